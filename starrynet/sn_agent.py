@@ -0,0 +1,103 @@
+import json
+import threading
+import time
+"""
+Controller side of the emulation agent. The agent (sn_orchestrater.py in
+agent mode) is started once on the emulation host and keeps one SSH channel
+open; requests are JSON lines [id, [[op, args...], ...]] answered by
+[id, results, error], so a batch of link operations, a delay update or a
+command costs one round trip on an open channel instead of a new SSH
+channel, a pty and often a new python3 process per command. See
+SN_AGENT_OPS in sn_orchestrater.py for the operations.
+"""
+
+
+class RemoteAgent():
+
+    def __init__(self,
+                 remote_ssh,
+                 orchestrater_path,
+                 work_dir,
+                 link_backend='bridge'):
+        # orchestrater_path: sn_orchestrater.py on the remote machine,
+        # work_dir: remote directory of the emulation (agent.log goes there),
+        # link_backend: how links are made, 'bridge' or 'veth'
+        self.channel = remote_ssh.get_transport().open_session()
+        self.channel.exec_command('python3 ' + orchestrater_path + ' ' +
+                                  work_dir + ' agent ' + link_backend)
+        self.requests = self.channel.makefile('wb')
+        self.replies = self.channel.makefile('rb')
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 0
+        # why the agent can no longer be called, None while it runs
+        self.closed = None
+        # statistics: requests, operations, and seconds spent waiting
+        self.calls = 0
+        self.ops = 0
+        self.wait_time = 0.0
+        self.reader = threading.Thread(target=self.read_replies, daemon=True)
+        self.reader.start()
+
+    def read_replies(self):
+        error = 'agent exited'
+        try:
+            for line in self.replies:
+                request_id, results, reply_error = json.loads(line)
+                with self.lock:
+                    slot = self.pending.pop(request_id)
+                slot['results'] = results
+                slot['error'] = reply_error
+                slot['done'].set()
+        except Exception as e:
+            # a reply that cannot be matched leaves the stream unusable
+            error = 'bad reply (%r)' % e
+        finally:
+            # fail whatever is still waiting, and every later call
+            with self.lock:
+                self.closed = error
+                slots = list(self.pending.values())
+                self.pending.clear()
+            for slot in slots:
+                slot['error'] = error
+                slot['done'].set()
+
+    def call(self, ops):
+        # Runs a batch of [op, args...] on the remote machine, in parallel.
+        # Returns their results in order; raises RuntimeError if one fails
+        # or if the agent is gone.
+        if not ops:
+            return []
+        start_time = time.time()
+        slot = {'done': threading.Event()}
+        with self.lock:
+            if self.closed is not None:
+                raise RuntimeError('remote agent: ' + self.closed)
+            request_id = self.next_id
+            self.next_id += 1
+            self.pending[request_id] = slot
+            self.requests.write(
+                (json.dumps([request_id, ops]) + '\n').encode())
+            self.requests.flush()
+        slot['done'].wait()
+        with self.lock:
+            self.calls += 1
+            self.ops += len(ops)
+            self.wait_time += time.time() - start_time
+        if slot['error'] is not None:
+            raise RuntimeError('remote agent: ' + slot['error'])
+        return slot['results']
+
+    def run(self, cmd):
+        # Output lines of a shell command, as sn_remote_cmd.
+        return self.call([['sh', cmd]])[0]
+
+    def close(self):
+        self.requests.close()
+        self.channel.shutdown_write()
+        self.reader.join()
+        self.channel.close()
+        if self.calls:
+            print("Remote agent: %d requests, %d operations, %.3f s per "
+                  "request." % (self.calls, self.ops,
+                                self.wait_time / self.calls))
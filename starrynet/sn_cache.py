@@ -0,0 +1,102 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+"""
+Content-addressed cache of observer outputs (positions, delay timeline and
+link changes), keyed by a hash of every input that affects them. Entries are
+evicted least-recently-used first once the cache exceeds its size bound.
+"""
+
+# Bump when the content or format of cached outputs changes.
+SN_CACHE_VERSION = 6
+# Outputs of Observer.calculate_delay, relative to the run directory.
+SN_CACHE_ITEMS = [
+    'delay', 'position', 'Topo_leo_change.txt', 'satellites.txt'
+]
+
+
+def sn_dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+class DelayCache():
+
+    def __init__(self, cache_dir, max_size):
+        # max_size in bytes; 0 disables the cache
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size = max_size
+        if self.max_size > 0:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, params):
+        params = dict(params, cache_version=SN_CACHE_VERSION)
+        text = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+    def load(self, key, path):
+        # Restore a cached entry into the run directory path. Returns False
+        # on a miss.
+        if self.max_size <= 0:
+            return False
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry):
+            return False
+        for item in SN_CACHE_ITEMS:
+            src = os.path.join(entry, item)
+            dst = os.path.join(path, item)
+            if os.path.isdir(dst):
+                shutil.rmtree(dst)
+            if os.path.isdir(src):
+                shutil.copytree(src, dst)
+            elif os.path.exists(src):
+                shutil.copy2(src, dst)
+        os.utime(entry)  # most recently used
+        return True
+
+    def store(self, key, path):
+        # Copy the outputs found in the run directory path into the cache,
+        # then evict old entries.
+        if self.max_size <= 0:
+            return
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry):
+            os.utime(entry)
+            return
+        tmp = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            for item in SN_CACHE_ITEMS:
+                src = os.path.join(path, item)
+                if os.path.isdir(src):
+                    shutil.copytree(src, os.path.join(tmp, item))
+                elif os.path.exists(src):
+                    shutil.copy2(src, os.path.join(tmp, item))
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        # Drop least recently used entries until the cache fits max_size.
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            entries.append(
+                (os.path.getmtime(entry), sn_dir_size(entry), name, entry))
+        total = sum(size for mtime, size, name, entry in entries)
+        for mtime, size, name, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -0,0 +1,184 @@
+import json
+import numpy as np
+
+from starrynet.sn_propagator import *
+from starrynet.sn_visibility import *
+from starrynet.sn_windows import *
+"""
+GSL handover policies. Every second, each GS keeps or replaces the satellites
+on its antennas according to a policy:
+  nearest             the antenna_num closest visible satellites (the default,
+                      "instant handover")
+  hysteresis          keep a satellite while it is visible, unless a free one
+                      is closer by more than SN_HYSTERESIS_KM
+  sticky              keep a satellite until it is no longer visible
+  longest visibility  keep a satellite until it is no longer visible, and
+                      replace it by the one that stays visible the longest
+The policies that depend on the previous second are run over all seconds
+before the observer shards, which then read the chosen satellites from
+delay/gsl.npy; the nearest policy needs no such pass. On request, every
+policy is evaluated on the same visibility data, so that the number of
+handovers each one makes is reported whatever the selected one.
+"""
+
+SN_HANDOVER_POLICIES = ['nearest', 'hysteresis', 'sticky', 'longest visibility']
+SN_HANDOVER_ALIASES = {'instant handover': 'nearest'}
+SN_HYSTERESIS_KM = 100
+
+
+def sn_handover_policy(name):
+    name = SN_HANDOVER_ALIASES.get(name.strip().lower(), name.strip().lower())
+    if name not in SN_HANDOVER_POLICIES:
+        raise ValueError('unknown handover policy "%s", expected one of %s' %
+                         (name, ', '.join(SN_HANDOVER_POLICIES)))
+    return name
+
+
+def sn_gsl_path(path):
+    # (seconds, GSes, antenna_num) int32 satellites chosen by the handover
+    # policy (-1 for an unused antenna), absent for the nearest policy.
+    return path + '/delay/gsl.npy'
+
+
+def sn_handover_count_path(path):
+    return path + '/delay/handover_count.json'
+
+
+def sn_handover_step(serving, rank, margin):
+    # One second of a policy. serving: (G, K) satellites (-1 for a free
+    # antenna), rank: (G, N) lower is better, inf if not visible. A serving
+    # satellite is replaced by a better candidate when its rank is worse by
+    # more than margin, or when it is no longer visible. Returns the new
+    # (G, K) serving satellites in ascending order.
+    G, K = serving.shape
+    rows = np.arange(G)[:, None]
+    kept_rank = np.where(serving >= 0, rank[rows, np.maximum(serving, 0)],
+                         np.inf)
+    kept = np.where(np.isfinite(kept_rank), serving, -1)
+    candidates = rank.copy()
+    g, k = np.nonzero(kept >= 0)
+    candidates[g, kept[g, k]] = np.inf
+    cand_sat, cand_rank = sn_closest(candidates, K)
+    # worst kept satellite against best candidate: the replaced antennas are
+    # a prefix of this pairing
+    order = np.argsort(-kept_rank, axis=-1, kind='stable')
+    kept = np.take_along_axis(kept, order, -1)
+    kept_rank = np.take_along_axis(kept_rank, order, -1)
+    replace = (cand_rank + margin < kept_rank) | (np.isinf(kept_rank) &
+                                                  np.isfinite(cand_rank))
+    return np.sort(np.where(replace, cand_sat, kept), axis=-1)
+
+
+def sn_new_links(pre, cur):
+    # Number of satellites in cur (G, K) that were not in pre (G, K).
+    new = (cur >= 0) & ~np.any(cur[:, :, None] == pre[:, None, :], axis=-1)
+    return int(np.count_nonzero(new))
+
+
+class HandoverEngine():
+
+    def __init__(self, satrecs, start, duration, fac_cbf, fac_lat, bound_dis,
+                 alpha, antenna_num, windows=None):
+        self.satrecs = satrecs
+        self.start = start
+        self.duration = duration
+        self.fac_cbf = np.asarray(fac_cbf, dtype=float).reshape(-1, 3)
+        self.fac_lat = np.asarray(fac_lat, dtype=float)
+        self.sat_num = len(satrecs)
+        self.bound_dis = np.broadcast_to(
+            np.asarray(bound_dis, dtype=float), (self.sat_num, ))
+        self.alpha = alpha
+        self.antenna_num = min(antenna_num, self.sat_num)
+        # visibility windows (see sn_windows), by GS-satellite pair and rise;
+        # only the longest visibility policy needs them
+        if windows is None:
+            windows = np.zeros(0, dtype=SN_WINDOW_DTYPE)
+        self.span = int(duration) * 1000 + 1
+        pair = (windows['gs'].astype(np.int64) - self.sat_num - 1) * \
+            self.sat_num + windows['sat'] - 1
+        keys = pair * self.span + windows['rise']
+        order = np.argsort(keys, kind='stable')
+        self.window_keys = keys[order]
+        self.window_pair = pair[order]
+        self.window_set = windows['set'][order].astype(np.int64)
+
+    def distances(self, first, last):
+        # (T, G, N) GS-satellite distances (km) of the seconds [first, last),
+        # inf where the satellite is not visible.
+        xyz = sn_propagate(self.satrecs, np.arange(first, last), self.start)
+        dis = sn_pairwise_distance(xyz, self.fac_cbf)
+        lat = sn_itrs_latitude(xyz)[:, None, :]
+        visible = (lat >= (self.fac_lat - self.alpha)[None, :, None]) & (
+            lat <= (self.fac_lat + self.alpha)[None, :, None]) & (
+                dis < self.bound_dis[None, None, :])
+        dis[~visible] = np.inf
+        return dis
+
+    def remaining(self, dis, t):
+        # (G, N) ms for which each visible satellite stays visible after
+        # second t, 0 if its window was not predicted.
+        g, n = np.nonzero(np.isfinite(dis))
+        pair = g * self.sat_num + n
+        now = t * 1000
+        result = np.zeros(dis.shape, dtype=np.int64)
+        if len(self.window_keys) == 0:
+            return result
+        index = np.searchsorted(self.window_keys, pair * self.span + now,
+                                side='right') - 1
+        index = np.maximum(index, 0)
+        found = (self.window_pair[index] == pair) & (self.window_set[index] >
+                                                     now)
+        result[g[found], n[found]] = self.window_set[index[found]] - now
+        return result
+
+    def rank(self, policy, dis, t):
+        if policy == 'longest visibility':
+            # longest remaining visibility first, then the closest
+            return np.where(np.isfinite(dis),
+                            dis * 1e-6 - self.remaining(dis, t), np.inf)
+        return dis
+
+    def run(self, policy, path, policies=None):
+        # Chooses the GSL satellites of every second with policy, writing
+        # them to sn_gsl_path(path) unless policy is nearest, and returns the
+        # number of handovers (links to a new satellite after the first
+        # second) made by each of policies, policy alone if None.
+        policies = policies or [policy]
+        G = len(self.fac_lat)
+        K = self.antenna_num
+        margins = {
+            'nearest': 0,
+            'hysteresis': SN_HYSTERESIS_KM,
+            'sticky': np.inf,
+            'longest visibility': np.inf,
+        }
+        serving = {
+            name: np.full((G, K), -1, dtype=np.int64)
+            for name in policies
+        }
+        counts = dict.fromkeys(policies, 0)
+        gsl = None
+        if policy != 'nearest':
+            gsl = np.lib.format.open_memmap(sn_gsl_path(path),
+                                            mode='w+',
+                                            dtype=np.int32,
+                                            shape=(self.duration, G, K))
+        block = max(1, SN_BLOCK_CELLS // max(1, G * self.sat_num))
+        for first in range(0, self.duration, block):
+            last = min(self.duration, first + block)
+            dis = self.distances(first, last)
+            for i, t in enumerate(range(first, last)):
+                for name in policies:
+                    cur = sn_handover_step(serving[name],
+                                           self.rank(name, dis[i], t),
+                                           margins[name])
+                    if t > 0:
+                        counts[name] += sn_new_links(serving[name], cur)
+                    serving[name] = cur
+                if gsl is not None:
+                    gsl[t] = serving[policy]
+        if gsl is not None:
+            gsl.flush()
+        with open(sn_handover_count_path(path), 'w') as f:
+            json.dump(counts, f, indent=4)
+        return counts
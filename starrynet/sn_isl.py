@@ -0,0 +1,58 @@
+import numpy as np
+
+from starrynet.sn_propagator import *
+from starrynet.sn_visibility import *
+"""
+Link-feasibility stage of the ISLs. The candidate ISLs (+grid ISLs of the
+Walker shells, plane ISLs of a TLE catalog) are checked every second
+against the configured constraints, all ISLs of the constellation at once:
+maximum range, earth occlusion (the link must stay SN_ATMOSPHERE km above
+the earth), shutoff of inter-plane links above a latitude, and shutoff of
+inter-plane links between counter-rotating planes (the seam of a star
+constellation). An ISL failing a check is absent from that second, so its
+removal and return are diffed into the link change stream like GSL changes
+and applied by the emulation. Without constraints the ISLs never change.
+"""
+
+
+def sn_isl_constraints(table):
+    # ISL constraints from the "ISL constraints" entry of config.json; 0 or
+    # false disables a check.
+    table = table or {}
+    return {
+        'max_range': float(table.get("max range (km)", 0)),
+        'occlusion': bool(table.get("earth occlusion", False)),
+        'latitude_limit': float(table.get("inter-plane latitude limit", 0)),
+        'seam': bool(table.get("counter-rotating seam", False)),
+    }
+
+
+def sn_isl_dynamic(constraints):
+    # Whether any constraint is enabled, i.e. the ISLs may change.
+    return bool(constraints) and any(constraints.values())
+
+
+def sn_isl_feasible(sat_cbf, sat_vel, isl_src, isl_dst, inter_plane,
+                    constraints):
+    # sat_cbf, sat_vel: (..., N, 3) satellite xyz (km) and velocities,
+    # inter_plane: (L, ) whether each ISL links two orbital planes.
+    # Returns (..., L) whether each ISL may be up.
+    p = sat_cbf[..., isl_src, :]
+    q = sat_cbf[..., isl_dst, :]
+    feasible = np.ones(p.shape[:-1], dtype=bool)
+    if constraints['max_range'] > 0:
+        d = q - p
+        feasible &= np.sum(d * d, axis=-1) < constraints['max_range']**2
+    if constraints['occlusion']:
+        feasible &= sn_line_of_sight(p, q)
+    if constraints['latitude_limit'] > 0:
+        lat = np.abs(sn_itrs_latitude(sat_cbf))
+        polar = (lat[..., isl_src] > constraints['latitude_limit']) | (
+            lat[..., isl_dst] > constraints['latitude_limit'])
+        feasible &= ~(polar & inter_plane)
+    if constraints['seam']:
+        # counter-rotating neighbors move in opposite directions
+        opposite = np.sum(sat_vel[..., isl_src, :] * sat_vel[..., isl_dst, :],
+                          axis=-1) < 0
+        feasible &= ~(opposite & inter_plane)
+    return feasible
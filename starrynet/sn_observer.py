@@ -1,12 +1,19 @@
 #encoding: utf-8
-import math
-from sgp4.api import Satrec, WGS84
-from skyfield.api import load, wgs84, EarthSatellite
-from datetime import datetime
 import numpy as np
 import os
+from concurrent.futures import ProcessPoolExecutor
 
+from starrynet.sn_cache import *
+from starrynet.sn_handover import *
+from starrynet.sn_isl import *
+from starrynet.sn_propagator import *
+from starrynet.sn_shard import *
+from starrynet.sn_shells import *
+from starrynet.sn_timeline import *
+from starrynet.sn_tle import *
 from starrynet.sn_utils import *
+from starrynet.sn_visibility import *
+from starrynet.sn_windows import *
 
 _ = inf = 999999  # inf
 
@@ -19,7 +26,10 @@ class Observer():
     def __init__(self, file_path, configuration_file_path, inclination,
                  satellite_altitude, orbit_number, sat_number, duration,
                  antenna_number, GS_lat_long, antenna_inclination,
-                 intra_routing, hello_interval, AS):
+                 intra_routing, hello_interval, AS, cache=None, tle_file='',
+                 workers=1, handover_policy='nearest', cycle=0, shells=None,
+                 inter_shell_links=(), isl_constraints=None,
+                 compare_policies=False, visibility_windows=False):
         self.file_path = file_path
         self.configuration_file_path = configuration_file_path
         self.inclination = inclination
@@ -33,193 +43,136 @@ class Observer():
         self.intra_routing = intra_routing
         self.hello_interval = hello_interval
         self.AS = AS
+        self.cache = cache
+        self.tle_file = tle_file
+        self.workers = workers  # processes of calculate_delay, 0 for auto
+        self.handover_policy = sn_handover_policy(handover_policy)
+        self.cycle = cycle  # configured constellation cycle (s), 0 for none
+        # count the handovers of every policy, not only the selected one
+        self.compare_policies = compare_policies
+        # predict GSL visibility windows and handover instants (sn_windows)
+        self.visibility_windows = visibility_windows
+        # Walker shells (see sn_shell), the single one of the arguments if
+        # none, and (lower, upper, range) inter-shell links
+        self.shells = shells or [{
+            'altitude': satellite_altitude,
+            'inclination': inclination,
+            'orbit': orbit_number,
+            'sat': sat_number,
+            'phase_shift': SN_DEFAULT_PHASE_SHIFT,
+        }]
+        self.inter_shell_links = list(inter_shell_links)
+        # see sn_isl_constraints
+        self.isl_constraints = isl_constraints or sn_isl_constraints({})
+        if self.tle_file:
+            # the catalog replaces the configured shells
+            self.inter_shell_links = []
+            self.load_tle()
+        else:
+            self.start = SN_START_UTC
+            self.gravity = WGS84
+            self.elements, self.sat_altitude = sn_shell_elements(self.shells)
+            self.constellation_size = len(self.elements)
+            self.isl_src, self.isl_dst = sn_shell_isls(self.shells)
+            self.sat_plane = sn_shell_planes(self.shells)
+            if len(self.shells) > 1:
+                print("%d satellites in %d shells" %
+                      (self.constellation_size, len(self.shells)))
 
-    def access_P_L_shortest(self, sat_cbf, fac_cbf, fac_num, sat_num,
-                            num_orbits, num_sats_per_orbit, duration, fac_ll,
-                            sat_lla, bound_dis, alpha, antenna_num, path):
-        delay_matrix = np.zeros((fac_num + sat_num, fac_num + sat_num))
-        for cur_time in range(duration):
-            for i in range(0, fac_num):
-                access_list = {}
-                fac_lat = float(fac_ll[i][0])  # latitude
-                up_lat = fac_lat + alpha  # bound
-                down_lat = fac_lat - alpha
-                x2 = fac_cbf[i][0]
-                y2 = fac_cbf[i][1]
-                z2 = fac_cbf[i][2]
-                for j in range(0, sat_num):
-                    if sat_lla[cur_time][j][0] >= down_lat and sat_lla[
-                            cur_time][j][0] <= up_lat:
-                        x1 = sat_cbf[cur_time][j][0]  # in km
-                        y1 = sat_cbf[cur_time][j][1]
-                        z1 = sat_cbf[cur_time][j][2]
-                        dist = math.sqrt(
-                            np.square(x1 - x2) + np.square(y1 - y2) +
-                            np.square(z1 - z2))
-                        if dist < bound_dis:
-                            # [satellite index，distance]
-                            access_list.update({j: dist})
-                if len(access_list) > antenna_num:
-                    sorted_access_list = dict(
-                        sorted(access_list.items(), key=lambda item: item[1]))
-                    cnt = 0
-                    for key, value in sorted_access_list.items():
-                        cnt = cnt + 1
-                        if cnt > antenna_num:
-                            break
-                        delay_time = value / (17.31 / 29.5 *
-                                              299792.458) * 1000  # ms
-                        delay_matrix[sat_num + i][key] = delay_time
-                        delay_matrix[key][sat_num + i] = delay_time
-                elif len(access_list) != 0:
-                    for key, value in access_list.items():
-                        delay_time = value / (17.31 / 29.5 *
-                                              299792.458) * 1000  # ms
-                        delay_matrix[sat_num + i][key] = delay_time
-                        delay_matrix[key][sat_num + i] = delay_time
-            for i in range(num_orbits):
-                for j in range(num_sats_per_orbit):
-                    num_sat1 = i * num_sats_per_orbit + j
-                    x1 = sat_cbf[cur_time][num_sat1][0]  # km
-                    y1 = sat_cbf[cur_time][num_sat1][1]
-                    z1 = sat_cbf[cur_time][num_sat1][2]
-                    num_sat2 = i * num_sats_per_orbit + (
-                        j + 1) % num_sats_per_orbit
-                    x2 = sat_cbf[cur_time][num_sat2][0]  # km
-                    y2 = sat_cbf[cur_time][num_sat2][1]
-                    z2 = sat_cbf[cur_time][num_sat2][2]
-                    num_sat3 = ((i + 1) % num_orbits) * num_sats_per_orbit + j
-                    x3 = sat_cbf[cur_time][num_sat3][0]  # km
-                    y3 = sat_cbf[cur_time][num_sat3][1]
-                    z3 = sat_cbf[cur_time][num_sat3][2]
-                    delay1 = math.sqrt(
-                        np.square(x1 - x2) + np.square(y1 - y2) +
-                        np.square(z1 - z2)) / (17.31 / 29.5 *
-                                               299792.458) * 1000  # ms
-                    delay2 = math.sqrt(
-                        np.square(x1 - x3) + np.square(y1 - y3) +
-                        np.square(z1 - z3)) / (17.31 / 29.5 *
-                                               299792.458) * 1000  # ms
-                    delay_matrix[num_sat1][num_sat2] = delay1
-                    delay_matrix[num_sat2][num_sat1] = delay1
-                    delay_matrix[num_sat1][num_sat3] = delay2
-                    delay_matrix[num_sat3][num_sat1] = delay2
-            np.savetxt(path + "/delay/" + str(cur_time + 1) + ".txt",
-                       delay_matrix,
-                       fmt='%.2f',
-                       delimiter=',')
-            for i in range(len(delay_matrix)):
-                delay_matrix[i, ...] = 0
-
-    def to_cbf(self, lat_long,
-               length):  # the xyz coordinate system. length: number of nodes
-        cbf = []
-        radius = 6371
-        for num in range(0, length):
-            cbf_in = []
-            R = radius
-            if len(lat_long[num]) > 2:
-                R += lat_long[num][2]
-            z = R * math.sin(math.radians(float(lat_long[num][0])))
-            x = R * math.cos(math.radians(float(
-                lat_long[num][0]))) * math.cos(
-                    math.radians(float(lat_long[num][1])))
-            y = R * math.cos(math.radians(float(
-                lat_long[num][0]))) * math.sin(
-                    math.radians(float(lat_long[num][1])))
-            cbf_in.append(x)
-            cbf_in.append(y)
-            cbf_in.append(z)
-            cbf.append(cbf_in)
-        return cbf  # xyz coordinates of all the satellites
+    def load_tle(self):
+        # TLE mode: satellites, start time and ISLs come from the catalog
+        cache_dir = None
+        if self.cache is not None and self.cache.max_size > 0:
+            cache_dir = self.cache.cache_dir
+        names, elements = sn_load_tle(self.tle_file, cache_dir)
+        self.start = sn_tle_start(elements)
+        self.gravity = WGS72
+        (self.sat_names, self.elements, plane, u, shell_of_plane,
+         self.sat_altitude) = sn_tle_constellation(names, elements,
+                                                   self.start)
+        self.isl_src, self.isl_dst = sn_plane_isls(plane, u, shell_of_plane)
+        self.sat_plane = plane
+        self.constellation_size = len(self.elements)
+        print("%d satellites in %d planes loaded from %s" %
+              (self.constellation_size, len(shell_of_plane), self.tle_file))
 
     def calculate_bound(self, inclination_angle, height):
-        bound_distance = 6371 * math.cos(
-            (90 + inclination_angle) / 180 * math.pi) + math.sqrt(
-                math.pow(
-                    6371 * math.cos(
-                        (90 + inclination_angle) / 180 * math.pi), 2) +
-                math.pow(height, 2) + 2 * height * 6371)
+        # height may be an array of satellite altitudes
+        bound_distance = 6371 * np.cos(
+            (90 + inclination_angle) / 180 * np.pi) + np.sqrt(
+                np.power(
+                    6371 * np.cos(
+                        (90 + inclination_angle) / 180 * np.pi), 2) +
+                np.power(height, 2) + 2 * height * 6371)
         return bound_distance
 
-    def matrix_to_change(self, duration, orbit_number, sat_number, path,
-                         GS_lat_long):
+    def matrix_to_change(self, duration, path, GS_lat_long, changes=None):
+        # changes: (time, added, removed) events in time order, diffed from
+        # the timeline of path if None
         no_fac = len(GS_lat_long)
-        no_geo = 0
         duration = duration - 1
-        no_leo = orbit_number * sat_number
-
-        topo_duration = [[[0 for i in range(no_leo + no_geo + no_fac)]
-                          for i in range(no_leo + no_geo + no_fac)]
-                         for k in range(duration)]
-        for time in range(1, duration + 1):
-            topo_path = path + '/delay/' + str(time) + ".txt"
-            adjacency_matrix = sn_get_param(topo_path)
-            for i in range(len(adjacency_matrix)):
-                for j in range(len(adjacency_matrix[i])):
-                    if float(adjacency_matrix[i][j]) > 0:
-                        adjacency_matrix[i][j] = 1
-                    else:
-                        adjacency_matrix[i][j] = 0
-            topo_duration[time - 1] = adjacency_matrix
-
-        changetime = []
-        Duration = []
-        for i in range(duration - 1):
-            l1 = topo_duration[i]
-            l2 = topo_duration[i + 1]
-            if l1 == l2:
-                continue
-            else:
-                changetime.append(i)
-        pretime = 0
-        for item in changetime:
-            Duration.append(item - pretime)
-            pretime = item
-        Duration.append(60)
+        # every shell, GEO included, is part of the constellation
+        node_num = self.constellation_size + no_fac
 
+        if changes is None:
+            timeline = DelayTimeline(sn_timeline_path(path))
+            changes = sn_link_changes(timeline, 1, duration)
         topo_leo_change_path = path + "/Topo_leo_change.txt"
         f = open(topo_leo_change_path, "w")
-        cnt = 1
-        for i in range(duration - 1):
-            pre_lines = topo_duration[i]
-            now_lines = topo_duration[i + 1]
-            if pre_lines == now_lines:
-                continue
-            else:
-                f.write("time " + str(i + 2) + ":\n")  # time started from 1
-                f.write('duration ' + str(Duration[cnt]) + ":\n")
-                cnt += 1
-                f.write("add:\n")
-                for j in range(no_fac):
-                    prelines = pre_lines[no_geo + no_leo + j]
-                    nowlines = now_lines[no_geo + no_leo + j]
-                    for k in range(no_geo + no_leo + no_fac):
-                        if prelines[k] == 0 and nowlines[k] == 1:
-                            f.write(
-                                str(k + 1) + "-" + str(no_leo + j + 1) +
-                                "\n")  # index
-                f.write("del:\n")
-                for j in range(no_fac):
-                    prelines = pre_lines[no_geo + no_leo + j]
-                    nowlines = now_lines[no_geo + no_leo + j]
-                    for k in range(no_geo + no_leo + no_fac):
-                        if prelines[k] == 1 and nowlines[k] == 0:
-                            f.write(
-                                str(k + 1) + "-" + str(no_leo + j + 1) +
-                                "\n")  # index
+        # a change is written once the next one is known, for its duration
+        pretime = 1
+        pending = None
+        for time, added, removed in changes:
+            if pending is not None:
+                self.write_change(f, pending, time - pretime, node_num)
+            pretime = time
+            pending = (time, added, removed)
+        if pending is not None:
+            self.write_change(f, pending, 60, node_num)
         f.write("time " + str(self.duration) + ":\n")  #
         f.write("end of the emulation! \n")  #
         f.close()
-        cnt = 1
+
+    def write_change(self, f, change, duration, node_num):
+        time, added, removed = change
+        f.write("time " + str(time) + ":\n")  # time started from 1
+        f.write('duration ' + str(duration) + ":\n")
+        f.write("add:\n")
+        for k, j in sn_key_pairs(added, node_num):
+            f.write(str(k + 1) + "-" + str(j + 1) + "\n")  # index
+        f.write("del:\n")
+        for k, j in sn_key_pairs(removed, node_num):
+            f.write(str(k + 1) + "-" + str(j + 1) + "\n")  # index
+
+    def cache_key(self):
+        # every input that affects the outputs of calculate_delay
+        params = {
+            'inclination': self.inclination,
+            'satellite_altitude': self.satellite_altitude,
+            'orbit_number': self.orbit_number,
+            'sat_number': self.sat_number,
+            'duration': self.duration,
+            'antenna_number': self.antenna_number,
+            'antenna_inclination': self.antenna_inclination,
+            'GS_lat_long': [[float(x) for x in gs] for gs in self.GS_lat_long],
+            'handover_policy': self.handover_policy,
+            'compare_policies': self.compare_policies,
+            'visibility_windows': self.visibility_windows,
+            'cycle': self.cycle,
+        }
+        if sn_isl_dynamic(self.isl_constraints):
+            params['isl_constraints'] = self.isl_constraints
+        if self.tle_file:
+            params['tle'] = sn_file_digest(self.tle_file)
+        else:
+            # the shells are used even if there is only one, and may differ
+            # from the top-level constellation parameters
+            params['shells'] = self.shells
+            params['inter_shell_links'] = self.inter_shell_links
+        return self.cache.key(params)
 
     def calculate_delay(self):
         path = self.configuration_file_path + "/" + self.file_path
-        sat_cbf = [
-        ]  # first dimension: time. second dimension: node. third dimension: xyz
-        sat_lla = [
-        ]  # first dimension: time. second dimension: node. third dimension: lla
-        fac_cbf = []  # first dimension: node. second dimension: xyz
 
         if os.path.exists(path + '/delay') == True:
             osstr = "rm -f " + path + "/delay/*"
@@ -232,90 +185,199 @@ class Observer():
             os.system(osstr)
         else:
             os.system("mkdir " + path + "/position")
+        if self.cache is not None:
+            key = self.cache_key()
+            if self.cache.load(key, path):
+                print("Delay and position data loaded from cache " + key)
+                return
 
-        ts = load.timescale()
-        since = datetime(1949, 12, 31, 0, 0, 0)
-        start = datetime(2020, 1, 1, 0, 0, 0)
-        epoch = (start - since).days
-        inclination = self.inclination * 2 * np.pi / 360
-        GM = 3.9860044e14
-        R = 6371393
-        altitude = self.satellite_altitude * 1000
-        mean_motion = np.sqrt(GM / (R + altitude)**3) * 60
-        num_of_orbit = self.orbit_number
-        sat_per_orbit = self.sat_number
-        num_of_sat = num_of_orbit * sat_per_orbit
-        F = 18
-        bound_dis = self.calculate_bound(
-            self.antenna_inclination, self.satellite_altitude) * 29.5 / 17.31
+        num_of_sat = self.constellation_size
+        if self.tle_file or len(self.shells) > 1:
+            # per-satellite bound, no latitude band: shells of a catalog
+            # or of a configured shell list differ in altitude and
+            # inclination
+            bound_dis = self.calculate_bound(
+                self.antenna_inclination, self.sat_altitude) * 29.5 / 17.31
+            alpha = 90
+        else:
+            # the only shell, which replaces the top-level parameters
+            shell = self.shells[0]
+            inclination = shell['inclination'] * 2 * np.pi / 360
+            bound_dis = self.calculate_bound(self.antenna_inclination,
+                                             shell['altitude']) * 29.5 / 17.31
+            alpha = np.degrees(
+                np.arccos(6371 / (6371 + shell['altitude']) *
+                          np.cos(np.radians(inclination)))) - inclination
 
-        duration = self.duration  # second
-        result = [[] for i in range(duration)]  # LLA result
-        lla_per_sec = [[] for i in range(duration)]  # LLA result
+        if self.tle_file:
+            with open(path + '/satellites.txt', 'w') as f:
+                for i, name in enumerate(self.sat_names):
+                    f.write(str(i + 1) + "," + name + "\n")
 
-        for i in range(num_of_orbit):  # range(num_of_orbit)
-            raan = i / num_of_orbit * 2 * np.pi
-            for j in range(sat_per_orbit):  # range(sat_per_orbit)
-                mean_anomaly = (j * 360 / sat_per_orbit + i * 360 * F /
-                                num_of_sat) % 360 * 2 * np.pi / 360
-                satrec = Satrec()
-                satrec.sgp4init(
-                    WGS84,  # gravity model
-                    'i',  # 'a' = old AFSPC mode, 'i' = improved mode
-                    i * sat_per_orbit + j,  # satnum: Satellite number
-                    epoch,  # epoch: days since 1949 December 31 00:00 UT
-                    2.8098e-05,  # bstar: drag coefficient (/earth radii)
-                    6.969196665e-13,  # ndot: ballistic coefficient (revs/day)
-                    0.0,  # nddot: second derivative of mean motion (revs/day^3)
-                    0.001,  # ecco: eccentricity
-                    0.0,  # argpo: argument of perigee (radians)
-                    inclination,  # inclo: inclination (radians)
-                    mean_anomaly,  # mo: mean anomaly (radians)
-                    mean_motion,  # no_kozai: mean motion (radians/minute)
-                    raan,  # nodeo: right ascension of ascending node (radians)
-                )
-                sat = EarthSatellite.from_satrec(satrec, ts)
-                cur = datetime(2022, 1, 1, 1, 0, 0)
-                t_ts = ts.utc(*cur.timetuple()[:5],
-                              range(duration))  # [:4]:minute，[:5]:second
-                geocentric = sat.at(t_ts)
-                subpoint = wgs84.subpoint(geocentric)
-                # list: [subpoint.latitude.degrees] [subpoint.longitude.degrees] [subpoint.elevation.km]
-                for t in range(duration):
-                    lla = '%f,%f,%f\n' % (subpoint.latitude.degrees[t],
-                                          subpoint.longitude.degrees[t],
-                                          subpoint.elevation.km[t])
-                    result[t].append(lla)
-                    lla = []
-                    lla.append(subpoint.latitude.degrees[t])
-                    lla.append(subpoint.longitude.degrees[t])
-                    lla.append(subpoint.elevation.km[t])
-                    lla_per_sec[t].append(lla)
+        # GS ITRS xyz and geocentric latitude, as for the satellites
+        fac_cbf = sn_lla_to_itrs(
+            np.reshape(np.asarray(self.GS_lat_long, dtype=float), (-1, 2)))
+        fac_lat = sn_itrs_latitude(fac_cbf)
+        shared = {
+            'elements': self.elements,
+            'isl_src': self.isl_src,
+            'isl_dst': self.isl_dst,
+            'isl_inter':
+            self.sat_plane[self.isl_src] != self.sat_plane[self.isl_dst],
+            'fac_cbf': fac_cbf,
+            'fac_lat': fac_lat,
+            'bound_dis': np.broadcast_to(bound_dis, (num_of_sat, )),
+        }
+        satrecs = sn_satrecs(self.elements, self.gravity)
+        gsl = ''
+        if len(fac_lat):
+            # the nearest policy is the one of the observer shards: the
+            # engine only runs for another policy or to compare them all
+            policies = []
+            if self.compare_policies:
+                policies = SN_HANDOVER_POLICIES
+            elif self.handover_policy != 'nearest':
+                policies = [self.handover_policy]
+            # GSL visibility windows and handover instants (ms) of the
+            # nearest policy, on request or for the longest visibility one
+            windows = None
+            if self.visibility_windows or 'longest visibility' in policies:
+                windows, handovers = VisibilityPredictor(
+                    satrecs, self.start, self.duration, fac_cbf, fac_lat,
+                    bound_dis, alpha, self.antenna_number).predict()
+                np.save(sn_windows_path(path), windows)
+                np.save(sn_handovers_path(path), handovers)
+            if policies:
+                counts = HandoverEngine(satrecs, self.start, self.duration,
+                                        fac_cbf, fac_lat, bound_dis, alpha,
+                                        self.antenna_number, windows).run(
+                                            self.handover_policy, path,
+                                            policies)
+                print("Handovers per policy: " +
+                      ", ".join("%s %d" % item for item in counts.items()) +
+                      " (" + self.handover_policy + " selected)")
+            if self.handover_policy != 'nearest':
+                gsl = sn_gsl_path(path)
+        # all positions in one array, filled in by the shards
+        np.lib.format.open_memmap(sn_position_path(path),
+                                  mode='w+',
+                                  dtype=np.float64,
+                                  shape=(self.duration, num_of_sat, 3)).flush()
+        np.lib.format.open_memmap(sn_state_path(path),
+                                  mode='w+',
+                                  dtype=np.float32,
+                                  shape=(self.duration, num_of_sat, 6)).flush()
+        np.save(sn_ground_path(path), fac_cbf)
+        # ISL delays repeat every cycle: the seconds of the first cycle are
+        # computed first, the later ones reuse their ISLs
+        cycle = 0
+        if not sn_isl_dynamic(self.isl_constraints):
+            # which ISLs are up is not checked for periodicity: with
+            # constraints, the ISLs of every second are computed
+            cycle = sn_isl_cycle(satrecs, self.start, self.isl_src,
+                                 self.isl_dst, self.cycle, self.duration)
+        if cycle:
+            print("ISL delays stored once per cycle of %d s" % cycle)
+            phases = [(0, cycle), (cycle, self.duration)]
+        else:
+            phases = [(0, self.duration)]
+        workers = self.workers or sn_auto_workers(self.duration)
+        tasks = []
+        blocks = []
+        try:
+            for name in shared:
+                shm, shared[name] = sn_share_array(shared[name])
+                blocks.append(shm)
+            for phase_first, phase_last in phases:
+                shards = [(phase_first + first, phase_first + last)
+                          for first, last in sn_time_shards(
+                              phase_last - phase_first, workers)]
+                tasks += self.observe_shards(shards, shared, alpha, gsl,
+                                             cycle, path)
+                if cycle and phase_first == 0:
+                    sn_concat_timelines([
+                        sn_periodic_path(task['timeline']) for task in tasks
+                    ], sn_periodic_path(sn_timeline_path(path)))
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+        sn_concat_timelines([task['timeline'] for task in tasks],
+                            sn_timeline_path(path))
+        # backpressure of the output writers, over all shards
+        submitted, blocks, blocked = np.sum(
+            [task['writer'] for task in tasks], axis=0)
+        print("Output writes: %d, %d blocked on a full queue for %.3f s" %
+              (submitted, blocks, blocked))
+        self.matrix_to_change(
+            self.duration, path, self.GS_lat_long,
+            (change for task in tasks
+             for change in sn_read_changes(task['changes'])))
+        for task in tasks:
+            os.remove(task['changes'])
+        if self.cache is not None:
+            self.cache.store(key, path)
 
-        for t in range(duration):
-            file = path + '/position/' + '%d.txt' % t
-            with open(file, 'w') as fw:
-                fw.writelines(result[t])
-            cbf_per_sec = self.to_cbf(lla_per_sec[t], num_of_sat)
-            sat_cbf.append(cbf_per_sec)
-            sat_lla.append(lla_per_sec[t])
+    def observe_shards(self, shards, shared, alpha, gsl, cycle, path):
+        # Runs sn_observe_shard on the [first, last) second ranges shards,
+        # in a process pool if there are several. Returns the tasks, with
+        # the AsyncWriter.stats() of each under 'writer'.
+        tasks = [{
+            'shared': shared,
+            'first': first,
+            'last': last,
+            'last_change': self.duration - 1,
+            'start': self.start,
+            'gravity': self.gravity,
+            'alpha': alpha,
+            'antenna_num': self.antenna_number,
+            'gsl': gsl,
+            'cycle': cycle,
+            'inter_shell': (sn_shell_offsets(self.shells),
+                            self.inter_shell_links),
+            'isl_constraints': self.isl_constraints,
+            'periodic': sn_periodic_path(sn_timeline_path(path)),
+            'path': path,
+            'timeline': path + '/delay/%d.sndt' % first,
+            'changes': path + '/delay/%d.changes' % first,
+        } for first, last in shards]
+        if len(tasks) == 1:
+            stats = [sn_observe_shard(tasks[0])]
+        else:
+            print("Observing %d seconds in %d shards" %
+                  (shards[-1][1] - shards[0][0], len(tasks)))
+            with ProcessPoolExecutor(len(tasks)) as pool:
+                stats = list(pool.map(sn_observe_shard, tasks))
+        for task, writer in zip(tasks, stats):
+            task['writer'] = writer
+        return tasks
 
-        if len(self.GS_lat_long) != 0:
-            fac_cbf = self.to_cbf(self.GS_lat_long, len(self.GS_lat_long))
+    def isl_pairs(self):
+        # Candidate ISLs (the grids of the shells, or the planes of the
+        # catalog) as 1-based (low, high) satellite pairs.
+        low = np.minimum(self.isl_src, self.isl_dst) + 1
+        high = np.maximum(self.isl_src, self.isl_dst) + 1
+        return set(zip(low.tolist(), high.tolist()))
 
-        alpha = np.degrees(
-            np.arccos(6371 / (6371 + self.satellite_altitude) *
-                      np.cos(np.radians(inclination)))) - inclination
-        self.access_P_L_shortest(sat_cbf, fac_cbf, len(self.GS_lat_long),
-                                 self.sat_number * self.orbit_number,
-                                 self.orbit_number, self.sat_number,
-                                 self.duration, self.GS_lat_long, sat_lla,
-                                 bound_dis, alpha, self.antenna_number, path)
-        self.matrix_to_change(self.duration, self.orbit_number,
-                              self.sat_number, path, self.GS_lat_long)
+    def isl_peers(self, path):
+        # 1-based ISL peers of every satellite: the candidate ISLs and every
+        # other satellite pair linked in some second of the timeline of
+        # path, such as inter-shell links.
+        timeline = DelayTimeline(sn_timeline_path(path))
+        pairs = self.isl_pairs()
+        for low, high in sn_key_pairs(
+                sn_linked_keys(timeline, 1, len(timeline)),
+                timeline.node_num):
+            if high < self.constellation_size:
+                pairs.add((low + 1, high + 1))
+        peers = [set() for _ in range(self.constellation_size)]
+        for low, high in pairs:
+            peers[low - 1].add(high)
+            peers[high - 1].add(low)
+        return peers
 
     def compute_conf(self, sat_node_number, interval, num1, num2, ID, Q,
-                     num_backbone, matrix):
+                     num_backbone, isl_peers):
         Q.append(
             "log \"/var/log/bird.log\" { debug, trace, info, remote, warning, error, auth, fatal, bug };"
         )
@@ -358,8 +420,10 @@ class Observer():
                  ";			# Default hello perid 10 is too long")
         Q.append("    };")
         if num1 <= sat_node_number and num2 <= num_backbone and ID <= sat_node_number:  # satellite
+            # every ISL that can come up, not only those of the first
+            # second
             for peer in range(num1, num2 + 1):
-                if (peer == ID) or (int(float(matrix[ID - 1][peer - 1])) == 0):
+                if peer not in isl_peers[ID - 1]:
                     continue
                 Q.append("    interface \"B%d-eth%d\" {" % (ID, peer))
                 Q.append("        type broadcast;		# Detected by default")
@@ -439,29 +503,29 @@ class Observer():
             return False
         if os.path.exists(self.configuration_file_path + "/" + self.file_path +
                           "/conf/bird-" +
-                          str(self.orbit_number * self.sat_number) + "-" +
+                          str(self.constellation_size) + "-" +
                           str(len(self.GS_lat_long))) == True:
             osstr = "rm -f " + self.configuration_file_path+"/"+self.file_path+"/conf/bird-" + \
-                str(self.orbit_number*self.sat_number) + "-" + str(len(self.GS_lat_long)) + "/*"
+                str(self.constellation_size) + "-" + str(len(self.GS_lat_long)) + "/*"
             os.system(osstr)
             sn_remote_cmd(remote_ssh, "mkdir ~/" + self.file_path + "/conf")
             sn_remote_cmd(
                 remote_ssh, "mkdir ~/" + self.file_path + "/conf/bird-" +
-                str(self.orbit_number * self.sat_number) + "-" +
+                str(self.constellation_size) + "-" +
                 str(len(self.GS_lat_long)))
         else:
             os.makedirs(self.configuration_file_path + "/" + self.file_path +
                         "/conf/bird-" +
-                        str(self.orbit_number * self.sat_number) + "-" +
+                        str(self.constellation_size) + "-" +
                         str(len(self.GS_lat_long)))
             sn_remote_cmd(remote_ssh, "mkdir ~/" + self.file_path + "/conf")
             sn_remote_cmd(
                 remote_ssh, "mkdir ~/" + self.file_path + "/conf/bird-" +
-                str(self.orbit_number * self.sat_number) + "-" +
+                str(self.constellation_size) + "-" +
                 str(len(self.GS_lat_long)))
-        path = self.configuration_file_path + "/" + self.file_path + "/delay/1.txt"
-        matrix = sn_get_param(path)
-        num_backbone = self.orbit_number * self.sat_number + len(
+        isl_peers = self.isl_peers(self.configuration_file_path + "/" +
+                                   self.file_path)
+        num_backbone = self.constellation_size + len(
             self.GS_lat_long)
         error = True
         for i in range(len(self.AS)):
@@ -469,10 +533,10 @@ class Observer():
                 for ID in range(self.AS[i][0], self.AS[i][1] + 1):
                     Q = []
                     error = self.compute_conf(
-                        self.orbit_number * self.sat_number,
+                        self.constellation_size,
                         self.hello_interval, self.AS[i][0], self.AS[i][1], ID,
-                        Q, num_backbone, matrix)
-                    self.print_conf(self.orbit_number * self.sat_number,
+                        Q, num_backbone, isl_peers)
+                    self.print_conf(self.constellation_size,
                                     len(self.GS_lat_long), ID, Q, remote_ftp)
             else:  # one node in one AS
                 ID = self.AS[i][0]
@@ -519,7 +583,7 @@ class Observer():
                 Q.append("    };")
                 Q.append("    };")
                 Q.append(" }")
-                self.print_conf(self.orbit_number * self.sat_number,
+                self.print_conf(self.constellation_size,
                                 len(self.GS_lat_long), ID, Q, remote_ftp)
 
         return error
@@ -1,6 +1,13 @@
 import os
+import json
+import pty
+import re
+import struct
+import subprocess
 import threading
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 import numpy
 """
@@ -8,260 +15,181 @@ Used in the remote machine for link updating, initializing links, damaging and r
 author: Yangtao Deng (dengyt21@mails.tsinghua.edu.cn) and Zeqi Lai (zeqilai@tsinghua.edu.cn) 
 """
 
-
-def sn_get_right_satellite(current_sat_id, current_orbit_id, orbit_num):
-    if current_orbit_id == orbit_num - 1:
-        return [current_sat_id, 0]
-    else:
-        return [current_sat_id, current_orbit_id + 1]
-
-
-def sn_get_down_satellite(current_sat_id, current_orbit_id, sat_num):
-    if current_sat_id == sat_num - 1:
-        return [0, current_orbit_id]
-    else:
-        return [current_sat_id + 1, current_orbit_id]
-
-
-def sn_ISL_establish(current_sat_id, current_orbit_id, container_id_list,
-                     orbit_num, sat_num, constellation_size, matrix, bw, loss):
-    current_id = current_orbit_id * sat_num + current_sat_id
-    isl_idx = current_id * 2 + 1
-    # Establish intra-orbit ISLs
-    # (Down):
-    [down_sat_id,
-     down_orbit_id] = sn_get_down_satellite(current_sat_id, current_orbit_id,
-                                            sat_num)
-    print("[" + str(isl_idx) + "/" + str(constellation_size * 2) +
-          "] Establish intra-orbit ISL from: (" + str(current_sat_id) + "," +
-          str(current_orbit_id) + ") to (" + str(down_sat_id) + "," +
-          str(down_orbit_id) + ")")
-    ISL_name = "Le_" + str(current_sat_id) + "-" + str(current_orbit_id) + \
-        "_" + str(down_sat_id) + "-" + str(down_orbit_id)
-    address_16_23 = isl_idx >> 8
-    address_8_15 = isl_idx & 0xff
-    # Create internal network in docker.
-    os.system('docker network create ' + ISL_name + " --subnet 10." +
-              str(address_16_23) + "." + str(address_8_15) + ".0/24")
-    print('[Create ISL:]' + 'docker network create ' + ISL_name +
-          " --subnet 10." + str(address_16_23) + "." + str(address_8_15) +
-          ".0/24")
-    os.system('docker network connect ' + ISL_name + " " +
-              str(container_id_list[current_orbit_id * sat_num +
-                                    current_sat_id]) + " --ip 10." +
-              str(address_16_23) + "." + str(address_8_15) + ".40")
-    delay = matrix[current_orbit_id * sat_num +
-                   current_sat_id][down_orbit_id * sat_num + down_sat_id]
-    with os.popen(
-            "docker exec -it " +
-            str(container_id_list[current_orbit_id * sat_num +
-                                  current_sat_id]) +
-            " ip addr | grep -B 2 10." + str(address_16_23) + "." +
-            str(address_8_15) +
-            ".40 | head -n 1 | awk -F: '{ print $2 }' | tr -d [:blank:]") as f:
+# Container network namespaces programmed at once.
+SN_NETNS_WORKERS = 16
+# Host pids of the containers (see sn_get_container_pids).
+SN_CONTAINER_PIDS = {}
+# Seconds between two polls of the OSPF state of all containers, and polls
+# in a row over which the routes must not change for the routing to be
+# converged (see sn_wait_routing).
+SN_ROUTING_POLL = 1
+SN_ROUTING_STABLE_POLLS = 3
+
+
+def sn_link_connect(network_name, container_id_list, node, peer, ip, delay,
+                    bw, loss):
+    # Attach node to the network as B<node>-eth<peer> with a netem qdisc.
+    os.system('docker network connect ' + network_name + " " +
+              str(container_id_list[node]) + " --ip " + ip)
+    with os.popen("docker exec -it " + str(container_id_list[node]) +
+                  " ip addr | grep -B 2 " + ip +
+                  " | head -n 1 | awk -F: '{ print $2 }' | tr -d [:blank:]"
+                  ) as f:
         ifconfig_output = f.readline()
         target_interface = str(ifconfig_output).split("@")[0]
-        os.system("docker exec -d " +
-                  str(container_id_list[current_orbit_id * sat_num +
-                                        current_sat_id]) +
+        os.system("docker exec -d " + str(container_id_list[node]) +
                   " ip link set dev " + target_interface + " down")
-        os.system("docker exec -d " +
-                  str(container_id_list[current_orbit_id * sat_num +
-                                        current_sat_id]) +
+        os.system("docker exec -d " + str(container_id_list[node]) +
                   " ip link set dev " + target_interface + " name " + "B" +
-                  str(current_orbit_id * sat_num + current_sat_id + 1) +
-                  "-eth" + str(down_orbit_id * sat_num + down_sat_id + 1))
-        os.system("docker exec -d " +
-                  str(container_id_list[current_orbit_id * sat_num +
-                                        current_sat_id]) +
-                  " ip link set dev B" +
-                  str(current_orbit_id * sat_num + current_sat_id + 1) +
-                  "-eth" + str(down_orbit_id * sat_num + down_sat_id + 1) +
-                  " up")
-        os.system("docker exec -d " +
-                  str(container_id_list[current_orbit_id * sat_num +
-                                        current_sat_id]) +
-                  " tc qdisc add dev B" +
-                  str(current_orbit_id * sat_num + current_sat_id + 1) +
-                  "-eth" + str(down_orbit_id * sat_num + down_sat_id + 1) +
-                  " root netem delay " + str(delay) + "ms loss " + str(loss) + "% rate " + str(bw) + "Gbit")
-    print('[Add current node:]' + 'docker network connect ' + ISL_name + " " +
-          str(container_id_list[current_orbit_id * sat_num + current_sat_id]) +
-          " --ip 10." + str(address_16_23) + "." + str(address_8_15) + ".40")
-    os.system('docker network connect ' + ISL_name + " " +
-              str(container_id_list[down_orbit_id * sat_num + down_sat_id]) +
-              " --ip 10." + str(address_16_23) + "." + str(address_8_15) +
-              ".10")
-    with os.popen(
-            "docker exec -it " +
-            str(container_id_list[down_orbit_id * sat_num + down_sat_id]) +
-            " ip addr | grep -B 2 10." + str(address_16_23) + "." +
-            str(address_8_15) +
-            ".10 | head -n 1 | awk -F: '{ print $2 }' | tr -d [:blank:]") as f:
-        ifconfig_output = f.readline()
-        target_interface = str(ifconfig_output).split("@")[0]
-        os.system("docker exec -d " +
-                  str(container_id_list[down_orbit_id * sat_num +
-                                        down_sat_id]) + " ip link set dev " +
-                  target_interface + " down")
-        os.system("docker exec -d " +
-                  str(container_id_list[down_orbit_id * sat_num +
-                                        down_sat_id]) + " ip link set dev " +
-                  target_interface + " name " + "B" +
-                  str(down_orbit_id * sat_num + down_sat_id + 1) + "-eth" +
-                  str(current_orbit_id * sat_num + current_sat_id + 1))
-        os.system("docker exec -d " +
-                  str(container_id_list[down_orbit_id * sat_num +
-                                        down_sat_id]) + " ip link set dev B" +
-                  str(down_orbit_id * sat_num + down_sat_id + 1) + "-eth" +
-                  str(current_orbit_id * sat_num + current_sat_id + 1) + " up")
-        os.system("docker exec -d " +
-                  str(container_id_list[down_orbit_id * sat_num +
-                                        down_sat_id]) + " tc qdisc add dev B" +
-                  str(down_orbit_id * sat_num + down_sat_id + 1) + "-eth" +
-                  str(current_orbit_id * sat_num + current_sat_id + 1) +
-                  " root netem delay " + str(delay) + "ms loss " + str(loss) + "% rate " + str(bw) + "Gbit")
-    print('[Add down node:]' + 'docker network connect ' + ISL_name + " " +
-          str(container_id_list[down_orbit_id * sat_num + down_sat_id]) +
-          " --ip 10." + str(address_16_23) + "." + str(address_8_15) + ".10")
-
-    print("Add 10." + str(address_16_23) + "." + str(address_8_15) +
-          ".40/24 and 10." + str(address_16_23) + "." + str(address_8_15) +
-          ".10/24 to (" + str(current_sat_id) + "," + str(current_orbit_id) +
-          ") to (" + str(down_sat_id) + "," + str(down_orbit_id) + ")")
-    isl_idx = isl_idx + 1
-
-    # Establish inter-orbit ISLs
-    # (Right):
-    [right_sat_id,
-     right_orbit_id] = sn_get_right_satellite(current_sat_id, current_orbit_id,
-                                              orbit_num)
-    print("[" + str(isl_idx) + "/" + str(constellation_size * 2) +
-          "] Establish inter-orbit ISL from: (" + str(current_sat_id) + "," +
-          str(current_orbit_id) + ") to (" + str(right_sat_id) + "," +
-          str(right_orbit_id) + ")")
-    ISL_name = "La_" + str(current_sat_id) + "-" + str(current_orbit_id) + \
-        "_" + str(right_sat_id) + "-" + str(right_orbit_id)
-    address_16_23 = isl_idx >> 8
-    address_8_15 = isl_idx & 0xff
+                  str(node + 1) + "-eth" + str(peer + 1))
+        os.system("docker exec -d " + str(container_id_list[node]) +
+                  " ip link set dev B" + str(node + 1) + "-eth" +
+                  str(peer + 1) + " up")
+        os.system("docker exec -d " + str(container_id_list[node]) +
+                  " tc qdisc add dev B" + str(node + 1) + "-eth" +
+                  str(peer + 1) + " root netem delay " + str(delay) +
+                  "ms loss " + str(loss) + "% rate " + str(bw) + "Gbit")
+    print('[Add node:]' + 'docker network connect ' + network_name + " " +
+          str(container_id_list[node]) + " --ip " + ip)
+
+
+def sn_ISL_subnet(isl_idx):
+    # isl_idx (1-based) numbers the ISL subnet 10.x.y.0/24
+    return "10." + str(isl_idx >> 8) + "." + str(isl_idx & 0xff)
+
+
+def sn_GSL_subnet(i, j, constellation_size):
+    # 9.x.y.0/24 of the GSL between satellite i and GS j (1-based)
+    return "9." + str((j - constellation_size) & 0xff) + "." + str(i & 0xff)
+
+
+def sn_ISL_establish(isl_idx, isl_num, current_id, peer_id, delay,
+                     container_id_list, bw, loss):
+    print("[" + str(isl_idx) + "/" + str(isl_num) + "] Establish ISL from: " +
+          str(current_id + 1) + " to " + str(peer_id + 1))
+    ISL_name = "Le_" + str(current_id + 1) + "-" + str(peer_id + 1)
+    subnet = sn_ISL_subnet(isl_idx)
     # Create internal network in docker.
-    os.system('docker network create ' + ISL_name + " --subnet 10." +
-              str(address_16_23) + "." + str(address_8_15) + ".0/24")
+    os.system('docker network create ' + ISL_name + " --subnet " + subnet +
+              ".0/24")
     print('[Create ISL:]' + 'docker network create ' + ISL_name +
-          " --subnet 10." + str(address_16_23) + "." + str(address_8_15) +
-          ".0/24")
-    os.system('docker network connect ' + ISL_name + " " +
-              str(container_id_list[current_orbit_id * sat_num +
-                                    current_sat_id]) + " --ip 10." +
-              str(address_16_23) + "." + str(address_8_15) + ".30")
-    delay = matrix[current_orbit_id * sat_num +
-                   current_sat_id][right_orbit_id * sat_num + right_sat_id]
-    with os.popen(
-            "docker exec -it " +
-            str(container_id_list[current_orbit_id * sat_num +
-                                  current_sat_id]) +
-            " ip addr | grep -B 2 10." + str(address_16_23) + "." +
-            str(address_8_15) +
-            ".30 | head -n 1 | awk -F: '{ print $2 }' | tr -d [:blank:]") as f:
-        ifconfig_output = f.readline()
-        target_interface = str(ifconfig_output).split("@")[0]
-        os.system("docker exec -d " +
-                  str(container_id_list[current_orbit_id * sat_num +
-                                        current_sat_id]) +
-                  " ip link set dev " + target_interface + " down")
-        os.system("docker exec -d " +
-                  str(container_id_list[current_orbit_id * sat_num +
-                                        current_sat_id]) +
-                  " ip link set dev " + target_interface + " name " + "B" +
-                  str(current_orbit_id * sat_num + current_sat_id + 1) +
-                  "-eth" + str(right_orbit_id * sat_num + right_sat_id + 1))
-        os.system("docker exec -d " +
-                  str(container_id_list[current_orbit_id * sat_num +
-                                        current_sat_id]) +
-                  " ip link set dev B" +
-                  str(current_orbit_id * sat_num + current_sat_id + 1) +
-                  "-eth" + str(right_orbit_id * sat_num + right_sat_id + 1) +
-                  " up")
-        os.system("docker exec -d " +
-                  str(container_id_list[current_orbit_id * sat_num +
-                                        current_sat_id]) +
-                  " tc qdisc add dev B" +
-                  str(current_orbit_id * sat_num + current_sat_id + 1) +
-                  "-eth" + str(right_orbit_id * sat_num + right_sat_id + 1) +
-                  " root netem delay " + str(delay) + "ms loss " + str(loss) + "% rate " + str(bw) + "Gbit")
-    print('[Add current node:]' + 'docker network connect ' + ISL_name + " " +
-          str(container_id_list[current_orbit_id * sat_num + current_sat_id]) +
-          " --ip 10." + str(address_16_23) + "." + str(address_8_15) + ".30")
-    os.system('docker network connect ' + ISL_name + " " +
-              str(container_id_list[right_orbit_id * sat_num + right_sat_id]) +
-              " --ip 10." + str(address_16_23) + "." + str(address_8_15) +
-              ".20")
-
-    with os.popen(
-            "docker exec -it " +
-            str(container_id_list[right_orbit_id * sat_num + right_sat_id]) +
-            " ip addr | grep -B 2 10." + str(address_16_23) + "." +
-            str(address_8_15) +
-            ".20 | head -n 1 | awk -F: '{ print $2 }' | tr -d [:blank:]") as f:
-        ifconfig_output = f.readline()
-        target_interface = str(ifconfig_output).split("@")[0]
-        os.system("docker exec -d " +
-                  str(container_id_list[right_orbit_id * sat_num +
-                                        right_sat_id]) + " ip link set dev " +
-                  target_interface + " down")
-        os.system("docker exec -d " +
-                  str(container_id_list[right_orbit_id * sat_num +
-                                        right_sat_id]) + " ip link set dev " +
-                  target_interface + " name " + "B" +
-                  str(right_orbit_id * sat_num + right_sat_id + 1) + "-eth" +
-                  str(current_orbit_id * sat_num + current_sat_id + 1))
-        os.system("docker exec -d " +
-                  str(container_id_list[right_orbit_id * sat_num +
-                                        right_sat_id]) + " ip link set dev B" +
-                  str(right_orbit_id * sat_num + right_sat_id + 1) + "-eth" +
-                  str(current_orbit_id * sat_num + current_sat_id + 1) + " up")
-        os.system("docker exec -d " +
-                  str(container_id_list[right_orbit_id * sat_num +
-                                        right_sat_id]) +
-                  " tc qdisc add dev B" +
-                  str(right_orbit_id * sat_num + right_sat_id + 1) + "-eth" +
-                  str(current_orbit_id * sat_num + current_sat_id + 1) +
-                  " root netem delay " + str(delay) + "ms loss " + str(loss) + "% rate " + str(bw) + "Gbit")
-    print('[Add right node:]' + 'docker network connect ' + ISL_name + " " +
-          str(container_id_list[right_orbit_id * sat_num + right_sat_id]) +
-          " --ip 10." + str(address_16_23) + "." + str(address_8_15) + ".20")
-
-    print("Add 10." + str(address_16_23) + "." + str(address_8_15) +
-          ".30/24 and 10." + str(address_16_23) + "." + str(address_8_15) +
-          ".20/24 to (" + str(current_sat_id) + "," + str(current_orbit_id) +
-          ") to (" + str(right_sat_id) + "," + str(right_orbit_id) + ")")
-
-
-def sn_establish_ISLs(container_id_list, matrix, orbit_num, sat_num,
-                      constellation_size, bw, loss):
+          " --subnet " + subnet + ".0/24")
+    sn_link_connect(ISL_name, container_id_list, current_id, peer_id,
+                    subnet + ".40", delay, bw, loss)
+    sn_link_connect(ISL_name, container_id_list, peer_id, current_id,
+                    subnet + ".10", delay, bw, loss)
+    print("Add " + subnet + ".40/24 and " + subnet + ".10/24 to " +
+          str(current_id + 1) + " to " + str(peer_id + 1))
+
+
+def sn_establish_ISLs(container_id_list, links, constellation_size, bw, loss,
+                      backend):
+    # every satellite-satellite link of the uploaded frame is an ISL
+    ISLs = [(low, high, link_delay)
+            for (low, high), link_delay in sorted(links.items())
+            if high < constellation_size]
+    if backend == "veth":
+        sn_veth_establish(container_id_list, [
+            (current_id, peer_id, sn_ISL_subnet(isl_idx) + ".40",
+             sn_ISL_subnet(isl_idx) + ".10", delay, bw, loss)
+            for isl_idx, (current_id, peer_id, delay) in enumerate(ISLs, 1)
+        ])
+        return
     ISL_threads = []
-    for current_orbit_id in range(0, orbit_num):
-        for current_sat_id in range(0, sat_num):
-            ISL_thread = threading.Thread(
-                target=sn_ISL_establish,
-                args=(current_sat_id, current_orbit_id, container_id_list,
-                      orbit_num, sat_num, constellation_size, matrix, bw,
-                      loss))
-            ISL_threads.append(ISL_thread)
+    for isl_idx, (current_id, peer_id, delay) in enumerate(ISLs, 1):
+        ISL_thread = threading.Thread(target=sn_ISL_establish,
+                                      args=(isl_idx, len(ISLs), current_id,
+                                            peer_id, delay, container_id_list,
+                                            bw, loss))
+        ISL_threads.append(ISL_thread)
     for ISL_thread in ISL_threads:
         ISL_thread.start()
     for ISL_thread in ISL_threads:
         ISL_thread.join()
 
 
-def sn_get_param(file_):
-    f = open(file_)
-    ADJ = f.readlines()
-    for i in range(len(ADJ)):
-        ADJ[i] = ADJ[i].strip('\n')
-    ADJ = [x.split(',') for x in ADJ]
-    f.close()
-    return ADJ
+def sn_GSL_establish(container_id_list, i, j, constellation_size, delay, bw,
+                     loss):
+    # GSL between satellite i and GS j (1-based)
+    subnet = sn_GSL_subnet(i, j, constellation_size)
+    GSL_name = "GSL_" + str(i) + "-" + str(j)
+    # Create internal network in docker.
+    os.system('docker network create ' + GSL_name + " --subnet " + subnet +
+              ".0/24")
+    print('[Create GSL:]' + 'docker network create ' + GSL_name +
+          " --subnet " + subnet + ".0/24")
+    sn_link_connect(GSL_name, container_id_list, i - 1, j - 1, subnet + ".50",
+                    delay, bw, loss)
+    sn_link_connect(GSL_name, container_id_list, j - 1, i - 1, subnet + ".60",
+                    delay, bw, loss)
+
+
+def sn_GSL_delete(container_id_list, i, j):
+    for node, peer in ((j, i), (i, j)):
+        os.system("docker exec -d " + str(container_id_list[node - 1]) +
+                  " ip link set dev B" + str(node) + "-eth" + str(peer) +
+                  " down")
+    GSL_name = "GSL_" + str(i) + "-" + str(j)
+    for node in (i, j):
+        os.system('docker network disconnect ' + GSL_name + " " +
+                  str(container_id_list[node - 1]))
+    os.system('docker network rm ' + GSL_name)
+
+
+def sn_ISL_up(container_id_list, i, j, delay):
+    # Interfaces of an existing ISL network (1-based satellites) up again,
+    # at the current delay.
+    for node, peer in ((i, j), (j, i)):
+        interface = "B" + str(node) + "-eth" + str(peer)
+        os.system("docker exec -d " + str(container_id_list[node - 1]) +
+                  " ip link set dev " + interface + " up")
+        os.system("docker exec -d " + str(container_id_list[node - 1]) +
+                  " tc qdisc change dev " + interface + " root netem delay " +
+                  str(delay) + "ms")
+
+
+def sn_ISL_down(container_id_list, i, j):
+    # The network is kept, so the ISL can come back (see sn_ISL_up).
+    for node, peer in ((i, j), (j, i)):
+        os.system("docker exec -d " + str(container_id_list[node - 1]) +
+                  " ip link set dev B" + str(node) + "-eth" + str(peer) +
+                  " down")
+
+
+def sn_ISL_delete(container_id_list, i, j):
+    # Removes the network of an ISL (1-based satellites) for good, as
+    # sn_GSL_delete; its subnet can be used by a new ISL afterwards.
+    for node, peer in ((i, j), (j, i)):
+        os.system("docker exec -d " + str(container_id_list[node - 1]) +
+                  " ip link set dev B" + str(node) + "-eth" + str(peer) +
+                  " down")
+    ISL_name = "Le_" + str(i) + "-" + str(j)
+    for node in (i, j):
+        os.system('docker network disconnect ' + ISL_name + " " +
+                  str(container_id_list[node - 1]))
+    os.system('docker network rm ' + ISL_name)
+
+
+def sn_get_links(file_):
+    # One-frame delay timeline uploaded by the controller (sn_timeline.py):
+    # 64-byte header ('<4sIIIQQ': magic, version, node number, frame number,
+    # data size in bytes, index offset) followed by its only frame, a
+    # keyframe: (src, dst, delay) edges of 12 bytes.
+    # Returns {(src, dst): delay (ms)} with 0-based src < dst.
+    with open(file_, 'rb') as f:
+        header = f.read(64)
+        data_size = struct.unpack_from('<4sIIIQQ', header)[4]
+        edges = numpy.fromfile(f,
+                               dtype=[('src', '<u4'), ('dst', '<u4'),
+                                      ('delay', '<f4')],
+                               count=data_size // 12)
+    delays = numpy.round(edges['delay'].astype(float), 2).tolist()
+    return dict(
+        zip(zip(edges['src'].tolist(), edges['dst'].tolist()), delays))
+
+
+def sn_get_link_delay(links, x, y):
+    return links.get((min(x, y), max(x, y)), 0.0)
 
 
 def sn_get_container_info():
@@ -277,79 +205,27 @@ def sn_get_container_info():
     return container_id_list
 
 
-def sn_establish_GSL(container_id_list, matrix, GS_num, constellation_size, bw,
-                     loss):
+def sn_establish_GSL(container_id_list, links, GS_num, constellation_size, bw,
+                     loss, backend):
     # starting links among satellites and ground stations
-    for i in range(1, constellation_size + 1):
-        for j in range(constellation_size + 1,
-                       constellation_size + GS_num + 1):
-            # matrix[i-1][j-1])==1 means a link between node i and node j
-            if ((float(matrix[i - 1][j - 1])) <= 0.01):
-                continue
-            # IP address  (there is a link between i and j)
-            delay = str(matrix[i - 1][j - 1])
-            address_16_23 = (j - constellation_size) & 0xff
-            address_8_15 = i & 0xff
-            GSL_name = "GSL_" + str(i) + "-" + str(j)
-            # Create internal network in docker.
-            os.system('docker network create ' + GSL_name + " --subnet 9." +
-                      str(address_16_23) + "." + str(address_8_15) + ".0/24")
-            print('[Create GSL:]' + 'docker network create ' + GSL_name +
-                  " --subnet 9." + str(address_16_23) + "." +
-                  str(address_8_15) + ".0/24")
-            os.system('docker network connect ' + GSL_name + " " +
-                      str(container_id_list[i - 1]) + " --ip 9." +
-                      str(address_16_23) + "." + str(address_8_15) + ".50")
-            with os.popen(
-                    "docker exec -it " + str(container_id_list[i - 1]) +
-                    " ip addr | grep -B 2 9." + str(address_16_23) + "." +
-                    str(address_8_15) +
-                    ".50 | head -n 1 | awk -F: '{ print $2 }' | tr -d [:blank:]"
-            ) as f:
-                ifconfig_output = f.readline()
-                target_interface = str(ifconfig_output).split("@")[0]
-                os.system("docker exec -d " + str(container_id_list[i - 1]) +
-                          " ip link set dev " + target_interface + " down")
-                os.system("docker exec -d " + str(container_id_list[i - 1]) +
-                          " ip link set dev " + target_interface + " name " +
-                          "B" + str(i - 1 + 1) + "-eth" + str(j))
-                os.system("docker exec -d " + str(container_id_list[i - 1]) +
-                          " ip link set dev B" + str(i - 1 + 1) + "-eth" +
-                          str(j) + " up")
-                os.system("docker exec -d " + str(container_id_list[i - 1]) +
-                          " tc qdisc add dev B" + str(i - 1 + 1) + "-eth" +
-                          str(j) + " root netem delay " + str(delay) + "ms loss " + str(loss) + "% rate " + str(bw) + "Gbit")
-            print('[Add current node:]' + 'docker network connect ' +
-                  GSL_name + " " + str(container_id_list[i - 1]) + " --ip 9." +
-                  str(address_16_23) + "." + str(address_8_15) + ".50")
-
-            os.system('docker network connect ' + GSL_name + " " +
-                      str(container_id_list[j - 1]) + " --ip 9." +
-                      str(address_16_23) + "." + str(address_8_15) + ".60")
-            with os.popen(
-                    "docker exec -it " + str(container_id_list[j - 1]) +
-                    " ip addr | grep -B 2 9." + str(address_16_23) + "." +
-                    str(address_8_15) +
-                    ".60 | head -n 1 | awk -F: '{ print $2 }' | tr -d [:blank:]"
-            ) as f:
-                ifconfig_output = f.readline()
-                target_interface = str(ifconfig_output).split("@")[0]
-                os.system("docker exec -d " + str(container_id_list[j - 1]) +
-                          " ip link set dev " + target_interface + " down")
-                os.system("docker exec -d " + str(container_id_list[j - 1]) +
-                          " ip link set dev " + target_interface + " name " +
-                          "B" + str(j) + "-eth" + str(i - 1 + 1))
-                os.system("docker exec -d " + str(container_id_list[j - 1]) +
-                          " ip link set dev B" + str(j) + "-eth" +
-                          str(i - 1 + 1) + " up")
-                os.system("docker exec -d " + str(container_id_list[j - 1]) +
-                          " tc qdisc add dev B" + str(j) + "-eth" +
-                          str(i - 1 + 1) + " root netem delay " + str(delay) +
-                          "ms loss " + str(loss) + "% rate " + str(bw) +
-                          "Gbit")
-            print('[Add right node:]' + 'docker network connect ' + GSL_name +
-                  " " + str(container_id_list[j - 1]) + " --ip 9." +
-                  str(address_16_23) + "." + str(address_8_15) + ".60")
+    veths = []
+    for (low, high), link_delay in sorted(links.items()):
+        i = low + 1
+        j = high + 1
+        if i > constellation_size or j <= constellation_size:
+            continue  # not a GSL
+        # a delay in links means a link between node i and node j
+        if link_delay <= 0.01:
+            continue
+        if backend == "veth":
+            subnet = sn_GSL_subnet(i, j, constellation_size)
+            veths.append((i - 1, j - 1, subnet + ".50", subnet + ".60",
+                          link_delay, bw, loss))
+        else:
+            sn_GSL_establish(container_id_list, i, j, constellation_size,
+                             link_delay, bw, loss)
+    if veths:
+        sn_veth_establish(container_id_list, veths)
     for j in range(constellation_size + 1, constellation_size + GS_num + 1):
         GS_name = "GS_" + str(j)
         # Create default network and interface for GS.
@@ -393,7 +269,7 @@ def sn_copy_run_conf(container_idx, Path, current, total):
 
 
 def sn_copy_run_conf_to_each_container(container_id_list, sat_node_number,
-                                       fac_node_number, path):
+                                       fac_node_number, path, timeout):
     print(
         "Copy bird configuration file to each container and run routing process."
     )
@@ -411,8 +287,103 @@ def sn_copy_run_conf_to_each_container(container_id_list, sat_node_number,
     for copy_thread in copy_threads:
         copy_thread.join()
     print("Initializing routing...")
-    sleep(120)
-    print("Routing initialized!")
+    conf_path = path + "/conf/bird-" + str(sat_node_number) + "-" + str(
+        fac_node_number)
+    expected = sn_expected_neighbors(path + "/1.sndt", conf_path,
+                                     len(container_id_list), sat_node_number)
+    convergence_time = sn_wait_routing(container_id_list, expected, timeout)
+    if convergence_time is None:
+        print("Routing not converged after " + str(timeout) + " s.")
+    else:
+        print("Routing converged in %.1f s." % convergence_time)
+
+
+def sn_expected_neighbors(links_path, conf_path, node_num,
+                          constellation_size):
+    # OSPF neighbors of every node once converged: one per link of the
+    # first second (links_path, see sn_get_links) set up at initialization
+    # whose two interfaces are in the bird configurations of conf_path.
+    configured = set()
+    for node in range(1, node_num + 1):
+        conf = conf_path + "/B" + str(node) + ".conf"
+        if os.path.exists(conf):
+            with open(conf) as f:
+                for peer in re.findall(r'interface "B\d+-eth(\d+)"',
+                                       f.read()):
+                    configured.add((node, int(peer)))
+    expected = [0] * node_num
+    for (low, high), link_delay in sn_get_links(links_path).items():
+        i = low + 1
+        j = high + 1
+        if j > constellation_size and link_delay <= 0.01:
+            continue  # GSL not established, see sn_establish_GSL
+        if (i, j) in configured and (j, i) in configured:
+            expected[low] += 1
+            expected[high] += 1
+    return expected
+
+
+def sn_birdc(container_id, pid, command):
+    # Output of a birdc command in a container; birdc and its control
+    # socket are in the file system of the container.
+    if pid > 0:
+        prefix = ["nsenter", "-t", str(pid), "-m", "-n"]
+    else:
+        prefix = ["docker", "exec", str(container_id)]
+    result = subprocess.run(prefix + ["birdc"] + command.split(),
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+    return result.stdout.decode(errors='replace')
+
+
+def sn_ospf_state(container_id, pid):
+    # (full adjacencies, neighbors, routes) of the bird of a container
+    full = 0
+    neighbors = 0
+    for line in sn_birdc(container_id, pid,
+                         "show ospf neighbors").splitlines():
+        # Router ID, Pri, State (e.g. Full/DR), DTime, Interface, Router IP
+        fields = line.split()
+        if len(fields) >= 6 and "/" in fields[2]:
+            neighbors += 1
+            if fields[2].startswith("Full"):
+                full += 1
+    count = re.search(r"(\d+) of \d+ routes",
+                      sn_birdc(container_id, pid, "show route count"))
+    routes = int(count.group(1)) if count else -1
+    return full, neighbors, routes
+
+
+def sn_wait_routing(container_id_list, expected, timeout):
+    # Polls the OSPF state of all containers in parallel until every node
+    # has its expected neighbors, all with full adjacencies, and the route
+    # numbers of all nodes have not changed for SN_ROUTING_STABLE_POLLS
+    # polls. Returns the convergence time (s): when the routes last
+    # changed, counted from the call; None after timeout seconds.
+    start_time = time.time()
+    pids = sn_get_container_pids(container_id_list)
+    last_routes = None
+    stable = 0
+    converged_time = None
+    with ThreadPoolExecutor(max_workers=SN_NETNS_WORKERS) as pool:
+        while time.time() - start_time < timeout:
+            poll_time = time.time()
+            states = list(pool.map(sn_ospf_state, container_id_list, pids))
+            adjacent = sum(1 for (full, neighbors, routes), n in zip(
+                states, expected) if full == neighbors == n)
+            routes = [state[2] for state in states]
+            if adjacent == len(states) and routes == last_routes:
+                stable += 1
+            else:
+                stable = 0
+                converged_time = poll_time
+            last_routes = routes
+            print("Routing: " + str(adjacent) + "/" + str(len(states)) +
+                  " nodes adjacent, %.0f s." % (time.time() - start_time))
+            if stable >= SN_ROUTING_STABLE_POLLS:
+                return converged_time - start_time
+            sleep(max(0, SN_ROUTING_POLL - (time.time() - poll_time)))
+    return None
 
 
 def sn_damage_link(sat_index, container_id_list):
@@ -499,51 +470,277 @@ def sn_recover(damage_list, container_id_list, sat_loss):
         recover_thread.join()
 
 
-def sn_update_delay(matrix, container_id_list,
-                    constellation_size):  # updating delays
-    delay_threads = []
-    for row in range(len(matrix)):
-        for col in range(row, len(matrix[row])):
-            if float(matrix[row][col]) > 0:
-                if row < col:
-                    delay_thread = threading.Thread(
-                        target=sn_delay_change,
-                        args=(row, col, matrix[row][col], container_id_list,
-                              constellation_size))
-                    delay_threads.append(delay_thread)
-                else:
-                    delay_thread = threading.Thread(
-                        target=sn_delay_change,
-                        args=(col, row, matrix[col][row], container_id_list,
-                              constellation_size))
-                    delay_threads.append(delay_thread)
-    for delay_thread in delay_threads:
-        delay_thread.start()
-    for delay_thread in delay_threads:
-        delay_thread.join()
-    print("Delay updating done.\n")
-
-
-def sn_delay_change(link_x, link_y, delay, container_id_list,
-                    constellation_size):  # multi-thread updating delays
-    if link_y <= constellation_size:
-        os.system("docker exec -d " + str(container_id_list[link_x]) +
-                  " tc qdisc change dev B" + str(link_x + 1) + "-eth" +
-                  str(link_y + 1) + " root netem delay " + str(delay) + "ms")
-        os.system("docker exec -d " + str(container_id_list[link_y]) +
-                  " tc qdisc change dev B" + str(link_y + 1) + "-eth" +
-                  str(link_x + 1) + " root netem delay " + str(delay) + "ms")
+def sn_get_container_pids(container_id_list):
+    # Host pid of every container, to enter its network namespace; 0 if
+    # unknown. Cached, a container keeps its pid while it runs.
+    missing = [
+        container_id for container_id in container_id_list
+        if container_id not in SN_CONTAINER_PIDS
+    ]
+    if missing:
+        with os.popen("docker inspect -f '{{.State.Pid}}' " +
+                      " ".join(missing)) as f:
+            pids = f.read().split()
+        for container_id, pid in zip(missing, pids):
+            SN_CONTAINER_PIDS[container_id] = int(pid)
+    return [SN_CONTAINER_PIDS.get(container_id, 0)
+            for container_id in container_id_list]
+
+
+def sn_netns_batch(container_id, pid, tool, commands):
+    # Runs ip or tc (tool) commands with one process in the network
+    # namespace of a container: nsenter, or docker exec if the pid is
+    # unknown. On the host if container_id is None.
+    if container_id is None:
+        prefix = []
+    elif pid > 0:
+        prefix = ["nsenter", "-t", str(pid), "-n"]
     else:
-        os.system("docker exec -d " + str(container_id_list[link_x]) +
-                  " tc qdisc change dev B" + str(link_x + 1) + "-eth" +
-                  str(link_y + 1) + " root netem delay " + str(delay) + "ms")
-        os.system("docker exec -d " + str(container_id_list[link_y]) +
-                  " tc qdisc change dev B" + str(link_y + 1) + "-eth" +
-                  str(link_x + 1) + " root netem delay " + str(delay) + "ms")
+        prefix = ["docker", "exec", "-i", str(container_id)]
+    subprocess.run(prefix + [tool, "-force", "-batch", "-"],
+                   input="\n".join(commands).encode() + b"\n",
+                   stdout=subprocess.DEVNULL)
+
+
+def sn_update_delay(links, container_id_list,
+                    constellation_size):  # updating delays
+    # The netem delays of a container are changed by one tc -batch in its
+    # namespace, SN_NETNS_WORKERS containers at a time. Returns the wall
+    # time (s).
+    start_time = time.time()
+    commands = {}
+    for (row, col), delay in sorted(links.items()):
+        if delay > 0:
+            for node, peer in ((row, col), (col, row)):
+                commands.setdefault(node, []).append(
+                    "qdisc change dev B" + str(node + 1) + "-eth" +
+                    str(peer + 1) + " root netem delay " + str(delay) + "ms")
+    pids = sn_get_container_pids(container_id_list)
+    with ThreadPoolExecutor(max_workers=SN_NETNS_WORKERS) as pool:
+        futures = [
+            pool.submit(sn_netns_batch, container_id_list[node], pids[node],
+                        "tc", node_commands)
+            for node, node_commands in commands.items()
+        ]
+        for future in futures:
+            future.result()
+    wall_time = time.time() - start_time
+    print("Delay updating done: " + str(len(links)) + " links in " +
+          str(len(commands)) + " containers, %.3f s.\n" % wall_time)
+    return wall_time
+
+
+def sn_veth_configure(container_id, pid, ip_commands, tc_commands):
+    sn_netns_batch(container_id, pid, "ip", ip_commands)
+    sn_netns_batch(container_id, pid, "tc", tc_commands)
+
+
+def sn_veth_establish(container_id_list, veths):
+    # veths: (node, peer, node ip, peer ip, delay, bw, loss), 0-based nodes.
+    # Every link is a veth pair B<node>-eth<peer>, B<peer>-eth<node> created
+    # right in the two container namespaces, without a docker network: one
+    # ip -batch on the host for all pairs, then one ip -batch (addresses,
+    # up) and one tc -batch (netem) per container.
+    pids = sn_get_container_pids(container_id_list)
+    pairs = []
+    ip_commands = {}
+    tc_commands = {}
+    for node, peer, node_ip, peer_ip, delay, bw, loss in veths:
+        if pids[node] <= 0 or pids[peer] <= 0:
+            raise RuntimeError("no network namespace for link " +
+                               str(node + 1) + "-" + str(peer + 1))
+        pairs.append("link add B" + str(node + 1) + "-eth" + str(peer + 1) +
+                     " netns " + str(pids[node]) + " type veth peer name B" +
+                     str(peer + 1) + "-eth" + str(node + 1) + " netns " +
+                     str(pids[peer]))
+        for current, other, ip in ((node, peer, node_ip), (peer, node,
+                                                             peer_ip)):
+            interface = "B" + str(current + 1) + "-eth" + str(other + 1)
+            ip_commands.setdefault(current, []).extend([
+                "addr add " + ip + "/24 dev " + interface,
+                "link set dev " + interface + " up"
+            ])
+            tc_commands.setdefault(current, []).append(
+                "qdisc add dev " + interface + " root netem delay " +
+                str(delay) + "ms loss " + str(loss) + "% rate " + str(bw) +
+                "Gbit")
+    sn_netns_batch(None, 0, "ip", pairs)
+    with ThreadPoolExecutor(max_workers=SN_NETNS_WORKERS) as pool:
+        futures = [
+            pool.submit(sn_veth_configure, container_id_list[node],
+                        pids[node], ip_commands[node], tc_commands[node])
+            for node in ip_commands
+        ]
+        for future in futures:
+            future.result()
+
+
+def sn_veth_delete(container_id_list, i, j):
+    # Deleting one end of a veth pair (1-based nodes) deletes both.
+    pids = sn_get_container_pids(container_id_list)
+    sn_netns_batch(container_id_list[i - 1], pids[i - 1], "ip",
+                   ["link del B" + str(i) + "-eth" + str(j)])
+
+
+def sn_veth_up(container_id_list, i, j, delay):
+    # sn_ISL_up of a veth pair (1-based nodes), one ip -batch and one
+    # tc -batch in each namespace.
+    pids = sn_get_container_pids(container_id_list)
+    for node, peer in ((i, j), (j, i)):
+        interface = "B" + str(node) + "-eth" + str(peer)
+        sn_veth_configure(container_id_list[node - 1], pids[node - 1],
+                          ["link set dev " + interface + " up"], [
+                              "qdisc change dev " + interface +
+                              " root netem delay " + str(delay) + "ms"
+                          ])
+
+
+def sn_veth_down(container_id_list, i, j):
+    # sn_ISL_down of a veth pair: both ends are set down, the pair is kept.
+    pids = sn_get_container_pids(container_id_list)
+    for node, peer in ((i, j), (j, i)):
+        sn_netns_batch(container_id_list[node - 1], pids[node - 1], "ip",
+                       ["link set dev B" + str(node) + "-eth" + str(peer) +
+                        " down"])
+
+
+def sn_agent_sh(container_id_list, cmd):
+    # Output lines of a shell command, as sn_remote_cmd on the controller.
+    result = subprocess.run(cmd,
+                            shell=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    return result.stdout.decode(errors='replace').splitlines(True)
+
+
+def sn_agent_update(container_id_list, links, constellation_size):
+    # links: [src, dst, delay] of the links to change, 0-based src < dst
+    return sn_update_delay({(src, dst): delay
+                            for src, dst, delay in links}, container_id_list,
+                           constellation_size)
+
+
+def sn_agent_ISL_add(container_id_list, isl_idx, i, j, delay, bw, loss):
+    sn_ISL_establish(isl_idx, isl_idx, i - 1, j - 1, delay, container_id_list,
+                     bw, loss)
+
+
+def sn_agent_veth_GSL_add(container_id_list, i, j, constellation_size, delay,
+                          bw, loss):
+    subnet = sn_GSL_subnet(i, j, constellation_size)
+    sn_veth_establish(container_id_list, [(i - 1, j - 1, subnet + ".50",
+                                           subnet + ".60", delay, bw, loss)])
+
+
+def sn_agent_veth_ISL_add(container_id_list, isl_idx, i, j, delay, bw, loss):
+    subnet = sn_ISL_subnet(isl_idx)
+    sn_veth_establish(container_id_list, [(i - 1, j - 1, subnet + ".40",
+                                           subnet + ".10", delay, bw, loss)])
+
+
+def sn_agent_damage(container_id_list, random_list):
+    sn_damage(random_list, container_id_list)
+
+
+def sn_agent_recover(container_id_list, damage_list, sat_loss):
+    sn_recover(damage_list, container_id_list, sat_loss)
+
+
+# Operations of the agent: name -> function(container_id_list, *args).
+# Nodes are numbered from 1 as on the controller.
+SN_AGENT_OPS = {
+    'sh': sn_agent_sh,
+    'update': sn_agent_update,
+    'gsl_add': sn_GSL_establish,
+    'gsl_del': sn_GSL_delete,
+    'isl_add': sn_agent_ISL_add,
+    'isl_up': sn_ISL_up,
+    'isl_down': sn_ISL_down,
+    'isl_del': sn_ISL_delete,
+    'damage': sn_agent_damage,
+    'recover': sn_agent_recover,
+}
+# Operations of an agent on the veth link backend.
+SN_AGENT_VETH_OPS = dict(SN_AGENT_OPS,
+                         gsl_add=sn_agent_veth_GSL_add,
+                         gsl_del=sn_veth_delete,
+                         isl_add=sn_agent_veth_ISL_add,
+                         isl_up=sn_veth_up,
+                         isl_down=sn_veth_down,
+                         isl_del=sn_veth_delete)
+
+
+def sn_agent_run(container_id_list, ops, table):
+    # Runs the ops of one request in parallel threads, functions from table.
+    # Returns their results in order.
+    results = [None] * len(ops)
+    errors = []
+
+    def run(k, op):
+        try:
+            results[k] = table[op[0]](container_id_list, *op[1:])
+        except Exception as e:
+            errors.append(str(op[0]) + ": " + repr(e))
+
+    op_threads = []
+    for k, op in enumerate(ops):
+        op_thread = threading.Thread(target=run, args=(k, op))
+        op_threads.append(op_thread)
+    for op_thread in op_threads:
+        op_thread.start()
+    for op_thread in op_threads:
+        op_thread.join()
+    if errors:
+        raise RuntimeError("; ".join(errors))
+    return results
+
+
+def sn_agent(path, backend):
+    # Long-lived agent, started once per emulation by the controller (see
+    # sn_agent.py) on one SSH channel. Reads [id, [[op, args...], ...]] JSON
+    # lines on stdin, runs every request in its own thread and answers
+    # [id, results, error] JSON lines on stdout, until stdin is closed.
+    # backend: link backend of the emulation, "bridge" or "veth".
+    table = SN_AGENT_VETH_OPS if backend == "veth" else SN_AGENT_OPS
+    requests = os.fdopen(os.dup(0), 'r')
+    replies = os.fdopen(os.dup(1), 'w')
+    # docker exec -it needs a terminal on stdin, and the output of the
+    # commands must not mix with the replies: it goes to agent.log. The
+    # master side stays open until the process exits.
+    master, slave = pty.openpty()
+    os.dup2(slave, 0)
+    log = os.open(path + "/agent.log", os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                  0o644)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    sys.stdout.reconfigure(line_buffering=True)
+    container_id_list = sn_get_container_info()
+    lock = threading.Lock()
+
+    def serve(request_id, ops):
+        try:
+            reply = [
+                request_id,
+                sn_agent_run(container_id_list, ops, table), None
+            ]
+        except Exception as e:
+            reply = [request_id, None, str(e)]
+        with lock:
+            replies.write(json.dumps(reply) + "\n")
+            replies.flush()
+
+    print("Agent started with " + str(len(container_id_list)) +
+          " containers, " + backend + " links.")
+    for line in requests:
+        request_id, ops = json.loads(line)
+        threading.Thread(target=serve, args=(request_id, ops)).start()
+    print("Agent stopped.")
 
 
 if __name__ == '__main__':
-    if len(sys.argv) == 10:
+    if len(sys.argv) >= 3 and sys.argv[2] == "agent":
+        sn_agent(sys.argv[1], sys.argv[3] if len(sys.argv) > 3 else "bridge")
+    elif len(sys.argv) == 11:
         orbit_num = int(sys.argv[1])
         sat_num = int(sys.argv[2])
         constellation_size = int(sys.argv[3])
@@ -553,27 +750,28 @@ if __name__ == '__main__':
         sat_ground_bandwidth = float(sys.argv[7])
         sat_ground_loss = float(sys.argv[8])
         current_topo_path = sys.argv[9]
-        matrix = sn_get_param(current_topo_path)
+        backend = sys.argv[10]
+        links = sn_get_links(current_topo_path)
         container_id_list = sn_get_container_info()
-        sn_establish_ISLs(container_id_list, matrix, orbit_num, sat_num,
-                          constellation_size, sat_bandwidth, sat_loss)
-        sn_establish_GSL(container_id_list, matrix, GS_num, constellation_size,
-                         sat_ground_bandwidth, sat_ground_loss)
-    elif len(sys.argv) == 4:
-        if sys.argv[3] == "update":
-            current_delay_path = sys.argv[1]
-            constellation_size = int(sys.argv[2])
-            matrix = sn_get_param(current_delay_path)
-            container_id_list = sn_get_container_info()
-            sn_update_delay(matrix, container_id_list, constellation_size)
-        else:
-            constellation_size = int(sys.argv[1])
-            GS_num = int(sys.argv[2])
-            path = sys.argv[3]
-            container_id_list = sn_get_container_info()
-            sn_copy_run_conf_to_each_container(container_id_list,
-                                               constellation_size, GS_num,
-                                               path)
+        sn_establish_ISLs(container_id_list, links, constellation_size,
+                          sat_bandwidth, sat_loss, backend)
+        sn_establish_GSL(container_id_list, links, GS_num, constellation_size,
+                         sat_ground_bandwidth, sat_ground_loss, backend)
+    elif len(sys.argv) == 4 and sys.argv[3] == "update":
+        current_delay_path = sys.argv[1]
+        constellation_size = int(sys.argv[2])
+        links = sn_get_links(current_delay_path)
+        container_id_list = sn_get_container_info()
+        sn_update_delay(links, container_id_list, constellation_size)
+    elif len(sys.argv) == 5:
+        constellation_size = int(sys.argv[1])
+        GS_num = int(sys.argv[2])
+        path = sys.argv[3]
+        timeout = int(sys.argv[4])
+        container_id_list = sn_get_container_info()
+        sn_copy_run_conf_to_each_container(container_id_list,
+                                           constellation_size, GS_num, path,
+                                           timeout)
     elif len(sys.argv) == 2:
         path = sys.argv[1]
         random_list = numpy.loadtxt(path + "/damage_list.txt")
@@ -0,0 +1,179 @@
+import numpy as np
+from datetime import datetime
+from sgp4.api import Satrec, SatrecArray, WGS84, jday
+from skyfield.api import load
+from skyfield.sgp4lib import theta_GMST1982
+"""
+Batch SGP4 propagation of a whole constellation, used by the observer to get
+the position of every satellite at every second in one vectorized call.
+Positions stay ITRS (earth-fixed) xyz in km, in which link distances are
+computed; geodetic coordinates are only derived for position outputs.
+"""
+
+# Emulation clock: second 0 of a run is mapped to this UTC instant.
+SN_START_UTC = datetime(2022, 1, 1, 1, 0, 0)
+
+# Satrec.sgp4init arguments after the gravity model and mode, one column of
+# an element table each.
+SN_SATREC_FIELDS = [
+    'satnum', 'epoch', 'bstar', 'ndot', 'nddot', 'ecco', 'argpo', 'inclo',
+    'mo', 'no_kozai', 'nodeo'
+]
+
+WGS84_A = 6378.137  # km
+WGS84_E2 = (2 - 1 / 298.257223563) / 298.257223563
+SN_EARTH_ROTATION = 7.2921158553e-5  # rad/s, rate of the GMST angle
+
+
+def sn_walker_elements(inclination, satellite_altitude, orbit_number,
+                       sat_number, F=18):
+    # Element table (one row per satellite, SN_SATREC_FIELDS columns) of a
+    # Walker shell, ordered orbit by orbit.
+    since = datetime(1949, 12, 31, 0, 0, 0)
+    start = datetime(2020, 1, 1, 0, 0, 0)
+    epoch = (start - since).days
+    inclination = inclination * 2 * np.pi / 360
+    GM = 3.9860044e14
+    R = 6371393
+    altitude = satellite_altitude * 1000
+    mean_motion = np.sqrt(GM / (R + altitude)**3) * 60
+    num_of_sat = orbit_number * sat_number
+    elements = np.empty((num_of_sat, len(SN_SATREC_FIELDS)))
+    for i in range(orbit_number):
+        raan = i / orbit_number * 2 * np.pi
+        for j in range(sat_number):
+            mean_anomaly = (j * 360 / sat_number + i * 360 * F /
+                            num_of_sat) % 360 * 2 * np.pi / 360
+            elements[i * sat_number + j] = [
+                i * sat_number + j,  # satnum: Satellite number
+                epoch,  # epoch: days since 1949 December 31 00:00 UT
+                2.8098e-05,  # bstar: drag coefficient (/earth radii)
+                6.969196665e-13,  # ndot: ballistic coefficient (revs/day)
+                0.0,  # nddot: second derivative of mean motion (revs/day^3)
+                0.001,  # ecco: eccentricity
+                0.0,  # argpo: argument of perigee (radians)
+                inclination,  # inclo: inclination (radians)
+                mean_anomaly,  # mo: mean anomaly (radians)
+                mean_motion,  # no_kozai: mean motion (radians/minute)
+                raan,  # nodeo: right ascension of ascending node (radians)
+            ]
+    return elements
+
+
+def sn_satrecs(elements, gravity=WGS84):
+    # One Satrec per row of an element table. 'i' = improved mode.
+    satrecs = []
+    for row in elements:
+        satrec = Satrec()
+        satrec.sgp4init(gravity, 'i', int(row[0]), *[float(x) for x in row[1:]])
+        satrecs.append(satrec)
+    return satrecs
+
+
+def sn_walker_satrecs(inclination, satellite_altitude, orbit_number,
+                      sat_number, F=18):
+    # One Satrec per satellite of a Walker shell, ordered orbit by orbit.
+    return sn_satrecs(
+        sn_walker_elements(inclination, satellite_altitude, orbit_number,
+                           sat_number, F))
+
+
+def sn_time_grid(seconds, start=SN_START_UTC):
+    # Julian dates (UTC, for SGP4) and GMST angles (UT1, for the TEME->ITRS
+    # rotation) of the given emulation seconds, counted from start.
+    seconds = np.asarray(seconds, dtype=float)
+    jd, fr = jday(*start.timetuple()[:6])
+    ts = load.timescale()
+    t = ts.utc(*start.timetuple()[:5], start.second + seconds)
+    theta, _ = theta_GMST1982(t.whole, t.ut1_fraction)
+    return np.full(seconds.shape, jd), fr + seconds / 86400.0, theta
+
+
+def sn_propagate(satrecs, seconds, start=SN_START_UTC):
+    # Positions of all satellites at all seconds as a contiguous (T, N, 3)
+    # float64 array of ITRS (earth-fixed) xyz in km.
+    jd, fr, theta = sn_time_grid(seconds, start)
+    e, r, v = SatrecArray(satrecs).sgp4(jd, fr)  # r: (N, T, 3) TEME, km
+    return sn_teme_to_itrs(r.transpose(1, 0, 2), theta[:, None])
+
+
+def sn_propagate_states(satrecs, seconds, start=SN_START_UTC):
+    # ITRS positions (km) and velocities (km/s, relative to the rotating
+    # earth) of all satellites at all seconds, both (T, N, 3).
+    jd, fr, theta = sn_time_grid(seconds, start)
+    e, r, v = SatrecArray(satrecs).sgp4(jd, fr)
+    xyz = sn_teme_to_itrs(r.transpose(1, 0, 2), theta[:, None])
+    vel = sn_teme_to_itrs(v.transpose(1, 0, 2), theta[:, None])
+    # minus earth rotation x position
+    vel[..., 0] += SN_EARTH_ROTATION * xyz[..., 1]
+    vel[..., 1] -= SN_EARTH_ROTATION * xyz[..., 0]
+    return xyz, vel
+
+
+def sn_propagate_pairs(satrecs, sats, seconds, start=SN_START_UTC):
+    # (M, 3) ITRS xyz in km of satellite sats[m] at second seconds[m].
+    sats = np.asarray(sats, dtype=np.int64)
+    jd, fr, theta = sn_time_grid(seconds, start)
+    r = np.empty((len(sats), 3))
+    order = np.argsort(sats, kind='stable')
+    bounds = np.flatnonzero(np.diff(sats[order])) + 1
+    for group in np.split(order, bounds):
+        if len(group):
+            e, r[group], v = satrecs[sats[group[0]]].sgp4_array(
+                jd[group], fr[group])
+    return sn_teme_to_itrs(r, theta)
+
+
+def sn_teme_to_itrs(r, theta):
+    # Rotate TEME xyz (..., 3) by the GMST angle theta (broadcast to r[..., 0])
+    c = np.cos(theta)
+    s = np.sin(theta)
+    xyz = np.empty(r.shape)
+    xyz[..., 0] = c * r[..., 0] + s * r[..., 1]
+    xyz[..., 1] = c * r[..., 1] - s * r[..., 0]
+    xyz[..., 2] = r[..., 2]
+    return xyz
+
+
+def sn_itrs_to_lla(xyz):
+    # WGS84 geodetic latitude/longitude (degrees) and elevation (km) of ITRS
+    # xyz (km), same iteration as skyfield's wgs84.subpoint.
+    x = xyz[..., 0]
+    y = xyz[..., 1]
+    z = xyz[..., 2]
+    R = np.sqrt(x * x + y * y)
+    lat = np.arctan2(z, R)
+    for iteration in range(3):
+        sin_lat = np.sin(lat)
+        e2_sin_lat = WGS84_E2 * sin_lat
+        aC = WGS84_A / np.sqrt(1.0 - e2_sin_lat * sin_lat)
+        hyp = z + aC * e2_sin_lat
+        lat = np.arctan2(hyp, R)
+    lon = (np.arctan2(y, x) - np.pi) % (2 * np.pi) - np.pi
+    lla = np.empty(xyz.shape)
+    lla[..., 0] = np.degrees(lat)
+    lla[..., 1] = np.degrees(lon)
+    lla[..., 2] = np.sqrt(hyp * hyp + R * R) - aC
+    return lla
+
+
+def sn_lla_to_itrs(lla):
+    # ITRS xyz (km) of WGS84 geodetic latitude/longitude (degrees) and
+    # optional elevation (km), (..., 2 or 3) -> (..., 3).
+    lla = np.asarray(lla, dtype=float)
+    lat = np.radians(lla[..., 0])
+    lon = np.radians(lla[..., 1])
+    h = lla[..., 2] if lla.shape[-1] > 2 else 0.0
+    sin_lat = np.sin(lat)
+    N = WGS84_A / np.sqrt(1.0 - WGS84_E2 * sin_lat * sin_lat)
+    xyz = np.empty(lla.shape[:-1] + (3, ))
+    xyz[..., 0] = (N + h) * np.cos(lat) * np.cos(lon)
+    xyz[..., 1] = (N + h) * np.cos(lat) * np.sin(lon)
+    xyz[..., 2] = (N * (1 - WGS84_E2) + h) * sin_lat
+    return xyz
+
+
+def sn_itrs_latitude(xyz):
+    # Geocentric latitude (degrees) of ITRS xyz (..., 3).
+    return np.degrees(
+        np.arctan2(xyz[..., 2], np.hypot(xyz[..., 0], xyz[..., 1])))
@@ -0,0 +1,260 @@
+import os
+import numpy as np
+from multiprocessing import shared_memory
+
+from starrynet.sn_isl import *
+from starrynet.sn_propagator import *
+from starrynet.sn_shells import *
+from starrynet.sn_timeline import *
+from starrynet.sn_topology import *
+from starrynet.sn_visibility import *
+from starrynet.sn_writer import *
+"""
+Time-sharded observer pipeline. The emulated seconds are split into shards;
+each shard propagates its satellites, writes its position files and its own
+delay timeline, and streams its link changes to disk, so shards can run in a
+process pool. Within a shard, seconds are processed in fixed-size windows.
+Read-only inputs (element table, ISL endpoints, ground stations) are passed
+through shared memory. Every second is computed the same way whatever the
+sharding, so the result does not depend on the number of workers. Text and
+timeline outputs go through a background writer (see sn_writer).
+"""
+
+# A shard covers at least this many seconds when the worker number is chosen
+# automatically, so that short runs are not slowed down by process startup.
+SN_SHARD_MIN_SECONDS = 60
+# Satellite x second cells held in memory at once: a shard is processed in
+# windows of SN_WINDOW_CELLS // satellites seconds, so peak memory does not
+# grow with the duration of the run.
+SN_WINDOW_CELLS = 1 << 20
+
+# The ISL delays are periodic (see sn_isl_cycle) if their largest difference
+# from one cycle to the next, accumulated over the run, stays within this
+# (ms): one 0.01 ms rounding step and a little drift.
+SN_CYCLE_TOLERANCE = 0.02
+# Seconds around the configured cycle searched for the ISL period, and ISL
+# frames compared for each candidate.
+SN_CYCLE_SEARCH = 30
+SN_CYCLE_SAMPLES = 16
+
+
+def sn_time_shards(duration, workers):
+    # [first, last) second ranges of at most `workers` nonempty shards.
+    workers = max(1, min(workers, duration))
+    bounds = [duration * k // workers for k in range(workers + 1)]
+    return [(bounds[k], bounds[k + 1]) for k in range(workers)
+            if bounds[k] < bounds[k + 1]]
+
+
+def sn_auto_workers(duration):
+    return max(1, min(os.cpu_count() or 1,
+                      duration // SN_SHARD_MIN_SECONDS))
+
+
+def sn_isl_delays(satrecs, start, isl_src, isl_dst, seconds):
+    # (T, L) delays (ms) of the ISLs at seconds
+    sat_xyz = sn_propagate(satrecs, seconds, start)
+    return sn_link_delay(sat_xyz[:, isl_src], sat_xyz[:, isl_dst])
+
+
+def sn_isl_cycle(satrecs, start, isl_src, isl_dst, cycle, duration):
+    # Period (s) of the ISL delays near the configured cycle, 0 if the run
+    # is not longer than one cycle or the delays do not repeat within
+    # SN_CYCLE_TOLERANCE. Satellites of one Walker shell share their J2
+    # drift, so their ISL delays repeat with the nodal period, which differs
+    # by a few seconds from the Keplerian one.
+    if cycle <= SN_CYCLE_SEARCH or len(isl_src) == 0 or \
+            duration <= cycle + SN_CYCLE_SEARCH:
+        return 0
+    samples = np.linspace(0, cycle, SN_CYCLE_SAMPLES,
+                          endpoint=False).astype(np.int64)
+    base = sn_isl_delays(satrecs, start, isl_src, isl_dst, samples)
+    candidates = np.arange(cycle - SN_CYCLE_SEARCH, cycle + SN_CYCLE_SEARCH + 1)
+    delays = sn_isl_delays(satrecs, start, isl_src, isl_dst,
+                           (samples[None, :] + candidates[:, None]).ravel())
+    errors = np.abs(
+        delays.reshape(len(candidates), len(samples), -1) - base).max(
+            axis=(1, 2))
+    best = int(candidates[np.argmin(errors)])
+    # the error grows with the number of cycles: check the last one
+    last = (duration - 1) // best * best
+    delays = sn_isl_delays(satrecs, start, isl_src, isl_dst, samples + last)
+    error = np.abs(np.round(delays, 2) - np.round(base, 2)).max()
+    if error > SN_CYCLE_TOLERANCE:
+        print("ISL delays not periodic: %.2f ms apart after %d s" %
+              (error, last))
+        return 0
+    return best
+
+
+def sn_share_array(array):
+    # Copy array into a new shared memory block. Returns the block (to be
+    # closed and unlinked by the owner) and a picklable descriptor.
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def sn_attach_array(descriptor):
+    # Read-only view of a block made by sn_share_array. The view must be
+    # released before the returned block is closed.
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array.flags.writeable = False
+    return shm, array
+
+
+def sn_observe_shard(task):
+    # Positions, delay timeline and link changes of the seconds
+    # [first, last). task is a dict of plain values and shared array
+    # descriptors (see Observer.calculate_delay). Link changes are written
+    # to the task['changes'] stream (see sn_write_change). Returns the
+    # AsyncWriter.stats() of the shard output.
+    blocks = {}
+    try:
+        shared = {}
+        for name, descriptor in task['shared'].items():
+            blocks[name], shared[name] = sn_attach_array(descriptor)
+        stats = sn_observe_seconds(task, **shared)
+        shared.clear()
+        return stats
+    finally:
+        for shm in blocks.values():
+            shm.close()
+
+
+def sn_window_seconds(sat_num):
+    return max(1, SN_WINDOW_CELLS // max(1, sat_num))
+
+
+def sn_observe_seconds(task, elements, isl_src, isl_dst, isl_inter, fac_cbf,
+                       fac_lat, bound_dis):
+    first = task['first']
+    last = task['last']
+    cycle = task['cycle']
+    sat_num = len(elements)
+    node_num = sat_num + len(fac_lat)
+    satrecs = sn_satrecs(elements, task['gravity'])
+    window = sn_window_seconds(sat_num)
+    positions = np.load(sn_position_path(task['path']), mmap_mode='r+')
+    states = np.load(sn_state_path(task['path']), mmap_mode='r+')
+    writer = DelayTimelineWriter(task['timeline'], node_num, cycle)
+    # a periodic timeline stores the ISLs of the first cycle only, the
+    # later seconds read them back
+    isl_writer = None
+    periodic = None
+    if cycle and first < cycle:
+        isl_writer = DelayTimelineWriter(sn_periodic_path(task['timeline']),
+                                         node_num)
+    elif cycle:
+        periodic = DelayTimeline(task['periodic'])
+    with open(task['changes'], 'wb') as changes, AsyncWriter() as output:
+        # one second before the shard, to diff its first frame against
+        pre_keys = None
+        if first > 0:
+            for t, isl, gsl in sn_observe_window(task, satrecs, first - 1,
+                                                 first, isl_src, isl_dst,
+                                                 isl_inter, fac_cbf, fac_lat,
+                                                 bound_dis, positions, states,
+                                                 output, periodic):
+                pre_keys = sn_edge_keys(sn_merge_edges(isl, gsl), node_num)
+        for w_first in range(first, last, window):
+            w_last = min(last, w_first + window)
+            for t, isl, gsl in sn_observe_window(task, satrecs, w_first,
+                                                 w_last, isl_src, isl_dst,
+                                                 isl_inter, fac_cbf, fac_lat,
+                                                 bound_dis, positions, states,
+                                                 output, periodic):
+                edges = sn_merge_edges(isl, gsl)
+                if cycle:
+                    output.submit(writer.append_edges, gsl)
+                    if t < cycle:
+                        output.submit(isl_writer.append_edges, isl)
+                else:
+                    output.submit(writer.append_edges, edges)
+                keys = sn_edge_keys(edges, node_num)
+                # time index t + 1; changes only reported up to last_change
+                if pre_keys is not None and t + 1 <= task['last_change'] and \
+                        not np.array_equal(pre_keys, keys):
+                    added, removed = sn_diff_keys(pre_keys, keys)
+                    output.submit(sn_write_change, changes, t + 1, added,
+                                  removed)
+                pre_keys = keys
+    writer.close()
+    if isl_writer is not None:
+        isl_writer.close()
+    del periodic
+    positions.flush()
+    states.flush()
+    return output.stats()
+
+
+def sn_write_itrs_positions(file_, xyz):
+    # Position text file (latitude, longitude, elevation) of ITRS xyz,
+    # converted on the writer thread.
+    sn_write_positions(file_, sn_itrs_to_lla(xyz))
+
+
+def sn_observe_window(task, satrecs, first, last, isl_src, isl_dst, isl_inter,
+                      fac_cbf, fac_lat, bound_dis, positions, states, output,
+                      periodic=None):
+    # Yields (second, ISL edges, GSL and inter-shell link edges) for the
+    # seconds [first, last), writing their positions through output. Memory
+    # is bounded by the window length. The ISLs of the seconds after the
+    # first cycle come from periodic. ISLs failing the constraints of
+    # task['isl_constraints'] are left out (see sn_isl).
+    sat_num = len(satrecs)
+    node_num = sat_num + len(fac_lat)
+    cycle = task['cycle']
+    offsets, links = task['inter_shell']
+    constraints = task['isl_constraints']
+    dynamic = sn_isl_dynamic(constraints)
+    seconds = np.arange(first, last)
+    # first dimension: time. second dimension: node. third dimension: ITRS
+    # xyz (km); geodetic coordinates are only derived by the writer
+    sat_cbf, sat_vel = sn_propagate_states(satrecs, seconds, task['start'])
+    if first >= task['first']:
+        positions[first:last] = sat_cbf
+        states[first:last, :, :3] = sat_cbf
+        states[first:last, :, 3:] = sat_vel
+        for i, t in enumerate(seconds):
+            output.submit(sn_write_itrs_positions,
+                          task['path'] + '/position/%d.txt' % t, sat_cbf[i])
+
+    if task['gsl']:
+        # GSLs chosen by the handover policy (see sn_handover)
+        gsl_sat = np.asarray(
+            np.load(task['gsl'], mmap_mode='r')[first:last], dtype=np.int64)
+        d = sat_cbf[np.arange(len(seconds))[:, None, None],
+                    np.maximum(gsl_sat, 0)] - fac_cbf[None, :, None, :]
+        gsl_dis = np.where(gsl_sat >= 0, np.sqrt(np.sum(d * d, axis=-1)),
+                           np.inf)
+    else:
+        # GSLs: the antenna_num closest satellites in the latitude band
+        gsl_sat, gsl_dis = sn_gsl_access(sat_cbf, sn_itrs_latitude(sat_cbf),
+                                         fac_cbf, fac_lat, bound_dis,
+                                         task['alpha'], task['antenna_num'])
+    gsl_delay = gsl_dis / SN_LINK_SPEED * 1000  # ms
+    gsl_fac = np.broadcast_to(
+        np.arange(sat_num, node_num)[:, None], gsl_sat.shape[1:])
+    for i, t in enumerate(seconds):
+        valid = gsl_sat[i] >= 0
+        if cycle and t >= cycle:
+            isl = periodic.edges(t % cycle + 1)
+        else:
+            cbf = sat_cbf[i]
+            delay = sn_link_delay(cbf[isl_src], cbf[isl_dst])
+            if dynamic:
+                # a 0 delay drops the link
+                delay[~sn_isl_feasible(cbf, sat_vel[i], isl_src, isl_dst,
+                                       isl_inter, constraints)] = 0
+            isl = sn_make_edges(isl_src, isl_dst, delay)
+        gsl = sn_make_edges(gsl_sat[i][valid], gsl_fac[valid],
+                            gsl_delay[i][valid])
+        if links:
+            src, dst, dis = sn_inter_shell_links(sat_cbf[i], offsets, links)
+            gsl = sn_merge_edges(
+                sn_make_edges(src, dst, dis / SN_LINK_SPEED * 1000), gsl)
+        yield int(t), isl, gsl
@@ -0,0 +1,124 @@
+import numpy as np
+
+from starrynet.sn_propagator import *
+from starrynet.sn_visibility import *
+"""
+Constellations made of several Walker shells (e.g. the Starlink shells, or a
+LEO shell and a GEO relay layer). The element tables of all shells are
+concatenated, so the whole constellation is propagated in one batched call;
+node indexes run shell after shell. Each shell has its own +grid ISLs.
+Inter-shell links are chosen every second: each satellite of the lower
+shell of a pair links to the closest satellite of the upper shell in line
+of sight and in range, found through a PointGrid, so the cost grows with
+the number of satellites, not with the product of the shell sizes.
+"""
+
+# Phase shift of the single shell described by the top-level fields of
+# config.json.
+SN_DEFAULT_PHASE_SHIFT = 18
+
+
+def sn_shell(table):
+    # Shell parameters from a "Shells" entry of config.json.
+    return {
+        'altitude': float(table["Altitude (km)"]),
+        'inclination': float(table["Inclination"]),
+        'orbit': int(table["# of orbit"]),
+        'sat': int(table["# of satellites"]),
+        'phase_shift': int(table.get("Phase shift",
+                                     SN_DEFAULT_PHASE_SHIFT)),
+    }
+
+
+def sn_inter_shell_link(table, shell_num):
+    # (lower shell, upper shell, range in km) from an "Inter-shell links"
+    # entry of config.json, shells numbered from 0.
+    lower = int(table["from shell"]) - 1
+    upper = int(table["to shell"]) - 1
+    if not (0 <= lower < shell_num and 0 <= upper < shell_num) or \
+            lower == upper:
+        raise ValueError('bad inter-shell link %d-%d for %d shells' %
+                         (lower + 1, upper + 1, shell_num))
+    return (lower, upper, float(table["range (km)"]))
+
+
+def sn_shell_offsets(shells):
+    # First node (0-based) of every shell, and the satellite number last.
+    sizes = [shell['orbit'] * shell['sat'] for shell in shells]
+    return np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+
+
+def sn_shell_elements(shells):
+    # Element table of all shells, shell after shell, numbered
+    # continuously, and the altitude (km) of every satellite.
+    offsets = sn_shell_offsets(shells)
+    elements = []
+    for shell, offset in zip(shells, offsets):
+        table = sn_walker_elements(shell['inclination'], shell['altitude'],
+                                   shell['orbit'], shell['sat'],
+                                   shell['phase_shift'])
+        table[:, 0] += offset
+        elements.append(table)
+    altitude = np.repeat([shell['altitude'] for shell in shells],
+                         np.diff(offsets))
+    return np.concatenate(elements), altitude
+
+
+def sn_shell_planes(shells):
+    # Orbital plane id of every satellite, planes numbered across shells.
+    sizes = np.repeat([shell['sat'] for shell in shells],
+                      [shell['orbit'] for shell in shells])
+    return np.repeat(np.arange(len(sizes)), sizes)
+
+
+def sn_grid_isls(num_orbits, num_sats_per_orbit):
+    # +grid, down (intra-orbit) and right (inter-orbit) neighbors
+    num_sat1 = np.arange(num_orbits * num_sats_per_orbit)
+    orbit = num_sat1 // num_sats_per_orbit
+    num_sat2 = orbit * num_sats_per_orbit + (num_sat1 +
+                                             1) % num_sats_per_orbit
+    num_sat3 = (orbit + 1) % num_orbits * num_sats_per_orbit + (
+        num_sat1 % num_sats_per_orbit)
+    return np.concatenate((num_sat1, num_sat1)), np.concatenate(
+        (num_sat2, num_sat3))
+
+
+def sn_shell_isls(shells):
+    # +grid ISLs of every shell, as (src, dst) node index arrays.
+    offsets = sn_shell_offsets(shells)
+    src = []
+    dst = []
+    for shell, offset in zip(shells, offsets):
+        s, d = sn_grid_isls(shell['orbit'], shell['sat'])
+        src.append(s + offset)
+        dst.append(d + offset)
+    return np.concatenate(src), np.concatenate(dst)
+
+
+def sn_inter_shell_links(sat_cbf, offsets, links):
+    # sat_cbf: (N, 3) satellite xyz of one second, offsets: see
+    # sn_shell_offsets, links: (lower, upper, range) tuples.
+    # Returns (src, dst, distance in km) of the inter-shell links.
+    src = []
+    dst = []
+    dis = []
+    for lower, upper, bound in links:
+        first, last = offsets[upper], offsets[upper + 1]
+        queries = sat_cbf[offsets[lower]:offsets[lower + 1]]
+        grid = PointGrid(sat_cbf[first:last], bound)
+        sat, query = grid.candidates(queries)
+        d = grid.points[sat] - queries[query]
+        distance = np.sqrt(np.sum(d * d, axis=-1))
+        keep = (distance < bound) & sn_line_of_sight(grid.points[sat],
+                                                     queries[query])
+        sat, query, distance = sat[keep], query[keep], distance[keep]
+        # closest one for every satellite of the lower shell
+        order = np.lexsort((sat, distance, query))
+        query, first_of = np.unique(query[order], return_index=True)
+        src.append(query + offsets[lower])
+        dst.append(sat[order][first_of] + first)
+        dis.append(distance[order][first_of])
+    if not src:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0))
+    return np.concatenate(src), np.concatenate(dst), np.concatenate(dis)
@@ -29,6 +29,11 @@ class StarryNet():
         self.IP_version = sn_args.IP_version
         self.link_policy = sn_args.link_policy
         self.update_interval = sn_args.update_interval
+        self.delay_threshold = sn_args.delay_threshold
+        self.link_backend = sn_args.link_backend
+        self.routing_timeout = sn_args.routing_timeout
+        # OSPF convergence time (s) of run_routing_deamon
+        self.routing_convergence_time = None
         self.duration = sn_args.duration
         self.inter_routing = sn_args.inter_routing
         self.intra_routing = sn_args.intra_routing
@@ -52,13 +57,44 @@ class StarryNet():
                 sn_args.satellite_altitude) + '-' + str(
                     sn_args.inclination
                 ) + '-' + sn_args.link_style + '-' + sn_args.link_policy
+        shells = [sn_shell(shell) for shell in sn_args.shells]
+        inter_shell_links = [
+            sn_inter_shell_link(link, len(shells))
+            for link in sn_args.inter_shell_links
+        ]
+        if shells:
+            # one directory per shell list: name, then orbits-satellites-
+            # altitude-inclination of every shell
+            self.file_path = './' + sn_args.cons_name + '-' + '-'.join(
+                '%d-%d-%g-%g' % (shell['orbit'], shell['sat'],
+                                 shell['altitude'], shell['inclination'])
+                for shell in shells
+            ) + '-' + sn_args.link_style + '-' + sn_args.link_policy
+        tle_file = ''
+        if sn_args.tle_file:
+            # satellites come from the catalog instead of the Walker shell
+            tle_file = os.path.join(self.configuration_file_path,
+                                    sn_args.tle_file)
+            self.file_path = './' + os.path.splitext(
+                os.path.basename(tle_file))[0] + '-tle-' + \
+                sn_args.link_style + '-' + sn_args.link_policy
         self.observer = Observer(self.file_path, self.configuration_file_path,
                                  self.inclination, self.satellite_altitude,
                                  self.orbit_number, self.sat_number,
                                  self.duration, self.antenna_number,
                                  GS_lat_long, self.antenna_inclination,
                                  self.intra_routing, self.hello_interval,
-                                 self.AS)
+                                 self.AS,
+                                 DelayCache(sn_args.cache_dir,
+                                            sn_args.cache_size * 1024 * 1024),
+                                 tle_file, sn_args.observer_workers,
+                                 sn_args.handover_policy, self.cycle, shells,
+                                 inter_shell_links,
+                                 sn_isl_constraints(sn_args.isl_constraints),
+                                 bool(sn_args.compare_handover_policies),
+                                 bool(sn_args.visibility_windows))
+        self.constellation_size = self.observer.constellation_size
+        self.node_size = self.constellation_size + sn_args.fac_num
         self.docker_service_name = 'constellation-test'
         self.isl_idx = 0
         self.ISL_hub = 'ISL_hub'
@@ -104,6 +140,8 @@ class StarryNet():
         sn_thread.join()
         # Initiate a necessary delay and position data for emulation
         self.observer.calculate_delay()
+        self.topology = TopologyTimeline(self.configuration_file_path + "/" +
+                                         self.file_path)
         # Generate configuration file for routing
         self.observer.generate_conf(self.remote_ssh, self.remote_ftp)
 
@@ -125,7 +163,8 @@ class StarryNet():
             self.remote_ssh, self.remote_ftp, self.orbit_number,
             self.sat_number, self.constellation_size, self.fac_num,
             self.file_path, self.configuration_file_path, self.sat_bandwidth,
-            self.sat_ground_bandwidth, self.sat_loss, self.sat_ground_loss)
+            self.sat_ground_bandwidth, self.sat_loss, self.sat_ground_loss,
+            self.link_backend)
         isl_thread.start()
         isl_thread.join()
         print("Link initialization done.")
@@ -135,49 +174,104 @@ class StarryNet():
             self.remote_ssh, self.remote_ftp, self.orbit_number,
             self.sat_number, self.constellation_size, self.fac_num,
             self.file_path, self.sat_bandwidth, self.sat_ground_bandwidth,
-            self.sat_loss, self.sat_ground_loss)
+            self.sat_loss, self.sat_ground_loss, self.routing_timeout)
         routing_thread.start()
         routing_thread.join()
+        self.routing_convergence_time = routing_thread.convergence_time
+        with open(
+                self.configuration_file_path + "/" + self.file_path +
+                "/routing_convergence.json", 'w') as f:
+            json.dump(
+                {
+                    'convergence time (s)': self.routing_convergence_time,
+                    'timeout (s)': self.routing_timeout
+                }, f)
         print("Bird routing in all containers are running.")
 
     def get_distance(self, sat1_index, sat2_index, time_index):
-        delaypath = self.configuration_file_path + "/" + self.file_path + '/delay/' + str(
-            time_index) + '.txt'
-        adjacency_matrix = sn_get_param(delaypath)
-        delay = float(adjacency_matrix[sat1_index - 1][sat2_index - 1])
+        if time_index != int(time_index):
+            # between two seconds: interpolated positions
+            return float(
+                self.topology.distances_at(sat1_index, sat2_index,
+                                           time_index))
+        delay = self.topology.delay(sat1_index, sat2_index, int(time_index))
         dis = delay * (17.31 / 29.5 * 299792.458) / 1000  # km
         return dis
 
     def get_neighbors(self, sat_index, time_index):
-        neighbors = []
-        delaypath = self.configuration_file_path + "/" + self.file_path + '/delay/' + str(
-            time_index) + '.txt'
-        adjacency_matrix = sn_get_param(delaypath)
-        sats = self.orbit_number * self.sat_number
-        for i in range(sats):
-            if (float(adjacency_matrix[i][sat_index - 1]) > 0.01):
-                neighbors.append(i + 1)
-        return neighbors
+        nodes, delays = self.topology.neighbors(sat_index, time_index)
+        sats = self.constellation_size
+        return nodes[(nodes <= sats) & (delays > 0.01)].tolist()
 
     def get_GSes(self, sat_index, time_index):
-        GSes = []
-        delaypath = self.configuration_file_path + "/" + self.file_path + '/delay/' + str(
-            time_index) + '.txt'
-        adjacency_matrix = sn_get_param(delaypath)
-        sats = self.orbit_number * self.sat_number
-        for i in range(sats, len(adjacency_matrix)):
-            if (float(adjacency_matrix[i][sat_index - 1]) > 0.01):
-                GSes.append(i + 1)
-        return GSes
+        nodes, delays = self.topology.neighbors(sat_index, time_index)
+        sats = self.constellation_size
+        return nodes[(nodes > sats) & (delays > 0.01)].tolist()
+
+    # Batched variants: index arguments are arrays (or scalars) broadcast
+    # together, results are NumPy arrays.
+
+    def get_distances(self, sat1_indexes, sat2_indexes, time_indexes):
+        delays = self.topology.delays(sat1_indexes, sat2_indexes, time_indexes)
+        return delays * (17.31 / 29.5 * 299792.458) / 1000  # km
+
+    def get_neighbors_batch(self, sat_indexes, time_indexes):
+        # (satellite, time, neighbor satellite) index arrays
+        sats, times, nodes, delays = self.topology.neighbor_arrays(
+            sat_indexes, time_indexes)
+        keep = (nodes <= self.constellation_size) & (delays > 0.01)
+        return sats[keep], times[keep], nodes[keep]
+
+    def get_GSes_batch(self, sat_indexes, time_indexes):
+        # (satellite, time, GS) index arrays
+        sats, times, nodes, delays = self.topology.neighbor_arrays(
+            sat_indexes, time_indexes)
+        keep = (nodes > self.constellation_size) & (delays > 0.01)
+        return sats[keep], times[keep], nodes[keep]
+
+    def get_delays_at(self, sat1_indexes, sat2_indexes, times):
+        # delays (ms) at float times, 0 where not linked
+        return self.topology.delays_at(sat1_indexes, sat2_indexes, times)
+
+    def get_delay_frames(self, first_time, last_time, step):
+        # (time, links) every step seconds, links with fields src, dst
+        # (0-based) and delay (ms)
+        return self.topology.delay_frames(first_time, last_time, step)
+
+    def get_positions(self, sat_indexes, time_indexes):
+        # (..., 3) latitude, longitude (degrees), altitude (km)
+        return self.topology.positions_of(sat_indexes, time_indexes)
+
+    def get_visibility_windows(self):
+        # (gs, sat, rise, set) records, times in ms, sorted by rise; needs
+        # "GSL visibility windows"
+        return np.load(sn_windows_path(self.configuration_file_path + "/" +
+                                       self.file_path))
+
+    def get_handovers(self):
+        # (time, gs, sat, connect) GSL events, time in ms, sorted by time;
+        # needs "GSL visibility windows"
+        return np.load(sn_handovers_path(self.configuration_file_path + "/" +
+                                         self.file_path))
+
+    def get_handover_counts(self):
+        # {policy: number of handovers} over the emulated duration: every
+        # policy with "Compare handover policies", else the selected one
+        # unless it is the nearest ({} then)
+        count_path = sn_handover_count_path(self.configuration_file_path +
+                                            "/" + self.file_path)
+        if not os.path.exists(count_path):
+            return {}
+        with open(count_path) as f:
+            return json.load(f)
 
     def get_utility(self, time_index):
         self.utility_checking_time.append(time_index)
 
     def get_position(self, sat_index, time_index):
-        path = self.configuration_file_path + "/" + self.file_path + '/position/' + '/%d.txt' % time_index
-        f = open(path)
-        ADJ = f.readlines()
-        return ADJ[sat_index - 1]
+        # same line as in position/<time_index>.txt
+        return '%f,%f,%f\n' % tuple(
+            self.topology.position(sat_index, time_index))
 
     def get_IP(self, sat_index):
         IP_info = sn_remote_cmd(
@@ -228,7 +322,9 @@ class StarryNet():
             self.sr_time, self.damage_ratio, self.damage_time,
             self.damage_list, self.recovery_time, self.route_src,
             self.route_time, self.duration, self.utility_checking_time,
-            self.perf_src, self.perf_des, self.perf_time)
+            self.perf_src, self.perf_des, self.perf_time, self.sat_bandwidth,
+            self.delay_threshold, self.link_backend,
+            self.observer.isl_pairs())
         sn_thread.start()
         sn_thread.join()
 
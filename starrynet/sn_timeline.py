@@ -0,0 +1,372 @@
+import os
+import struct
+import numpy as np
+"""
+On-disk delay timeline. Each emulated second is a sparse edge list (src, dst,
+delay in ms, src < dst, 0-based node indexes), so the file grows with the
+number of links rather than node_num^2. Consecutive seconds share most links
+and their delays drift by a few 0.01 ms steps, so frames are delta coded:
+every SN_KEYFRAME_INTERVAL frames (and whenever it is smaller) a keyframe
+stores the edges as they are; the other frames store the links removed from
+and added to the previous frame, and the change of every other delay in
+0.01 ms units as 0, 1, 2 or 4 byte integers. Delays are rounded to 0.01 ms
+(see sn_make_edges), so the coding is lossless. Layout: a fixed-size header,
+the frame data, then an index entry per frame (data offset, keyframe, sizes),
+so decoding second t reads its keyframe and at most SN_KEYFRAME_INTERVAL - 1
+deltas; reading seconds in order applies one delta each.
+
+A periodic timeline (cycle > 0 in the header) holds only the GSLs of every
+second; the ISLs of second t are frame t % cycle + 1 of a companion timeline
+(see sn_periodic_path), stored once per constellation cycle.
+"""
+
+SN_TIMELINE_MAGIC = b'SNDT'
+SN_TIMELINE_VERSION = 4
+SN_TIMELINE_HEADER = 64  # bytes
+# magic, version, node number, frame number, data size (bytes), index
+# offset, cycle (0 if not periodic)
+SN_TIMELINE_STRUCT = '<4sIIIQQI'
+SN_EDGE_DTYPE = np.dtype([('src', '<u4'), ('dst', '<u4'), ('delay', '<f4')])
+# data offset, first frame (0-based) of the run of deltas decoded from the
+# same keyframe (the frame itself for a keyframe), number of links, links
+# removed from and added to the previous frame, bytes per delay change
+SN_FRAME_DTYPE = np.dtype([('offset', '<u8'), ('key', '<u4'),
+                           ('links', '<u4'), ('removed', '<u4'),
+                           ('added', '<u4'), ('width', 'u1')])
+SN_KEYFRAME_INTERVAL = 64
+SN_DELTA_DTYPES = {0: None, 1: '<i1', 2: '<i2', 4: '<i4'}
+
+
+def sn_timeline_path(path):
+    # Timeline of the run whose working directory is path.
+    return path + '/delay/delay.sndt'
+
+
+def sn_periodic_path(file_):
+    # Per-cycle ISL frames of the periodic timeline file_.
+    return os.path.splitext(file_)[0] + '.isl.sndt'
+
+
+def sn_make_edges(src, dst, delay):
+    # Normalize one frame of links: delays rounded to 0.01 ms, links whose
+    # delay rounds to 0 dropped, src < dst, sorted and deduplicated.
+    src = np.asarray(src, dtype=np.int64).ravel()
+    dst = np.asarray(dst, dtype=np.int64).ravel()
+    delay = np.round(np.asarray(delay, dtype=float).ravel(), 2)
+    keep = (delay > 0) & (src != dst)
+    src, dst, delay = src[keep], dst[keep], delay[keep]
+    low = np.minimum(src, dst)
+    high = np.maximum(src, dst)
+    order = np.lexsort((high, low))
+    low, high, delay = low[order], high[order], delay[order]
+    unique = np.ones(len(low), dtype=bool)
+    unique[1:] = (low[1:] != low[:-1]) | (high[1:] != high[:-1])
+    edges = np.empty(int(unique.sum()), dtype=SN_EDGE_DTYPE)
+    edges['src'] = low[unique]
+    edges['dst'] = high[unique]
+    edges['delay'] = delay[unique]
+    return edges
+
+
+def sn_merge_edges(edges1, edges2):
+    # Union of two normalized edge lists with no link in common.
+    edges = np.concatenate((edges1, edges2))
+    order = np.lexsort((edges['dst'], edges['src']))
+    return edges[order]
+
+
+def sn_quantize(delay):
+    # delays (ms) as integer 0.01 ms steps
+    return np.rint(np.asarray(delay, dtype=float) * 100).astype(np.int64)
+
+
+def sn_delta_width(delta):
+    # Bytes per delay change: 0 if they are all 0.
+    if len(delta) == 0 or not delta.any():
+        return 0
+    top = max(-int(delta.min()), int(delta.max()))
+    return 1 if top < 1 << 7 else 2 if top < 1 << 15 else 4
+
+
+class DelayTimelineWriter():
+
+    def __init__(self, file_, node_num, cycle=0):
+        self.file_ = file_
+        self.node_num = node_num
+        self.cycle = cycle
+        self.index = []
+        self.size = 0
+        # links of the previous frame: keys and 0.01 ms delays
+        self.pre_keys = None
+        self.pre_delay = None
+        self.f = open(file_, 'wb')
+        self.f.write(b'\0' * SN_TIMELINE_HEADER)
+
+    def append(self, src, dst, delay):
+        # Write the next frame (time index len(self.index) + 1) from link
+        # endpoints and delays in any order.
+        self.append_edges(sn_make_edges(src, dst, delay))
+
+    def append_edges(self, edges):
+        # Write the next frame from normalized edges (see sn_make_edges).
+        keys = sn_edge_keys(edges, self.node_num)
+        delay = sn_quantize(edges['delay'])
+        frame = len(self.index)
+        key = frame if not self.index else self.index[-1][1]
+        chunks = None
+        if self.pre_keys is not None and frame - key < SN_KEYFRAME_INTERVAL:
+            removed = np.flatnonzero(
+                ~np.isin(self.pre_keys, keys, assume_unique=True))
+            added = ~np.isin(keys, self.pre_keys, assume_unique=True)
+            kept = np.ones(len(self.pre_keys), dtype=bool)
+            kept[removed] = False
+            delta = delay[~added] - self.pre_delay[kept]
+            width = sn_delta_width(delta)
+            chunks = [
+                removed.astype('<u4').tobytes(), edges[added].tobytes(),
+                delta.astype(SN_DELTA_DTYPES[width]).tobytes()
+                if width else b''
+            ]
+            if sum(len(chunk) for chunk in chunks) >= edges.nbytes:
+                chunks = None
+        if chunks is None:
+            key = frame
+            removed, added, width = (), (), 0
+            chunks = [np.ascontiguousarray(edges).tobytes()]
+        self.index.append((self.size, key, len(edges), len(removed),
+                           int(np.count_nonzero(added)), width))
+        for chunk in chunks:
+            self.f.write(chunk)
+            self.size += len(chunk)
+        self.pre_keys = keys
+        self.pre_delay = delay
+
+    def close(self):
+        index_offset = SN_TIMELINE_HEADER + self.size
+        self.f.write(np.array(self.index, dtype=SN_FRAME_DTYPE).tobytes())
+        header = struct.pack(SN_TIMELINE_STRUCT, SN_TIMELINE_MAGIC,
+                             SN_TIMELINE_VERSION, self.node_num,
+                             len(self.index), self.size, index_offset,
+                             self.cycle)
+        self.f.seek(0)
+        self.f.write(header.ljust(SN_TIMELINE_HEADER, b'\0'))
+        self.f.close()
+
+
+def sn_save_frame(file_, node_num, edges):
+    # One-frame timeline, used to ship a single second to the remote side.
+    # Its only frame is a keyframe: the data is the edges as they are.
+    writer = DelayTimelineWriter(file_, node_num)
+    writer.append(edges['src'], edges['dst'], edges['delay'])
+    writer.close()
+
+
+def sn_concat_timelines(files, file_):
+    # Join timelines of consecutive time ranges into file_, frame after
+    # frame. The inputs are removed.
+    if len(files) == 1:
+        os.replace(files[0], file_)
+        return
+    first = DelayTimeline(files[0])
+    node_num = first.node_num
+    writer = DelayTimelineWriter(file_, node_num, first.cycle)
+    del first
+    for part in files:
+        timeline = DelayTimeline(part)
+        if timeline.node_num != node_num:
+            raise ValueError(part + ' has %d nodes, not %d' %
+                             (timeline.node_num, node_num))
+        with open(part, 'rb') as f:
+            f.seek(SN_TIMELINE_HEADER)
+            sn_copy_bytes(f, writer.f, timeline.data_size)
+        # the first frame of every part is a keyframe
+        base = len(writer.index)
+        for offset, key, *sizes in timeline.index.tolist():
+            writer.index.append((offset + writer.size, key + base, *sizes))
+        writer.size += timeline.data_size
+        del timeline
+        os.remove(part)
+    writer.close()
+
+
+def sn_copy_bytes(src, dst, size):
+    while size > 0:
+        chunk = src.read(min(size, 1 << 24))
+        if not chunk:
+            raise ValueError('unexpected end of timeline')
+        dst.write(chunk)
+        size -= len(chunk)
+
+
+class DelayTimeline():
+
+    def __init__(self, file_):
+        self.file_ = file_
+        with open(file_, 'rb') as f:
+            header = f.read(SN_TIMELINE_HEADER)
+            (magic, version, self.node_num, self.frame_num, self.data_size,
+             index_offset,
+             self.cycle) = struct.unpack_from(SN_TIMELINE_STRUCT, header)
+            if magic != SN_TIMELINE_MAGIC or version != SN_TIMELINE_VERSION:
+                raise ValueError(file_ + ' is not a StarryNet delay timeline')
+            f.seek(index_offset)
+            self.index = np.fromfile(f,
+                                     dtype=SN_FRAME_DTYPE,
+                                     count=self.frame_num)
+        if len(self.index) != self.frame_num:
+            raise ValueError(file_ + ' is truncated')
+        if self.data_size == 0:
+            self.data = np.zeros(0, dtype=np.uint8)
+        else:
+            self.data = np.memmap(file_,
+                                  dtype=np.uint8,
+                                  mode='r',
+                                  offset=SN_TIMELINE_HEADER,
+                                  shape=(self.data_size, )).view(np.ndarray)
+        # index entries as tuples, cheaper to look up one frame at a time
+        self.frames = self.index.tolist()
+        self.periodic_timeline = None
+        # last decoded frame: time index, edges, 0.01 ms delays
+        self.decoded = (0, None, None)
+
+    def __len__(self):
+        return self.frame_num
+
+    def periodic(self):
+        # Companion timeline of the ISL frames, opened on first use.
+        if self.periodic_timeline is None:
+            self.periodic_timeline = DelayTimeline(
+                sn_periodic_path(self.file_))
+        return self.periodic_timeline
+
+    def read(self, offset, dtype, count):
+        size = np.dtype(dtype).itemsize * count
+        return np.frombuffer(self.data[offset:offset + size], dtype=dtype)
+
+    def decode(self, time_index):
+        # (edges, 0.01 ms delays) stored for time_index, from the previous
+        # frame if it was the last one decoded, else from the keyframe.
+        offset, key, links = self.frames[time_index - 1][:3]
+        key += 1
+        if key == time_index:
+            edges = self.read(offset, SN_EDGE_DTYPE, links).copy()
+            return edges, sn_quantize(edges['delay'])
+        if self.decoded[0] == time_index - 1:
+            edges, delay = self.decoded[1:]
+            edges, delay = self.apply(time_index, edges.copy(), delay)
+        else:
+            edges, delay = self.decode(key)
+            for t in range(key + 1, time_index + 1):
+                edges, delay = self.apply(t, edges, delay)
+        edges['delay'] = delay / 100
+        return edges, delay
+
+    def apply(self, time_index, edges, delay):
+        # Frame time_index from the previous one (edges, delay). The delay
+        # field of the returned edges is left for the caller to update.
+        offset, key, links, removed, added, width = \
+            self.frames[time_index - 1]
+        if removed or added:
+            removed = self.read(offset, '<u4', removed)
+            offset += removed.nbytes
+            added = self.read(offset, SN_EDGE_DTYPE, added)
+            offset += added.nbytes
+            kept = np.ones(len(edges), dtype=bool)
+            kept[removed] = False
+            edges = edges[kept]
+            delay = delay[kept]
+        else:
+            added = ()
+        if width:
+            delay = delay + self.read(offset, SN_DELTA_DTYPES[width],
+                                      len(delay))
+        if len(added):
+            pos = np.searchsorted(sn_edge_keys(edges, self.node_num),
+                                  sn_edge_keys(added, self.node_num))
+            edges = np.insert(edges, pos, added)
+            delay = np.insert(delay, pos, sn_quantize(added['delay']))
+        return edges, delay
+
+    def edges(self, time_index):
+        # Links at time_index (1-based) with fields src, dst (0-based,
+        # src < dst) and delay (ms), sorted.
+        if time_index < 1 or time_index > self.frame_num:
+            raise IndexError('time index %d out of range [1, %d]' %
+                             (time_index, self.frame_num))
+        if self.decoded[0] == time_index:
+            edges = self.decoded[1]
+        else:
+            edges, delay = self.decode(time_index)
+            edges.flags.writeable = False
+            self.decoded = (time_index, edges, delay)
+        if self.cycle:
+            isl = self.periodic().edges((time_index - 1) % self.cycle + 1)
+            edges = sn_merge_edges(isl, edges)
+        return edges
+
+
+def sn_edge_keys(edges, node_num):
+    # Sorted int64 keys src * node_num + dst identifying the links of a frame.
+    return edges['src'].astype(np.int64) * node_num + edges['dst']
+
+
+def sn_diff_keys(pre_keys, now_keys):
+    # Added and removed links between two sorted key arrays: the symmetric
+    # difference (XOR) split by which side each key came from.
+    changed = np.setxor1d(pre_keys, now_keys, assume_unique=True)
+    added = np.isin(changed, now_keys, assume_unique=True)
+    return changed[added], changed[~added]
+
+
+def sn_link_changes(timeline, first_time, last_time):
+    # Yields (time, added keys, removed keys) for every second in
+    # (first_time, last_time] whose links differ from the previous second.
+    # Only two frames are held at a time; equal frames cost one comparison.
+    pre_keys = sn_edge_keys(timeline.edges(first_time), timeline.node_num)
+    for time in range(first_time + 1, last_time + 1):
+        now_keys = sn_edge_keys(timeline.edges(time), timeline.node_num)
+        if not np.array_equal(pre_keys, now_keys):
+            added, removed = sn_diff_keys(pre_keys, now_keys)
+            yield time, added, removed
+        pre_keys = now_keys
+
+
+def sn_linked_keys(timeline, first_time, last_time):
+    # Sorted keys of every link up in at least one second of
+    # [first_time, last_time].
+    keys = [sn_edge_keys(timeline.edges(first_time), timeline.node_num)]
+    keys += [
+        added for _, added, _ in sn_link_changes(timeline, first_time,
+                                                 last_time)
+    ]
+    return np.unique(np.concatenate(keys))
+
+
+def sn_write_change(f, time, added, removed):
+    # Append one link change to a binary change stream: int64 time, added
+    # and removed key counts, then the keys.
+    np.array([time, len(added), len(removed)], dtype='<i8').tofile(f)
+    np.asarray(added, dtype='<i8').tofile(f)
+    np.asarray(removed, dtype='<i8').tofile(f)
+
+
+def sn_read_changes(file_):
+    # Yields the (time, added keys, removed keys) of a change stream, one
+    # at a time.
+    with open(file_, 'rb') as f:
+        while True:
+            head = np.fromfile(f, dtype='<i8', count=3)
+            if len(head) < 3:
+                return
+            time, added_num, removed_num = head.tolist()
+            added = np.fromfile(f, dtype='<i8', count=added_num)
+            removed = np.fromfile(f, dtype='<i8', count=removed_num)
+            yield time, added, removed
+
+
+def sn_key_pairs(keys, node_num):
+    # (src, dst) pairs of keys, ordered by dst then src.
+    src = keys // node_num
+    dst = keys % node_num
+    order = np.lexsort((src, dst))
+    return zip(src[order].tolist(), dst[order].tolist())
@@ -0,0 +1,218 @@
+import os
+import hashlib
+import numpy as np
+from datetime import datetime, timedelta
+from sgp4.api import SatrecArray, WGS72, jday
+
+from starrynet.sn_propagator import *
+"""
+TLE catalog mode: parses a catalog such as tle/Starlink.tle into orbital
+element arrays (cached as .npz), builds the SGP4 models, and groups the
+satellites into shells and orbital planes to assign ISLs. TLE mean elements
+are propagated with the WGS72 gravity model.
+"""
+
+SN_TLE_CACHE_VERSION = 1
+# Satellites closer than these are put in the same shell / orbital plane.
+SN_SHELL_INCLINATION_TOL = 0.5  # degree
+SN_SHELL_ALTITUDE_TOL = 20  # km
+SN_PLANE_RAAN_TOL = 1.5  # degree
+SN_MU = 398600.8  # km^3/s^2, WGS72 as used by the TLE mean elements
+SN_EARTH_RADIUS = 6378.135  # km, WGS72
+
+
+def sn_tle_float(field):
+    # TLE fields with an implied leading decimal point and a power of ten
+    # exponent, e.g. ' 35067-2' = 0.35067e-2.
+    field = np.char.ljust(field, 8).tolist()
+    sign = np.array([-1.0 if f[0] == '-' else 1.0 for f in field])
+    mantissa = np.array(['0.' + f[1:6].replace(' ', '0') for f in field])
+    exponent = np.array([f[6:8].replace(' ', '') or '0' for f in field])
+    return sign * mantissa.astype(float) * 10.0**exponent.astype(int)
+
+
+def sn_parse_tle(file_):
+    # Vectorized fixed-column parse of a 3-line TLE catalog. Returns the
+    # satellite names and a dict of element arrays in sgp4init units.
+    with open(file_, encoding='utf8') as f:
+        lines = [line.rstrip('\r\n') for line in f if line.strip()]
+    names = [line.strip() for line in lines[0::3]]
+    line1 = np.array([line.ljust(69) for line in lines[1::3]])
+    line2 = np.array([line.ljust(69) for line in lines[2::3]])
+    if len(names) != len(line1) or len(line1) != len(line2) or not all(
+            np.char.startswith(line1, '1 ')) or not all(
+                np.char.startswith(line2, '2 ')):
+        raise ValueError(file_ + ' is not a 3-line TLE catalog')
+
+    def column(lines, start, end):
+        return np.array([line[start:end] for line in lines.tolist()])
+
+    year = column(line1, 18, 20).astype(int)
+    year = np.where(year < 57, 2000 + year, 1900 + year)
+    day = column(line1, 20, 32).astype(float)
+    jan0 = np.array([jday(y, 1, 1, 0, 0, 0)[0] for y in year]) - 1
+    deg = np.pi / 180
+    satnum = column(line1, 2, 7)
+    elements = {
+        'satnum':
+        np.array([int(s) if s.strip().isdigit() else i
+                  for i, s in enumerate(satnum.tolist())]),
+        'epoch':
+        jan0 + day - 2433281.5,  # days since 1949 December 31 00:00 UT
+        'ndot':
+        column(line1, 33, 43).astype(float) / (1440.0 * 1440.0 / (2 * np.pi)),
+        'nddot':
+        sn_tle_float(column(line1, 44, 52)) / (1440.0**3 / (2 * np.pi)),
+        'bstar':
+        sn_tle_float(column(line1, 53, 61)),
+        'inclo':
+        column(line2, 8, 16).astype(float) * deg,
+        'nodeo':
+        column(line2, 17, 25).astype(float) * deg,
+        'ecco':
+        np.char.add('0.', np.char.replace(column(line2, 26, 33), ' ',
+                                          '0')).astype(float),
+        'argpo':
+        column(line2, 34, 42).astype(float) * deg,
+        'mo':
+        column(line2, 43, 51).astype(float) * deg,
+        'no_kozai':
+        column(line2, 52, 63).astype(float) / (1440.0 / (2 * np.pi)),
+    }
+    return names, elements
+
+
+def sn_file_digest(file_):
+    with open(file_, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def sn_load_tle(file_, cache_dir=None):
+    # sn_parse_tle, memoized in cache_dir by the content hash of the catalog.
+    if cache_dir is None:
+        return sn_parse_tle(file_)
+    digest = sn_file_digest(file_)
+    cache_dir = os.path.expanduser(cache_dir)
+    cached = os.path.join(cache_dir,
+                          'tle-%d-%s.npz' % (SN_TLE_CACHE_VERSION, digest))
+    if os.path.exists(cached):
+        with np.load(cached) as data:
+            return data['names'].tolist(), {
+                name: data[name]
+                for name in SN_SATREC_FIELDS
+            }
+    names, elements = sn_parse_tle(file_)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = cached + '.%d.tmp.npz' % os.getpid()
+    np.savez(tmp, names=np.array(names), **elements)
+    os.replace(tmp, cached)
+    return names, elements
+
+
+def sn_tle_table(elements):
+    # Element table (see sn_satrecs) of parsed TLEs.
+    return np.stack([elements[name] for name in SN_SATREC_FIELDS],
+                    axis=1).astype(float)
+
+
+def sn_tle_start(elements):
+    # Latest epoch of the catalog, rounded up to a whole second, so that no
+    # satellite is propagated far from its epoch.
+    epoch = datetime(1949, 12, 31) + timedelta(days=float(
+        np.max(elements['epoch'])))
+    return epoch.replace(microsecond=0) + timedelta(
+        seconds=1 if epoch.microsecond else 0)
+
+
+def sn_tle_constellation(names, elements, start):
+    # Drops satellites that SGP4 cannot propagate at start and sorts the
+    # rest plane by plane. Returns (names, element table, plane id and
+    # argument of latitude in degrees of every satellite, shell id of every
+    # plane, mean altitude in km of every satellite), in node order.
+    table = sn_tle_table(elements)
+    satrecs = sn_satrecs(table, WGS72)
+    jd, fr = jday(*start.timetuple()[:6])
+    e, r, v = SatrecArray(satrecs).sgp4(np.array([jd]), np.array([fr]))
+    ok = (e[:, 0] == 0) & np.all(np.isfinite(r[:, 0]), axis=1)
+    r = r[ok, 0]
+    v = v[ok, 0]
+    # current orbital plane and argument of latitude from the TEME state
+    h = np.cross(r, v)
+    inclination = np.degrees(np.arccos(h[:, 2] / np.linalg.norm(h, axis=1)))
+    raan = np.radians(np.degrees(np.arctan2(h[:, 0], -h[:, 1])) % 360)
+    u = np.degrees(
+        np.arctan2(r[:, 2] / np.sin(np.radians(inclination)),
+                   r[:, 0] * np.cos(raan) + r[:, 1] * np.sin(raan))) % 360
+    mean_motion = elements['no_kozai'][ok] / 60  # rad/s
+    altitude = (SN_MU / mean_motion**2)**(1 / 3) - SN_EARTH_RADIUS
+    plane, shell_of_plane = sn_group_planes(inclination, altitude,
+                                            np.degrees(raan))
+    order = np.lexsort((u, plane))
+    index = np.nonzero(ok)[0][order]
+    return ([names[i] for i in index], table[index], plane[order], u[order],
+            shell_of_plane, altitude[order])
+
+
+def sn_split(values, tol):
+    # Labels of sorted-order clusters: a new cluster starts at each gap > tol.
+    order = np.argsort(values, kind='stable')
+    label = np.zeros(len(values), dtype=np.int64)
+    label[order[1:]] = np.cumsum(np.diff(values[order]) > tol)
+    return label
+
+
+def sn_group_planes(inclination, altitude, raan):
+    # Plane id of every satellite and shell id of every plane. Shells are
+    # split by inclination, then altitude; planes by RAAN, wrapping around
+    # 360 degrees. Planes are numbered by shell, then RAAN.
+    plane = np.zeros(len(raan), dtype=np.int64)
+    shell_of_plane = []
+    inc_label = sn_split(inclination, SN_SHELL_INCLINATION_TOL)
+    for inc in np.unique(inc_label):
+        in_inc = np.nonzero(inc_label == inc)[0]
+        alt_label = sn_split(altitude[in_inc], SN_SHELL_ALTITUDE_TOL)
+        for alt in np.unique(alt_label):
+            members = in_inc[alt_label == alt]
+            label = sn_split(raan[members], SN_PLANE_RAAN_TOL)
+            if label.max() > 0:
+                # merge the last plane into the first across 0/360 degrees
+                first = raan[members][label == 0].min()
+                last = raan[members][label == label.max()].max()
+                if first + 360 - last <= SN_PLANE_RAAN_TOL:
+                    label[label == label.max()] = 0
+            plane[members] = len(shell_of_plane) + label
+            shell_of_plane += [inc * len(raan) + alt] * (label.max() + 1)
+    return plane, np.unique(shell_of_plane, return_inverse=True)[1]
+
+
+def sn_plane_isls(plane, u, shell_of_plane):
+    # ISLs of a plane-sorted constellation: a ring inside each plane
+    # (intra-orbit) and a link to the satellite with the closest argument of
+    # latitude in the next plane of the shell (inter-orbit). A satellite
+    # accepts at most one inter-orbit link from the previous plane, so no
+    # satellite has more than four ISLs. Returns (src, dst) index arrays.
+    plane = np.asarray(plane)
+    u = np.asarray(u, dtype=float)
+    plane_num = len(shell_of_plane)
+    members = [np.nonzero(plane == p)[0] for p in range(plane_num)]
+    src = []
+    dst = []
+    for p in range(plane_num):
+        sats = members[p]
+        if len(sats) > 1:
+            src.append(sats)
+            dst.append(np.roll(sats, -1))
+        same_shell = np.nonzero(shell_of_plane == shell_of_plane[p])[0]
+        if len(same_shell) < 2:
+            continue
+        q = same_shell[(np.searchsorted(same_shell, p) + 1) % len(same_shell)]
+        diff = np.abs((u[members[q]][None, :] - u[sats][:, None] + 180) %
+                      360 - 180)
+        nearest = np.argmin(diff, axis=1)
+        order = np.argsort(diff[np.arange(len(sats)), nearest], kind='stable')
+        target, first = np.unique(nearest[order], return_index=True)
+        src.append(sats[order[first]])
+        dst.append(members[q][target])
+    if not src:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(src), np.concatenate(dst)
@@ -0,0 +1,226 @@
+import numpy as np
+from collections import OrderedDict
+
+from starrynet.sn_propagator import *
+from starrynet.sn_timeline import *
+from starrynet.sn_visibility import *
+"""
+Indexed view of the observer outputs for the StarryNet query APIs. Each
+timestep of the delay timeline gets a CSR adjacency index (built on first
+use, the most recent ones kept in memory), so single queries cost O(degree)
+and positions are read from a memory-mapped array. Batched variants take
+arrays of nodes and times and return NumPy arrays. Between seconds,
+satellite positions are cubic Hermite interpolations of the stored positions
+and SGP4 velocities, so distances and delays can be queried at any time
+without propagating again.
+"""
+
+# Timesteps whose adjacency index is kept in memory.
+SN_TOPOLOGY_FRAMES = 256
+
+
+def sn_position_path(path):
+    # (seconds, satellites, 3) float64 ITRS xyz (km) array of the run whose
+    # working directory is path.
+    return path + '/position/position.npy'
+
+
+def sn_state_path(path):
+    # (seconds, satellites, 6) float32 ITRS positions (km) and velocities
+    # (km/s, relative to the rotating earth).
+    return path + '/position/state.npy'
+
+
+def sn_ground_path(path):
+    # (GSes, 3) float64 GS ITRS positions (km).
+    return path + '/position/ground.npy'
+
+
+class TopologyFrame():
+
+    def __init__(self, edges, node_num):
+        # keys of the links, sorted (see sn_edge_keys)
+        self.keys = sn_edge_keys(edges, node_num)
+        self.delays = np.asarray(edges['delay'])
+        # CSR adjacency: neighbors of node n (0-based, ascending) are
+        # indices[indptr[n]:indptr[n + 1]]
+        src = np.concatenate((edges['src'], edges['dst'])).astype(np.int64)
+        dst = np.concatenate((edges['dst'], edges['src'])).astype(np.int64)
+        order = np.lexsort((dst, src))
+        self.indices = dst[order]
+        self.indptr = np.zeros(node_num + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=node_num),
+                  out=self.indptr[1:])
+        self.link_delays = np.concatenate(
+            (self.delays, self.delays))[order]
+
+
+class TopologyTimeline():
+
+    def __init__(self, path):
+        self.path = path
+        self.delay_timeline = DelayTimeline(sn_timeline_path(path))
+        self.node_num = self.delay_timeline.node_num
+        self.frames = OrderedDict()
+        self.positions = np.load(sn_position_path(path), mmap_mode='r')
+        self.states = None
+        self.ground = None
+
+    def frame(self, time_index):
+        # Adjacency index of the links at time_index (1-based).
+        frame = self.frames.get(time_index)
+        if frame is None:
+            frame = TopologyFrame(self.delay_timeline.edges(time_index),
+                                  self.node_num)
+            self.frames[time_index] = frame
+            if len(self.frames) > SN_TOPOLOGY_FRAMES:
+                self.frames.popitem(last=False)
+        else:
+            self.frames.move_to_end(time_index)
+        return frame
+
+    def neighbors(self, node_index, time_index):
+        # 1-based indexes of the nodes linked to node_index, ascending, and
+        # the matching delays (ms).
+        frame = self.frame(time_index)
+        first = frame.indptr[node_index - 1]
+        last = frame.indptr[node_index]
+        return frame.indices[first:last] + 1, frame.link_delays[first:last]
+
+    def delay(self, node1_index, node2_index, time_index):
+        # Delay (ms) between 1-based node indexes, 0 if not linked.
+        frame = self.frame(time_index)
+        first = frame.indptr[node1_index - 1]
+        last = frame.indptr[node1_index]
+        pos = first + np.searchsorted(frame.indices[first:last],
+                                      node2_index - 1)
+        if pos < last and frame.indices[pos] == node2_index - 1:
+            return round(float(frame.link_delays[pos]), 2)
+        return 0.0
+
+    def position(self, sat_index, time_index):
+        # Latitude, longitude (degrees) and altitude (km) of a satellite
+        # (1-based) at second time_index.
+        return sn_itrs_to_lla(self.positions[time_index, sat_index - 1])
+
+    def delays(self, node1_indexes, node2_indexes, time_indexes):
+        # Batched delay: arrays (broadcast together) of 1-based node indexes
+        # and time indexes -> array of delays (ms), 0 where not linked.
+        node1, node2, times = np.broadcast_arrays(
+            np.asarray(node1_indexes, dtype=np.int64),
+            np.asarray(node2_indexes, dtype=np.int64),
+            np.asarray(time_indexes, dtype=np.int64))
+        low = np.minimum(node1, node2) - 1
+        high = np.maximum(node1, node2) - 1
+        keys = low * self.node_num + high
+        result = np.zeros(keys.shape)
+        for time_index in np.unique(times):
+            frame = self.frame(int(time_index))
+            if len(frame.keys) == 0:
+                continue
+            at = times == time_index
+            pos = np.searchsorted(frame.keys, keys[at])
+            pos = np.minimum(pos, len(frame.keys) - 1)
+            found = frame.keys[pos] == keys[at]
+            delay = np.round(frame.delays[pos].astype(float), 2)
+            result[at] = np.where(found, delay, 0.0)
+        return result
+
+    def neighbor_arrays(self, node_indexes, time_indexes):
+        # Batched neighbors: for every (node, time) pair of the broadcast
+        # arrays, its links as flat arrays (node, time, neighbor, delay)
+        # with 1-based node indexes, grouped by time then input order.
+        nodes, times = np.broadcast_arrays(
+            np.asarray(node_indexes, dtype=np.int64),
+            np.asarray(time_indexes, dtype=np.int64))
+        nodes = nodes.ravel()
+        times = times.ravel()
+        parts = []
+        for time_index in np.unique(times):
+            frame = self.frame(int(time_index))
+            node = nodes[times == time_index]
+            first = frame.indptr[node - 1]
+            count = frame.indptr[node] - first
+            # positions first[k] .. first[k] + count[k] - 1 of every node k
+            starts = np.repeat(first - np.cumsum(count) + count, count)
+            pos = starts + np.arange(count.sum())
+            parts.append((np.repeat(node, count),
+                          np.full(count.sum(), time_index),
+                          frame.indices[pos] + 1, frame.link_delays[pos]))
+        if not parts:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                    np.zeros(0, dtype=np.int64), np.zeros(0,
+                                                          dtype=np.float32))
+        return tuple(np.concatenate(column) for column in zip(*parts))
+
+    def positions_of(self, sat_indexes, time_indexes):
+        # Batched position: broadcast arrays of 1-based satellite indexes and
+        # seconds -> (..., 3) latitude, longitude, altitude.
+        sats, times = np.broadcast_arrays(
+            np.asarray(sat_indexes, dtype=np.int64),
+            np.asarray(time_indexes, dtype=np.int64))
+        return sn_itrs_to_lla(np.asarray(self.positions[times, sats - 1]))
+
+    def locations(self, node_indexes, seconds):
+        # ITRS xyz (km) of 1-based node indexes at seconds
+        # (floats, broadcast together): satellites interpolated between the
+        # stored seconds, GSes fixed.
+        if self.states is None:
+            self.states = np.load(sn_state_path(self.path), mmap_mode='r')
+            self.ground = np.load(sn_ground_path(self.path))
+        nodes, seconds = np.broadcast_arrays(
+            np.asarray(node_indexes, dtype=np.int64),
+            np.asarray(seconds, dtype=float))
+        sat_num = self.states.shape[1]
+        result = np.empty(nodes.shape + (3, ))
+        is_sat = nodes <= sat_num
+        result[~is_sat] = self.ground[nodes[~is_sat] - sat_num - 1]
+        sat = nodes[is_sat] - 1
+        t = seconds[is_sat]
+        i = np.clip(np.floor(t), 0, max(len(self.states) - 2,
+                                        0)).astype(np.int64)
+        u = (t - i)[:, None]
+        p0 = self.states[i, sat].astype(float)
+        if len(self.states) < 2:
+            result[is_sat] = p0[:, :3]
+            return result
+        p1 = self.states[i + 1, sat].astype(float)
+        # cubic Hermite basis over one second
+        u2 = u * u
+        u3 = u2 * u
+        result[is_sat] = (2 * u3 - 3 * u2 + 1) * p0[:, :3] + (
+            u3 - 2 * u2 + u) * p0[:, 3:] + (-2 * u3 + 3 * u2) * p1[:, :3] + (
+                u3 - u2) * p1[:, 3:]
+        return result
+
+    def distances_at(self, node1_indexes, node2_indexes, times):
+        # Distances (km) between linked nodes at float times on the
+        # time_index scale (time_index t is second t - 1), 0 where not
+        # linked. The links are those of time index floor(time).
+        node1, node2, times = np.broadcast_arrays(
+            np.asarray(node1_indexes, dtype=np.int64),
+            np.asarray(node2_indexes, dtype=np.int64),
+            np.asarray(times, dtype=float))
+        linked = self.delays(node1, node2, np.floor(times)) > 0
+        d = self.locations(node1, times - 1) - self.locations(node2, times - 1)
+        return np.where(linked, np.sqrt(np.sum(d * d, axis=-1)), 0.0)
+
+    def delays_at(self, node1_indexes, node2_indexes, times):
+        # Delays (ms) of distances_at.
+        return self.distances_at(node1_indexes, node2_indexes,
+                                 times) / SN_LINK_SPEED * 1000
+
+    def delay_frames(self, first_time, last_time, step):
+        # Yields (time, edges) every step seconds of [first_time, last_time)
+        # on the time_index scale: the links of time index floor(time) with
+        # their delays at time (see sn_make_edges).
+        count = int(np.ceil(round((last_time - first_time) / step, 9)))
+        for time in np.round(first_time + np.arange(count) * step, 9):
+            edges = self.delay_timeline.edges(int(np.floor(time)))
+            src = edges['src'].astype(np.int64)
+            dst = edges['dst'].astype(np.int64)
+            d = self.locations(src + 1, time - 1) - self.locations(
+                dst + 1, time - 1)
+            yield float(time), sn_make_edges(
+                src, dst,
+                np.sqrt(np.sum(d * d, axis=-1)) / SN_LINK_SPEED * 1000)
@@ -8,6 +8,9 @@ from time import sleep
 import time
 import numpy
 import random
+from starrynet.sn_agent import *
+from starrynet.sn_timeline import *
+from starrynet.sn_topology import *
 """
 Starrynet utils that are used in sn_synchronizer
 author: Yangtao Deng (dengyt21@mails.tsinghua.edu.cn) and Zeqi Lai (zeqilai@tsinghua.edu.cn)
@@ -63,6 +66,9 @@ def sn_load_file(path, GS_lat_long):
     data['inter_as_routing'] = table["Inter-AS routing"]
     data['link_policy'] = table["Link policy"]
     data['handover_policy'] = table["Handover policy"]
+    data['compare_handover_policies'] = table.get(
+        "Compare handover policies", False)
+    data['visibility_windows'] = table.get("GSL visibility windows", False)
     data['update_time'] = table["update_time (s)"]
     data['sat_bw'] = table["satellite link bandwidth (\"X\" Gbps)"]
     data['sat_ground_bw'] = table["sat-ground bandwidth (\"X\" Gbps)"]
@@ -76,6 +82,20 @@ def sn_load_file(path, GS_lat_long):
     data['remote_machine_IP'] = table["remote_machine_IP"]
     data['remote_machine_username'] = table["remote_machine_username"]
     data['remote_machine_password'] = table["remote_machine_password"]
+    data['cache_dir'] = table.get("cache directory", "~/.starrynet/cache")
+    data['cache_size'] = table.get("cache size (MB)", 1024)
+    data['tle_file'] = table.get("TLE file", "")
+    data['observer_workers'] = table.get("observer workers", 0)
+    data['delay_threshold'] = table.get("delay update threshold (ms)", 0)
+    data['link_backend'] = table.get("Link backend", "bridge")
+    data['routing_timeout'] = table.get("routing convergence timeout (s)",
+                                        120)
+    # Walker shells and inter-shell links replacing the single shell above
+    # (see sn_shells)
+    data['shells'] = table.get("Shells", [])
+    data['inter_shell_links'] = table.get("Inter-shell links", [])
+    # checks of which ISLs are up every second (see sn_isl)
+    data['isl_constraints'] = table.get("ISL constraints", {})
 
     parser = argparse.ArgumentParser(description='manual to this script')
     parser.add_argument('--cons_name', type=str, default=data['cons_name'])
@@ -89,10 +109,25 @@ def sn_load_file(path, GS_lat_long):
     parser.add_argument('--link_style', type=str, default=data['link'])
     parser.add_argument('--IP_version', type=str, default=data['ip'])
     parser.add_argument('--link_policy', type=str, default=data['link_policy'])
+    parser.add_argument('--handover_policy',
+                        type=str,
+                        default=data['handover_policy'])
+    # "1" to count the handovers of every policy
+    parser.add_argument('--compare_handover_policies',
+                        type=int,
+                        default=int(data['compare_handover_policies']))
+    # "1" to predict GSL visibility windows and handover instants
+    parser.add_argument('--visibility_windows',
+                        type=int,
+                        default=int(data['visibility_windows']))
     # link delay updating granularity
     parser.add_argument('--update_interval',
                         type=int,
                         default=data['update_time'])
+    # link delay changes (ms) not larger than this are not applied
+    parser.add_argument('--delay_threshold',
+                        type=float,
+                        default=data['delay_threshold'])
     parser.add_argument('--duration', type=int, default=data['duration'])
     parser.add_argument('--inter_routing',
                         type=str,
@@ -131,6 +166,28 @@ def sn_load_file(path, GS_lat_long):
                         type=str,
                         default=data['remote_machine_password'])
 
+    # observer output cache, "0" MB disables it
+    parser.add_argument('--cache_dir', type=str, default=data['cache_dir'])
+    parser.add_argument('--cache_size', type=int, default=data['cache_size'])
+    # TLE catalog (e.g. tle/Starlink.tle) replacing the Walker shell
+    parser.add_argument('--tle_file', type=str, default=data['tle_file'])
+    # processes computing positions and delays, "0" for one per CPU
+    parser.add_argument('--observer_workers',
+                        type=int,
+                        default=data['observer_workers'])
+    # "bridge" (a docker network per link) or "veth" (veth pairs)
+    parser.add_argument('--link_backend',
+                        type=str,
+                        choices=['bridge', 'veth'],
+                        default=data['link_backend'])
+    # longest wait (s) for the OSPF routing to converge
+    parser.add_argument('--routing_timeout',
+                        type=int,
+                        default=data['routing_timeout'])
+    parser.set_defaults(shells=data['shells'],
+                        inter_shell_links=data['inter_shell_links'],
+                        isl_constraints=data['isl_constraints'])
+
     parser.add_argument('--path',
                         '-p',
                         type=str,
@@ -179,6 +236,9 @@ def sn_init_remote_ftp(transport):
 
 
 def sn_remote_cmd(remote_ssh, cmd):
+    # remote_ssh may also be the RemoteAgent of a running emulation
+    if isinstance(remote_ssh, RemoteAgent):
+        return remote_ssh.run(cmd)
     stdin, stdout, stderr = remote_ssh.exec_command(cmd, get_pty=True)
     lines = stdout.readlines()
     return lines
@@ -283,9 +343,10 @@ class sn_Link_Init_Thread(threading.Thread):
     def __init__(self, remote_ssh, remote_ftp, orbit_num, sat_num,
                  constellation_size, fac_num, file_path,
                  configuration_file_path, sat_bandwidth, sat_ground_bandwidth,
-                 sat_loss, sat_ground_loss):
+                 sat_loss, sat_ground_loss, link_backend):
         threading.Thread.__init__(self)
         self.remote_ssh = remote_ssh
+        self.link_backend = link_backend
         self.constellation_size = constellation_size
         self.fac_num = fac_num
         self.orbit_num = orbit_num
@@ -303,9 +364,10 @@ class sn_Link_Init_Thread(threading.Thread):
         self.remote_ftp.put(
             os.path.join(os.getcwd(), "starrynet/sn_orchestrater.py"),
             self.file_path + "/sn_orchestrater.py")
-        self.remote_ftp.put(
-            self.configuration_file_path + "/" + self.file_path +
-            '/delay/1.txt', self.file_path + "/1.txt")
+        remote_delay_path = sn_put_delay_frame(self.remote_ftp,
+                                               self.file_path,
+                                               self.configuration_file_path,
+                                               1)
         print('Initializing links ...')
         sn_remote_cmd(
             self.remote_ssh, "python3 " + self.file_path +
@@ -313,7 +375,8 @@ class sn_Link_Init_Thread(threading.Thread):
             str(self.sat_num) + " " + str(self.constellation_size) + " " +
             str(self.fac_num) + " " + str(self.sat_bandwidth) + " " +
             str(self.sat_loss) + " " + str(self.sat_ground_bandwidth) + " " +
-            str(self.sat_ground_loss) + " " + self.file_path + "/1.txt")
+            str(self.sat_ground_loss) + " " + remote_delay_path + " " +
+            self.link_backend)
 
 
 # A thread designed for initializing bird routing.
@@ -321,8 +384,12 @@ class sn_Routing_Init_Thread(threading.Thread):
 
     def __init__(self, remote_ssh, remote_ftp, orbit_num, sat_num,
                  constellation_size, fac_num, file_path, sat_bandwidth,
-                 sat_ground_bandwidth, sat_loss, sat_ground_loss):
+                 sat_ground_bandwidth, sat_loss, sat_ground_loss,
+                 routing_timeout):
         threading.Thread.__init__(self)
+        self.routing_timeout = routing_timeout
+        # measured by the remote machine, None if not converged in time
+        self.convergence_time = None
         self.remote_ssh = remote_ssh
         self.constellation_size = constellation_size
         self.fac_num = fac_num
@@ -343,11 +410,19 @@ class sn_Routing_Init_Thread(threading.Thread):
             os.path.join(os.getcwd(), "starrynet/sn_orchestrater.py"),
             self.file_path + "/sn_orchestrater.py")
         print('Initializing routing ...')
-        sn_remote_cmd(
+        result = sn_remote_cmd(
             self.remote_ssh, "python3 " + self.file_path +
             "/sn_orchestrater.py" + " " + str(self.constellation_size) + " " +
-            str(self.fac_num) + " " + self.file_path)
-        print("Routing initialized!")
+            str(self.fac_num) + " " + self.file_path + " " +
+            str(self.routing_timeout))
+        for line in result:
+            if line.startswith("Routing converged in "):
+                self.convergence_time = float(line.split()[3])
+        if self.convergence_time is None:
+            print("Routing not converged after " +
+                  str(self.routing_timeout) + " s.")
+        else:
+            print("Routing initialized in %.1f s!" % self.convergence_time)
 
 
 # A thread designed for emulation.
@@ -359,10 +434,12 @@ class sn_Emulation_Start_Thread(threading.Thread):
                  ping_src, ping_des, ping_time, sr_src, sr_des, sr_target,
                  sr_time, damage_ratio, damage_time, damage_list,
                  recovery_time, route_src, route_time, duration,
-                 utility_checking_time, perf_src, perf_des, perf_time):
+                 utility_checking_time, perf_src, perf_des, perf_time,
+                 sat_bw, delay_threshold, link_backend, isl_pairs):
         threading.Thread.__init__(self)
         self.remote_ssh = remote_ssh
         self.remote_ftp = remote_ftp
+        self.sat_bw = sat_bw
         self.sat_loss = sat_loss
         self.sat_ground_bw = sat_ground_bw
         self.sat_ground_loss = sat_ground_loss
@@ -370,6 +447,10 @@ class sn_Emulation_Start_Thread(threading.Thread):
         self.file_path = file_path
         self.configuration_file_path = configuration_file_path
         self.update_interval = update_interval
+        self.delay_threshold = delay_threshold
+        self.link_backend = link_backend
+        # candidate ISLs, 1-based (low, high) pairs (see Observer.isl_pairs)
+        self.isl_pairs = isl_pairs
         self.constellation_size = constellation_size
         self.ping_src = ping_src
         self.ping_des = ping_des
@@ -393,11 +474,45 @@ class sn_Emulation_Start_Thread(threading.Thread):
             self.container_id_list = sn_get_container_info(self.remote_ssh)
 
     def run(self):
+        # one agent on the remote machine for the whole emulation (see
+        # sn_agent.py); all commands below go through it
+        self.remote_ftp.put(
+            os.path.join(os.getcwd(), "starrynet/sn_orchestrater.py"),
+            self.file_path + "/sn_orchestrater.py")
+        self.agent = RemoteAgent(self.remote_ssh,
+                                 self.file_path + "/sn_orchestrater.py",
+                                 self.file_path, self.link_backend)
+        # delay updates applied and skipped (see sn_update_delay)
+        self.delay_applied = 0
+        self.delay_skipped = 0
+        try:
+            self.emulate()
+        finally:
+            self.agent.close()
+            print("Delay updates: %d links applied, %d skipped." %
+                  (self.delay_applied, self.delay_skipped))
+
+    def emulate(self):
         ping_threads = []
         perf_threads = []
         timeptr = 2  # current emulating time
         topo_change_file_path = self.configuration_file_path + "/" + self.file_path + '/Topo_leo_change.txt'
         fi = open(topo_change_file_path, 'r')
+        timeline = TopologyTimeline(self.configuration_file_path + "/" +
+                                    self.file_path)
+        # ISL networks by (sat, sat) 1-based pair: those of the first
+        # second, numbered as by sn_orchestrater.py, then the new ones;
+        # the numbers of deleted networks are used again
+        links = timeline.delay_timeline.edges(1)
+        links = links[links['dst'] < self.constellation_size]
+        self.isl_networks = {(s + 1, f + 1): i + 1 for i, (s, f) in
+                             enumerate(zip(links['src'].tolist(),
+                                           links['dst'].tolist()))}
+        self.next_isl_idx = len(self.isl_networks) + 1
+        self.free_isl_idx = []
+        # delays on the remote machine, set up from the first second
+        self.timeline = timeline
+        self.applied = timeline.delay_timeline.edges(1)
         line = fi.readline()
         while line:  # starting reading change information and emulating
             words = line.split()
@@ -409,26 +524,22 @@ class sn_Emulation_Start_Thread(threading.Thread):
                     start_time = time.time()
                     if timeptr in self.utility_checking_time:
                         sn_check_utility(
-                            timeptr, self.remote_ssh,
+                            timeptr, self.agent,
                             self.configuration_file_path + "/" +
                             self.file_path)
                     if timeptr % self.update_interval == 0:
                         # updating link delays after link changes
-                        sn_update_delay(self.file_path,
-                                        self.configuration_file_path, timeptr,
-                                        self.constellation_size,
-                                        self.remote_ssh, self.remote_ftp)
+                        self.update_delay(timeptr)
                     if timeptr in self.damage_time:
-                        sn_damage(
-                            self.damage_ratio[self.damage_time.index(timeptr)],
-                            self.damage_list, self.constellation_size,
-                            self.remote_ssh, self.remote_ftp, self.file_path,
-                            self.configuration_file_path)
+                        self.forget_delays(
+                            sn_damage(
+                                self.damage_ratio[self.damage_time.index(
+                                    timeptr)], self.damage_list,
+                                self.constellation_size, self.agent))
                     if timeptr in self.recovery_time:
-                        sn_recover(self.damage_list, self.sat_loss,
-                                   self.remote_ssh, self.remote_ftp,
-                                   self.file_path,
-                                   self.configuration_file_path)
+                        self.forget_delays(
+                            sn_recover(self.damage_list, self.sat_loss,
+                                       self.agent))
                     if timeptr in self.sr_time:
                         index = [
                             i for i, val in enumerate(self.sr_time)
@@ -438,7 +549,7 @@ class sn_Emulation_Start_Thread(threading.Thread):
                             sn_sr(self.sr_src[index_num],
                                   self.sr_des[index_num],
                                   self.sr_target[index_num],
-                                  self.container_id_list, self.remote_ssh)
+                                  self.container_id_list, self.agent)
                     if timeptr in self.ping_time:
                         if timeptr in self.ping_time:
                             index = [
@@ -455,7 +566,7 @@ class sn_Emulation_Start_Thread(threading.Thread):
                                           self.container_id_list,
                                           self.file_path,
                                           self.configuration_file_path,
-                                          self.remote_ssh))
+                                          self.agent))
                                 ping_thread.start()
                                 ping_threads.append(ping_thread)
                     if timeptr in self.perf_time:
@@ -474,7 +585,7 @@ class sn_Emulation_Start_Thread(threading.Thread):
                                           self.container_id_list,
                                           self.file_path,
                                           self.configuration_file_path,
-                                          self.remote_ssh))
+                                          self.agent))
                                 perf_thread.start()
                                 perf_threads.append(perf_thread)
                     if timeptr in self.route_time:
@@ -487,7 +598,7 @@ class sn_Emulation_Start_Thread(threading.Thread):
                                      self.route_time[index_num],
                                      self.file_path,
                                      self.configuration_file_path,
-                                     self.container_id_list, self.remote_ssh)
+                                     self.container_id_list, self.agent)
                     timeptr += 1
                     end_time = time.time()
                     passed_time = (
@@ -503,6 +614,8 @@ class sn_Emulation_Start_Thread(threading.Thread):
                 line = fi.readline()
                 line = fi.readline()
                 words = line.split()
+                # all link changes of this second go in one agent request
+                ops = []
                 while words[0] != 'del:':  # addlink
                     word = words[0].split('-')
                     s = int(word[0])
@@ -511,22 +624,17 @@ class sn_Emulation_Start_Thread(threading.Thread):
                         tmp = s
                         s = f
                         f = tmp
-                    print("add link", s, f)
-                    current_topo_path = self.configuration_file_path + "/" + self.file_path + '/delay/' + str(
-                        current_time) + '.txt'
-                    matrix = sn_get_param(current_topo_path)
-                    sn_establish_new_GSL(self.container_id_list, matrix,
-                                         self.constellation_size,
-                                         self.sat_ground_bw,
-                                         self.sat_ground_loss, s, f,
-                                         self.remote_ssh)
+                    if f <= self.constellation_size:
+                        print("add ISL", s, f)
+                    else:
+                        print("add link", s, f)
+                    delay = timeline.delay(s, f, int(current_time))
+                    ops.append(self.add_link_op(s, f, delay))
                     line = fi.readline()
                     words = line.split()
                 line = fi.readline()
                 words = line.split()
-                if len(words) == 0:
-                    return
-                while words[0] != 'time':  # delete link
+                while words and words[0] != 'time':  # delete link
                     word = words[0].split('-')
                     s = int(word[0])
                     f = int(word[1])
@@ -534,32 +642,34 @@ class sn_Emulation_Start_Thread(threading.Thread):
                         tmp = s
                         s = f
                         f = tmp
-                    print("del link " + str(s) + "-" + str(f) + "\n")
-                    sn_del_link(s, f, self.container_id_list, self.remote_ssh)
+                    if f <= self.constellation_size:
+                        print("del ISL", s, f)
+                        ops.append(self.del_isl_op(s, f))
+                    else:
+                        print("del link " + str(s) + "-" + str(f) + "\n")
+                        ops.append(['gsl_del', s, f])
                     line = fi.readline()
                     words = line.split()
-                    if len(words) == 0:
-                        return
+                self.agent.call(ops)
+                if len(words) == 0:
+                    return
                 if timeptr in self.utility_checking_time:
                     sn_check_utility(
-                        timeptr, self.remote_ssh,
+                        timeptr, self.agent,
                         self.configuration_file_path + "/" + self.file_path)
                 if timeptr % self.update_interval == 0:
                     # updating link delays after link changes
-                    sn_update_delay(self.file_path,
-                                    self.configuration_file_path, timeptr,
-                                    self.constellation_size, self.remote_ssh,
-                                    self.remote_ftp)
+                    self.update_delay(timeptr)
                 if timeptr in self.damage_time:
-                    sn_damage(
-                        self.damage_ratio[self.damage_time.index(timeptr)],
-                        self.damage_list, self.constellation_size,
-                        self.remote_ssh, self.remote_ftp, self.file_path,
-                        self.configuration_file_path)
+                    self.forget_delays(
+                        sn_damage(
+                            self.damage_ratio[self.damage_time.index(timeptr)],
+                            self.damage_list, self.constellation_size,
+                            self.agent))
                 if timeptr in self.recovery_time:
-                    sn_recover(self.damage_list, self.sat_loss,
-                               self.remote_ssh, self.remote_ftp,
-                               self.file_path, self.configuration_file_path)
+                    self.forget_delays(
+                        sn_recover(self.damage_list, self.sat_loss,
+                                   self.agent))
                 if timeptr in self.sr_time:
                     index = [
                         i for i, val in enumerate(self.sr_time)
@@ -568,7 +678,7 @@ class sn_Emulation_Start_Thread(threading.Thread):
                     for index_num in index:
                         sn_sr(self.sr_src[index_num], self.sr_des[index_num],
                               self.sr_target[index_num],
-                              self.container_id_list, self.remote_ssh)
+                              self.container_id_list, self.agent)
                 if timeptr in self.ping_time:
                     if timeptr in self.ping_time:
                         index = [
@@ -584,7 +694,7 @@ class sn_Emulation_Start_Thread(threading.Thread):
                                       self.constellation_size,
                                       self.container_id_list, self.file_path,
                                       self.configuration_file_path,
-                                      self.remote_ssh))
+                                      self.agent))
                             ping_thread.start()
                             ping_threads.append(ping_thread)
                 if timeptr in self.perf_time:
@@ -602,7 +712,7 @@ class sn_Emulation_Start_Thread(threading.Thread):
                                       self.constellation_size,
                                       self.container_id_list, self.file_path,
                                       self.configuration_file_path,
-                                      self.remote_ssh))
+                                      self.agent))
                             perf_thread.start()
                             perf_threads.append(perf_thread)
                 if timeptr in self.route_time:
@@ -614,7 +724,7 @@ class sn_Emulation_Start_Thread(threading.Thread):
                         sn_route(self.route_src[index_num],
                                  self.route_time[index_num], self.file_path,
                                  self.configuration_file_path,
-                                 self.container_id_list, self.remote_ssh)
+                                 self.container_id_list, self.agent)
                 timeptr += 1  # current emulating time
                 if timeptr >= self.duration:
                     return
@@ -624,6 +734,60 @@ class sn_Emulation_Start_Thread(threading.Thread):
         for perf_thread in perf_threads:
             perf_thread.join()
 
+    def update_delay(self, timeptr):
+        self.applied, applied, skipped = sn_update_delay(
+            self.timeline.delay_timeline, timeptr, self.applied,
+            self.delay_threshold, self.constellation_size, self.agent)
+        self.delay_applied += applied
+        self.delay_skipped += skipped
+
+    def forget_delays(self, satellites):
+        # Damage and recovery reset the netem delays of the links of
+        # satellites (0-based): they are sent again by the next update.
+        self.applied = sn_forget_links(self.applied, satellites)
+
+    def add_link_op(self, s, f, delay):
+        # Agent operation bringing up link s-f (1-based, s < f): a new GSL,
+        # or the network of an ISL that was up before, or a new ISL.
+        delay = round(float(delay), 2)
+        if f > self.constellation_size:
+            return [
+                'gsl_add', s, f, self.constellation_size, delay,
+                self.sat_ground_bw, self.sat_ground_loss
+            ]
+        if (s, f) in self.isl_networks:
+            return ['isl_up', s, f, delay]
+        if self.free_isl_idx:
+            isl_idx = self.free_isl_idx.pop()
+        else:
+            isl_idx = self.next_isl_idx
+            self.next_isl_idx += 1
+        self.isl_networks[(s, f)] = isl_idx
+        return ['isl_add', isl_idx, s, f, delay, self.sat_bw, self.sat_loss]
+
+    def del_isl_op(self, s, f):
+        # Agent operation taking down ISL s-f (1-based, s < f). A candidate
+        # ISL keeps its network, so it can come back; the network of any
+        # other pair, such as an inter-shell link, is removed and its number
+        # freed. The adds of a change come before its dels, so a number is
+        # used again in a later change only.
+        if (s, f) in self.isl_pairs:
+            return ['isl_down', s, f]
+        self.free_isl_idx.append(self.isl_networks.pop((s, f)))
+        return ['isl_del', s, f]
+
+
+def sn_put_delay_frame(remote_ftp, file_path, configuration_file_path,
+                       time_index):
+    # Upload the links at time_index as a one-frame timeline.
+    local_path = configuration_file_path + "/" + file_path
+    timeline = DelayTimeline(sn_timeline_path(local_path))
+    frame_path = local_path + '/mid_files/' + str(time_index) + '.sndt'
+    sn_save_frame(frame_path, timeline.node_num, timeline.edges(time_index))
+    remote_delay_path = file_path + '/' + str(time_index) + '.sndt'
+    remote_ftp.put(frame_path, remote_delay_path)
+    return remote_delay_path
+
 
 def sn_check_utility(time_index, remote_ssh, file_path):
     result = sn_remote_cmd(remote_ssh, "vmstat")
@@ -632,23 +796,60 @@ def sn_check_utility(time_index, remote_ssh, file_path):
     f.close()
 
 
-def sn_update_delay(file_path, configuration_file_path, timeptr,
-                    constellation_size, remote_ssh,
-                    remote_ftp):  # updating delays
-    remote_ftp.put(os.path.join(os.getcwd(), "starrynet/sn_orchestrater.py"),
-                   file_path + "/sn_orchestrater.py")
-    remote_ftp.put(
-        configuration_file_path + "/" + file_path + '/delay/' + str(timeptr) +
-        '.txt', file_path + '/' + str(timeptr) + '.txt')
-    sn_remote_cmd(
-        remote_ssh,
-        "python3 " + file_path + "/sn_orchestrater.py " + file_path + '/' +
-        str(timeptr) + '.txt ' + str(constellation_size) + " update")
-    print("Delay updating done.\n")
-
-
-def sn_damage(ratio, damage_list, constellation_size, remote_ssh, remote_ftp,
-              file_path, configuration_file_path):
+def sn_delay_updates(applied, edges, node_num, threshold):
+    # applied: links and delays set on the remote machine, edges: links of
+    # the second to emulate (both sorted frames, see sn_make_edges).
+    # Returns whether each link of edges must be updated, i.e. is new or
+    # moved by more than threshold (ms), and the delays applied afterwards.
+    pre_keys = sn_edge_keys(applied, node_num)
+    keys = sn_edge_keys(edges, node_num)
+    known = numpy.zeros(len(keys), dtype=bool)
+    pre_delay = numpy.zeros(len(keys), dtype=edges['delay'].dtype)
+    if len(pre_keys):
+        pos = numpy.minimum(numpy.searchsorted(pre_keys, keys),
+                            len(pre_keys) - 1)
+        known = pre_keys[pos] == keys
+        pre_delay = numpy.where(known, applied['delay'][pos], 0)
+    moved = numpy.abs(sn_quantize(edges['delay']) - sn_quantize(pre_delay))
+    update = ~known | (moved > numpy.rint(threshold * 100))
+    edges = edges.copy()
+    edges['delay'] = numpy.where(update, edges['delay'], pre_delay)
+    return update, edges
+
+
+def sn_forget_links(applied, nodes):
+    # applied without the links of nodes (0-based), whose delays are then
+    # unknown on the remote machine.
+    nodes = numpy.asarray(list(nodes), dtype=numpy.int64)
+    keep = ~(numpy.isin(applied['src'], nodes) |
+             numpy.isin(applied['dst'], nodes))
+    return applied[keep]
+
+
+def sn_update_delay(delay_timeline, timeptr, applied, threshold,
+                    constellation_size, agent):  # updating delays
+    # Only the links whose delay changed by more than threshold since it
+    # was last applied are sent to the agent. Returns the applied delays
+    # and the numbers of applied and skipped link updates.
+    start_time = time.time()
+    update, applied = sn_delay_updates(applied,
+                                       delay_timeline.edges(timeptr),
+                                       delay_timeline.node_num, threshold)
+    changed = applied[update]
+    remote_time = 0
+    if len(changed):
+        links = [[s, f, round(delay, 2)] for s, f, delay in zip(
+            changed['src'].tolist(), changed['dst'].tolist(),
+            changed['delay'].tolist())]
+        remote_time = agent.call([['update', links, constellation_size]])[0]
+    skipped = len(update) - len(changed)
+    print("Delay updating done: %d links applied, %d skipped, in %.3f s "
+          "(%.3f s on the remote machine).\n" %
+          (len(changed), skipped, time.time() - start_time, remote_time))
+    return applied, len(changed), skipped
+
+
+def sn_damage(ratio, damage_list, constellation_size, agent):
     print("Randomly setting damaged links...\n")
     random_list = []
     cumulated_damage_list = damage_list
@@ -656,36 +857,20 @@ def sn_damage(ratio, damage_list, constellation_size, remote_ssh, remote_ftp,
         target = int(random.uniform(0, constellation_size - 1))
         random_list.append(target)
         cumulated_damage_list.append(target)
-    numpy.savetxt(
-        configuration_file_path + "/" + file_path +
-        '/mid_files/damage_list.txt', random_list)
-    remote_ftp.put(os.path.join(os.getcwd(), "starrynet/sn_orchestrater.py"),
-                   file_path + "/sn_orchestrater.py")
-    remote_ftp.put(
-        configuration_file_path + "/" + file_path +
-        '/mid_files/damage_list.txt', file_path + "/damage_list.txt")
-    sn_remote_cmd(remote_ssh,
-                  "python3 " + file_path + "/sn_orchestrater.py " + file_path)
+    agent.call([['damage', random_list]])
     print("Damage done.\n")
+    # tc qdisc change ... loss resets the delays of their links
+    return random_list
 
 
-def sn_recover(damage_list, sat_loss, remote_ssh, remote_ftp, file_path,
-               configuration_file_path):
+def sn_recover(damage_list, sat_loss, agent):
     print("Recovering damaged links...\n")
     cumulated_damage_list = damage_list
-    numpy.savetxt(
-        configuration_file_path + "/" + file_path +
-        '/mid_files/damage_list.txt', cumulated_damage_list)
-    remote_ftp.put(os.path.join(os.getcwd(), "starrynet/sn_orchestrater.py"),
-                   file_path + "/sn_orchestrater.py")
-    remote_ftp.put(
-        configuration_file_path + "/" + file_path +
-        '/mid_files/damage_list.txt', file_path + "/damage_list.txt")
-    sn_remote_cmd(
-        remote_ssh, "python3 " + file_path + "/sn_orchestrater.py " +
-        file_path + " " + str(sat_loss))
+    recovered = list(cumulated_damage_list)
+    agent.call([['recover', cumulated_damage_list, sat_loss]])
     cumulated_damage_list.clear()
     print("Link recover done.\n")
+    return recovered
 
 
 def sn_sr(src, des, target, container_id_list, remote_ssh):
@@ -780,113 +965,6 @@ def sn_route(src, time_index, file_path, configuration_file_path,
     f.close()
 
 
-def sn_establish_new_GSL(container_id_list, matrix, constellation_size, bw,
-                         loss, sat_index, GS_index, remote_ssh):
-    i = sat_index
-    j = GS_index
-    # IP address  (there is a link between i and j)
-    delay = str(matrix[i - 1][j - 1])
-    address_16_23 = (j - constellation_size) & 0xff
-    address_8_15 = i & 0xff
-    GSL_name = "GSL_" + str(i) + "-" + str(j)
-    # Create internal network in docker.
-    sn_remote_cmd(
-        remote_ssh, 'docker network create ' + GSL_name + " --subnet 9." +
-        str(address_16_23) + "." + str(address_8_15) + ".0/24")
-    print('[Create GSL:]' + 'docker network create ' + GSL_name +
-          " --subnet 9." + str(address_16_23) + "." + str(address_8_15) +
-          ".0/24")
-    sn_remote_cmd(
-        remote_ssh, 'docker network connect ' + GSL_name + " " +
-        str(container_id_list[i - 1]) + " --ip 9." + str(address_16_23) + "." +
-        str(address_8_15) + ".50")
-    ifconfig_output = sn_remote_cmd(
-        remote_ssh, "docker exec -it " + str(container_id_list[i - 1]) +
-        " ip addr | grep -B 2 9." + str(address_16_23) + "." +
-        str(address_8_15) +
-        ".50 | head -n 1 | awk -F: '{ print $2 }' | tr -d [:blank:]")
-    target_interface = str(ifconfig_output[0]).split("@")[0]
-    sn_remote_cmd(
-        remote_ssh, "docker exec -d " + str(container_id_list[i - 1]) +
-        " ip link set dev " + target_interface + " down")
-    sn_remote_cmd(
-        remote_ssh, "docker exec -d " + str(container_id_list[i - 1]) +
-        " ip link set dev " + target_interface + " name " + "B" +
-        str(i - 1 + 1) + "-eth" + str(j))
-    sn_remote_cmd(
-        remote_ssh, "docker exec -d " + str(container_id_list[i - 1]) +
-        " ip link set dev B" + str(i - 1 + 1) + "-eth" + str(j) + " up")
-    sn_remote_cmd(
-        remote_ssh, "docker exec -d " + str(container_id_list[i - 1]) +
-        " tc qdisc add dev B" + str(i - 1 + 1) + "-eth" + str(j) +
-        " root netem delay " + str(delay) + "ms")
-    sn_remote_cmd(
-        remote_ssh, "docker exec -d " + str(container_id_list[i - 1]) +
-        " tc qdisc add dev B" + str(i - 1 + 1) + "-eth" + str(j) +
-        " root netem loss " + str(loss) + "%")
-    sn_remote_cmd(
-        remote_ssh, "docker exec -d " + str(container_id_list[i - 1]) +
-        " tc qdisc add dev B" + str(i - 1 + 1) + "-eth" + str(j) +
-        " root netem rate " + str(bw) + "Gbps")
-    print('[Add current node:]' + 'docker network connect ' + GSL_name + " " +
-          str(container_id_list[i - 1]) + " --ip 10." + str(address_16_23) +
-          "." + str(address_8_15) + ".50")
-    sn_remote_cmd(
-        remote_ssh, 'docker network connect ' + GSL_name + " " +
-        str(container_id_list[j - 1]) + " --ip 9." + str(address_16_23) + "." +
-        str(address_8_15) + ".60")
-    ifconfig_output = sn_remote_cmd(
-        remote_ssh, "docker exec -it " + str(container_id_list[j - 1]) +
-        " ip addr | grep -B 2 9." + str(address_16_23) + "." +
-        str(address_8_15) +
-        ".60 | head -n 1 | awk -F: '{ print $2 }' | tr -d [:blank:]")
-    target_interface = str(ifconfig_output[0]).split("@")[0]
-    sn_remote_cmd(
-        remote_ssh, "docker exec -d " + str(container_id_list[j - 1]) +
-        " ip link set dev " + target_interface + " down")
-    sn_remote_cmd(
-        remote_ssh, "docker exec -d " + str(container_id_list[j - 1]) +
-        " ip link set dev " + target_interface + " name " + "B" + str(j) +
-        "-eth" + str(i - 1 + 1))
-    sn_remote_cmd(
-        remote_ssh, "docker exec -d " + str(container_id_list[j - 1]) +
-        " ip link set dev B" + str(j) + "-eth" + str(i - 1 + 1) + " up")
-    sn_remote_cmd(
-        remote_ssh, "docker exec -d " + str(container_id_list[j - 1]) +
-        " tc qdisc add dev B" + str(j) + "-eth" + str(i - 1 + 1) +
-        " root netem delay " + str(delay) + "ms")
-    sn_remote_cmd(
-        remote_ssh, "docker exec -d " + str(container_id_list[j - 1]) +
-        " tc qdisc add dev B" + str(j) + "-eth" + str(i - 1 + 1) +
-        " root netem loss " + str(loss) + "%")
-    sn_remote_cmd(
-        remote_ssh, "docker exec -d " + str(container_id_list[j - 1]) +
-        " tc qdisc add dev B" + str(j) + "-eth" + str(i - 1 + 1) +
-        " root netem rate " + str(bw) + "Gbps")
-    print('[Add right node:]' + 'docker network connect ' + GSL_name + " " +
-          str(container_id_list[j - 1]) + " --ip 10." + str(address_16_23) +
-          "." + str(address_8_15) + ".60")
-
-
-def sn_del_link(first_index, second_index, container_id_list, remote_ssh):
-    sn_remote_cmd(
-        remote_ssh, "docker exec -d " +
-        str(container_id_list[second_index - 1]) + " ip link set dev B" +
-        str(second_index) + "-eth" + str(first_index) + " down")
-    sn_remote_cmd(
-        remote_ssh, "docker exec -d " +
-        str(container_id_list[first_index - 1]) + " ip link set dev B" +
-        str(first_index) + "-eth" + str(second_index) + " down")
-    GSL_name = "GSL_" + str(first_index) + "-" + str(second_index)
-    sn_remote_cmd(
-        remote_ssh, 'docker network disconnect ' + GSL_name + " " +
-        str(container_id_list[first_index - 1]))
-    sn_remote_cmd(
-        remote_ssh, 'docker network disconnect ' + GSL_name + " " +
-        str(container_id_list[second_index - 1]))
-    sn_remote_cmd(remote_ssh, 'docker network rm ' + GSL_name)
-
-
 # A thread designed for stopping the emulation.
 class sn_Emulation_Stop_Thread(threading.Thread):
 
@@ -0,0 +1,204 @@
+import numpy as np
+"""
+Ground-to-satellite visibility kernels used by the observer, on ITRS xyz
+(km) of satellites and ground terminals. With few GSes, all GS-satellite
+distances of a block of timesteps are computed at once with broadcasting.
+With many ground terminals, the terminals are put once in a uniform grid of
+cubes, and every timestep only the terminals of the cubes within slant
+range of a satellite are candidates (GroundGrid).
+"""
+
+# Radio propagation speed used for link delays, km/s.
+SN_LINK_SPEED = 17.31 / 29.5 * 299792.458
+
+# Upper bound of GS x satellite x timestep cells evaluated in one block.
+SN_BLOCK_CELLS = 1 << 22
+# GS number from which sn_gsl_access uses the ground grid.
+SN_GRID_MIN_GS = 64
+# Cubes of a PointGrid per lookup distance.
+SN_GRID_SPLIT = 2
+# Height (km) of the atmosphere a link between satellites may not cross.
+SN_ATMOSPHERE = 80
+
+
+def sn_gsl_access(sat_cbf, sat_lat, fac_cbf, fac_lat, bound_dis, alpha,
+                  antenna_num):
+    # sat_cbf: (T, N, 3) satellite xyz, sat_lat: (T, N) satellite latitude
+    # (see sn_itrs_latitude), fac_cbf: (G, 3) GS xyz, fac_lat: (G, ) GS
+    # latitude
+    # Returns (T, G, antenna_num) satellite indexes, closest first (-1 for an
+    # unused antenna), and the matching distances in km (inf if unused).
+    sat_cbf = np.asarray(sat_cbf, dtype=float)
+    sat_lat = np.asarray(sat_lat, dtype=float)
+    fac_cbf = np.asarray(fac_cbf, dtype=float).reshape(-1, 3)
+    fac_lat = np.asarray(fac_lat, dtype=float)
+    T, N = sat_lat.shape
+    G = len(fac_lat)
+    K = min(antenna_num, N)
+    access_sat = np.full((T, G, K), -1, dtype=np.int64)
+    access_dis = np.full((T, G, K), np.inf)
+    if T == 0 or G == 0 or K <= 0:
+        return access_sat, access_dis
+    if G >= SN_GRID_MIN_GS:
+        grid = GroundGrid(fac_cbf, bound_dis)
+        for t in range(T):
+            access_sat[t], access_dis[t] = sn_grid_access(
+                *grid.visible(sat_cbf[t], sat_lat[t], fac_lat, bound_dis,
+                              alpha), G, K)
+        return access_sat, access_dis
+    up_lat = fac_lat + alpha  # bound
+    down_lat = fac_lat - alpha
+    g_step = max(1, min(G, SN_BLOCK_CELLS // N))
+    t_step = max(1, SN_BLOCK_CELLS // (g_step * N))
+    for t0 in range(0, T, t_step):
+        t1 = min(T, t0 + t_step)
+        lat = sat_lat[t0:t1, None, :]
+        for g0 in range(0, G, g_step):
+            g1 = min(G, g0 + g_step)
+            dis = sn_pairwise_distance(sat_cbf[t0:t1], fac_cbf[g0:g1])
+            visible = (lat >= down_lat[None, g0:g1, None]) & (
+                lat <= up_lat[None, g0:g1, None]) & (dis < bound_dis)
+            dis[~visible] = np.inf
+            sat, dis = sn_closest(dis, K)
+            sat[np.isinf(dis)] = -1
+            access_sat[t0:t1, g0:g1] = sat
+            access_dis[t0:t1, g0:g1] = dis
+    return access_sat, access_dis
+
+
+def sn_grid_access(gs, sat, dis, G, K):
+    # (G, K) closest satellites (-1 if unused) and distances (inf) of each
+    # GS from its visible (gs, sat, distance) sorted by GS then distance, as
+    # returned by GroundGrid.visible.
+    access_sat = np.full((G, K), -1, dtype=np.int64)
+    access_dis = np.full((G, K), np.inf)
+    # rank of each satellite among the visible ones of its GS
+    rank = np.arange(len(gs)) - np.searchsorted(gs, gs)
+    keep = rank < K
+    access_sat[gs[keep], rank[keep]] = sat[keep]
+    access_dis[gs[keep], rank[keep]] = dis[keep]
+    return access_sat, access_dis
+
+
+class PointGrid():
+
+    def __init__(self, points, bound):
+        # points: (P, 3) xyz (km) put in a uniform grid of cubes, bound:
+        # largest distance (km) at which they are looked up
+        self.points = np.asarray(points, dtype=float).reshape(-1, 3)
+        self.bound = float(bound)
+        self.cell = self.bound / SN_GRID_SPLIT
+        cells = np.floor(self.points / self.cell).astype(np.int64)
+        # the grid covers the points; lookups outside find nothing
+        if len(cells):
+            self.low = cells.min(axis=0)
+            self.size = cells.max(axis=0) - self.low + 1
+        else:
+            self.low = np.zeros(3, dtype=np.int64)
+            self.size = np.ones(3, dtype=np.int64)
+        # offsets of the cubes that can hold a point within bound of a point
+        # of cube 0: their gap to cube 0 is below the bound
+        span = np.arange(-SN_GRID_SPLIT, SN_GRID_SPLIT + 1)
+        offsets = np.stack(np.meshgrid(span, span, span, indexing='ij'),
+                           axis=-1).reshape(-1, 3)
+        gap = np.maximum(np.abs(offsets) - 1, 0) * self.cell
+        self.offsets = offsets[np.sum(gap * gap, axis=-1) < self.bound**2]
+        keys = self.keys(cells)
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+    def keys(self, cells):
+        cells = cells - self.low
+        return (cells[..., 0] * self.size[1] + cells[..., 1]) * \
+            self.size[2] + cells[..., 2]
+
+    def candidates(self, queries):
+        # (point, query) index pairs of every query xyz and the points of
+        # the cubes around it, a superset of the pairs within bound.
+        cells = np.floor(queries / self.cell).astype(np.int64)
+        around = cells[:, None, :] + self.offsets[None, :, :]  # (Q, cubes, 3)
+        inside = np.all((around >= self.low) &
+                        (around < self.low + self.size),
+                        axis=-1)
+        keys = np.where(inside, self.keys(around), -1)
+        first = np.searchsorted(self.sorted_keys, keys, side='left')
+        count = np.searchsorted(self.sorted_keys, keys, side='right') - first
+        count[~inside] = 0
+        count = count.ravel()
+        # positions first[k] .. first[k] + count[k] - 1 of every cube k
+        starts = np.repeat(first.ravel() - np.cumsum(count) + count, count)
+        pos = starts + np.arange(count.sum())
+        query = np.repeat(np.arange(len(queries)), self.offsets.shape[0])
+        return self.order[pos], np.repeat(query, count)
+
+
+class GroundGrid(PointGrid):
+
+    def __init__(self, fac_cbf, bound_dis):
+        # fac_cbf: (G, 3) terminal xyz, bound_dis: slant range (km). The
+        # terminals do not move, so they are put in the grid once and every
+        # timestep only looks up the cubes around each satellite.
+        PointGrid.__init__(self, fac_cbf, np.max(bound_dis))
+        self.fac_cbf = self.points
+
+    def visible(self, sat_cbf, sat_lat, fac_lat, bound_dis, alpha):
+        # (gs, sat, distance) of the satellites of one timestep within slant
+        # range and latitude band of each terminal, sorted by terminal then
+        # distance.
+        sat_cbf = np.asarray(sat_cbf, dtype=float)
+        gs, sat = self.candidates(sat_cbf)
+        dx = sat_cbf[sat, 0] - self.fac_cbf[gs, 0]
+        dy = sat_cbf[sat, 1] - self.fac_cbf[gs, 1]
+        dz = sat_cbf[sat, 2] - self.fac_cbf[gs, 2]
+        dis = dx * dx + dy * dy + dz * dz
+        # loose squared range first, the exact test follows
+        near = dis < self.bound**2 * 1.001
+        gs, sat, dis = gs[near], sat[near], np.sqrt(dis[near])
+        bound_dis = np.broadcast_to(np.asarray(bound_dis, dtype=float),
+                                    (len(sat_cbf), ))
+        lat = sat_lat[sat]
+        keep = (lat >= fac_lat[gs] - alpha) & (lat <= fac_lat[gs] + alpha) & (
+            dis < bound_dis[sat])
+        gs, sat, dis = gs[keep], sat[keep], dis[keep]
+        order = np.lexsort((sat, dis, gs))
+        return gs[order], sat[order], dis[order]
+
+
+def sn_pairwise_distance(sat_cbf, fac_cbf):
+    # (T, N, 3) satellites and (G, 3) ground nodes -> (T, G, N) distances
+    dx = sat_cbf[:, None, :, 0] - fac_cbf[None, :, None, 0]
+    dy = sat_cbf[:, None, :, 1] - fac_cbf[None, :, None, 1]
+    dz = sat_cbf[:, None, :, 2] - fac_cbf[None, :, None, 2]
+    return np.sqrt(dx * dx + dy * dy + dz * dz)
+
+
+def sn_closest(dis, k):
+    # Indexes and values of the k smallest entries along the last axis,
+    # sorted by distance.
+    if k < dis.shape[-1]:
+        sat = np.argpartition(dis, k - 1, axis=-1)[..., :k]
+    else:
+        sat = np.broadcast_to(np.arange(dis.shape[-1]), dis.shape)
+    dis = np.take_along_axis(dis, sat, axis=-1)
+    order = np.argsort(dis, axis=-1, kind='stable')
+    return np.take_along_axis(sat, order, -1), np.take_along_axis(
+        dis, order, -1)
+
+
+def sn_line_of_sight(cbf1, cbf2, margin=SN_ATMOSPHERE):
+    # (..., 3) xyz in km -> whether the segment between them stays margin km
+    # above a spherical earth.
+    d = cbf2 - cbf1
+    dd = np.sum(d * d, axis=-1)
+    # closest point of the segment to the earth center
+    s = np.clip(-np.sum(cbf1 * d, axis=-1) / np.where(dd > 0, dd, 1), 0, 1)
+    closest = cbf1 + s[..., None] * d
+    return np.sum(closest * closest, axis=-1) > (6371 + margin)**2
+
+
+def sn_link_delay(cbf1, cbf2):
+    # (..., 3) xyz in km -> delay in ms
+    d = cbf1 - cbf2
+    dist = np.sqrt(d[..., 0] * d[..., 0] + d[..., 1] * d[..., 1] +
+                   d[..., 2] * d[..., 2])
+    return dist / SN_LINK_SPEED * 1000
@@ -0,0 +1,268 @@
+import numpy as np
+
+from starrynet.sn_propagator import *
+from starrynet.sn_visibility import *
+"""
+Analytic GS-satellite visibility windows and handover instants. Visibility
+(latitude band and slant range, as in sn_gsl_access) and the set of serving
+satellites are sampled every SN_COARSE_STEP seconds; every change between two
+samples is then located to SN_TIME_RESOLUTION by bisection on exact SGP4
+positions. Times are in milliseconds since the start of the run; a pass or a
+change of serving satellites shorter than the coarse step may be missed. The
+bisection of a GS only propagates the satellites visible to it at either end
+of the coarse interval, and with many GSes the coarse samples use the ground
+grid (GroundGrid) instead of all GS-satellite distances.
+"""
+
+SN_COARSE_STEP = 10  # s
+SN_TIME_RESOLUTION = 0.001  # s
+# rise/set of a GS-satellite pair, node indexes 1-based as in the timeline
+SN_WINDOW_DTYPE = np.dtype([('gs', '<i4'), ('sat', '<i4'), ('rise', '<i8'),
+                            ('set', '<i8')])
+# a GSL connected (1) or disconnected (0) at time (ms)
+SN_HANDOVER_DTYPE = np.dtype([('time', '<i8'), ('gs', '<i4'), ('sat', '<i4'),
+                              ('connect', 'i1')])
+
+
+def sn_windows_path(path):
+    return path + '/delay/windows.npy'
+
+
+def sn_handovers_path(path):
+    return path + '/delay/handovers.npy'
+
+
+def sn_coarse_times(duration, step=SN_COARSE_STEP):
+    # Sample seconds covering [0, duration], both ends included.
+    return np.unique(np.append(np.arange(0, duration, step), duration))
+
+
+def sn_bisect(lo, hi, same_as_lo):
+    # Shrinks every interval [lo, hi] around a state change: same_as_lo(index,
+    # t) tells whether the items index are still in their lo state at t.
+    # Returns the refined hi, the first instant in the new state.
+    lo = np.array(lo, dtype=float)
+    hi = np.array(hi, dtype=float)
+    while True:
+        index = np.flatnonzero(hi - lo > SN_TIME_RESOLUTION)
+        if len(index) == 0:
+            return hi
+        mid = (lo[index] + hi[index]) / 2
+        same = same_as_lo(index, mid)
+        lo[index[same]] = mid[same]
+        hi[index[~same]] = mid[~same]
+
+
+def sn_to_ms(seconds):
+    return np.round(np.asarray(seconds) * 1000).astype(np.int64)
+
+
+def sn_mask_indexes(mask):
+    # (M, C) column indexes of the True entries of every row of mask (M, N),
+    # -1 padded; C is the largest row count.
+    count = np.count_nonzero(mask, axis=1)
+    C = int(count.max()) if len(count) else 0
+    index = np.argsort(~mask, axis=1, kind='stable')[:, :C]
+    return np.where(np.arange(C) < count[:, None], index, -1)
+
+
+def sn_pad_columns(columns, value=-1):
+    # Concatenates (M_i, C_i) arrays, padding them to the largest C_i.
+    C = max(column.shape[1] for column in columns)
+    return np.concatenate([
+        np.pad(column, ((0, 0), (0, C - column.shape[1])),
+               constant_values=value) for column in columns
+    ])
+
+
+class VisibilityPredictor():
+
+    def __init__(self, satrecs, start, duration, fac_cbf, fac_lat, bound_dis,
+                 alpha, antenna_num):
+        self.satrecs = satrecs
+        self.start = start
+        self.duration = duration
+        self.fac_cbf = np.asarray(fac_cbf, dtype=float).reshape(-1, 3)
+        self.fac_lat = np.asarray(fac_lat, dtype=float)
+        self.sat_num = len(satrecs)
+        self.bound_dis = np.broadcast_to(
+            np.asarray(bound_dis, dtype=float), (self.sat_num, ))
+        self.alpha = alpha
+        self.antenna_num = antenna_num
+
+    def visible_pairs(self, gs, sats, seconds):
+        # Visibility of satellite sats[m] from GS gs[m] at seconds[m]
+        xyz = sn_propagate_pairs(self.satrecs, sats, seconds, self.start)
+        d = xyz - self.fac_cbf[gs]
+        dis = np.sqrt(np.sum(d * d, axis=-1))
+        lat = sn_itrs_latitude(xyz)
+        return (lat >= self.fac_lat[gs] - self.alpha) & (
+            lat <= self.fac_lat[gs] + self.alpha) & (dis <
+                                                     self.bound_dis[sats])
+
+    def serving(self, gs, seconds, candidates):
+        # (M, antenna_num) sorted serving satellites (-1 for an unused
+        # antenna) of GS gs[m] at seconds[m]: the closest visible ones among
+        # candidates[m] (-1 padded), the only satellites propagated.
+        M, C = candidates.shape
+        K = min(self.antenna_num, self.sat_num)
+        if C < K:
+            candidates = np.pad(candidates, ((0, 0), (0, K - C)),
+                                constant_values=-1)
+            M, C = candidates.shape
+        sats = np.maximum(candidates, 0)
+        xyz = sn_propagate_pairs(self.satrecs, sats.ravel(),
+                                 np.repeat(seconds, C),
+                                 self.start).reshape(M, C, 3)
+        d = xyz - self.fac_cbf[gs][:, None, :]
+        dis = np.sqrt(np.sum(d * d, axis=-1))
+        lat = sn_itrs_latitude(xyz)
+        visible = (candidates >= 0) & (
+            lat >= (self.fac_lat[gs] - self.alpha)[:, None]) & (
+                lat <= (self.fac_lat[gs] + self.alpha)[:, None]) & (
+                    dis < self.bound_dis[sats])
+        dis[~visible] = np.inf
+        index, dis = sn_closest(dis, K)
+        sat = np.take_along_axis(candidates, index, -1)
+        sat[np.isinf(dis)] = -1
+        return np.sort(sat, axis=-1)
+
+    def coarse(self, step=SN_COARSE_STEP):
+        # Yields (time, visible (G, N), serving (G, K) sorted) at the coarse
+        # sample times, a block of times at a time.
+        times = sn_coarse_times(self.duration, step)
+        G = len(self.fac_lat)
+        K = min(self.antenna_num, self.sat_num)
+        if G >= SN_GRID_MIN_GS:
+            grid = GroundGrid(self.fac_cbf, self.bound_dis)
+            for t in times:
+                xyz = sn_propagate(self.satrecs, [t], self.start)[0]
+                gs, sat, dis = grid.visible(xyz, sn_itrs_latitude(xyz),
+                                            self.fac_lat, self.bound_dis,
+                                            self.alpha)
+                visible = np.zeros((G, self.sat_num), dtype=bool)
+                visible[gs, sat] = True
+                serving, _ = sn_grid_access(gs, sat, dis, G, K)
+                yield t, visible, np.sort(serving, axis=-1)
+            return
+        block = max(1, SN_BLOCK_CELLS // max(1, G * self.sat_num))
+        for b in range(0, len(times), block):
+            part = times[b:b + block]
+            xyz = sn_propagate(self.satrecs, part, self.start)
+            dis = sn_pairwise_distance(xyz, self.fac_cbf)  # (T, G, N)
+            lat = sn_itrs_latitude(xyz)[:, None, :]
+            visible = (lat >= (self.fac_lat - self.alpha)[None, :, None]) & (
+                lat <= (self.fac_lat + self.alpha)[None, :, None]) & (
+                    dis < self.bound_dis[None, None, :])
+            dis[~visible] = np.inf
+            sat, dis = sn_closest(dis, K)
+            sat[np.isinf(dis)] = -1
+            sat = np.sort(sat, axis=-1)
+            for i, t in enumerate(part):
+                yield t, visible[i], sat[i]
+
+    def predict(self, step=SN_COARSE_STEP):
+        # Returns (windows, handovers): SN_WINDOW_DTYPE and SN_HANDOVER_DTYPE
+        # arrays sorted by time.
+        G = len(self.fac_lat)
+        end = sn_to_ms(self.duration)
+        rises = []  # (gs, sat, ms) of every window start
+        sets = []
+        flips = []  # (gs, sat, lo, hi) visibility changes
+        # (gs, lo, hi, serving at lo, candidates) serving set changes, the
+        # candidates being the satellites visible at lo or hi
+        changes = []
+        pre = None
+        for t, visible, serving in self.coarse(step):
+            if pre is None:
+                g, s = np.nonzero(visible)
+                rises.append((g, s, np.zeros(len(g), dtype=np.int64)))
+            else:
+                pre_t, pre_visible, pre_serving = pre
+                g, s = np.nonzero(visible != pre_visible)
+                flips.append((g, s, np.full(len(g), pre_t, dtype=float),
+                              np.full(len(g), t, dtype=float)))
+                g = np.flatnonzero(np.any(serving != pre_serving, axis=1))
+                changes.append(
+                    (g, np.full(len(g), pre_t, dtype=float),
+                     np.full(len(g), t, dtype=float), pre_serving[g],
+                     sn_mask_indexes(pre_visible[g] | visible[g])))
+            pre = (t, visible, serving)
+        if pre is not None:
+            g, s = np.nonzero(pre[1])
+            sets.append((g, s, np.full(len(g), end, dtype=np.int64)))
+
+        # rise/set instants
+        g, s, lo, hi = [np.concatenate(column) for column in zip(*flips)]
+        if len(g):
+            rising = ~self.visible_pairs(g, s, lo)
+            at = sn_bisect(
+                lo, hi, lambda index, mid: self.visible_pairs(
+                    g[index], s[index], mid) != rising[index])
+            ms = sn_to_ms(at)
+            rises.append((g[rising], s[rising], ms[rising]))
+            sets.append((g[~rising], s[~rising], ms[~rising]))
+        windows = self.pair_windows(rises, sets)
+        handovers = self.refine_changes(changes, G)
+        return windows, handovers
+
+    def pair_windows(self, rises, sets):
+        # Rises and sets of a pair alternate: matching them in (gs, sat,
+        # time) order gives the windows.
+        rg, rs, rt = [np.concatenate(column) for column in zip(*rises)]
+        sg, ss, st = [np.concatenate(column) for column in zip(*sets)]
+        r_order = np.lexsort((rt, rs, rg))
+        s_order = np.lexsort((st, ss, sg))
+        windows = np.empty(len(rg), dtype=SN_WINDOW_DTYPE)
+        windows['gs'] = rg[r_order] + self.sat_num + 1
+        windows['sat'] = rs[r_order] + 1
+        windows['rise'] = rt[r_order]
+        windows['set'] = st[s_order]
+        order = np.lexsort((windows['sat'], windows['gs'], windows['rise']))
+        return windows[order]
+
+    def refine_changes(self, changes, G):
+        # Exact instants of the serving set changes. An interval may hold
+        # several changes: after the first one is found, the rest of the
+        # interval is searched again from the new serving set.
+        K = min(self.antenna_num, self.sat_num)
+        g, lo, hi, before = [
+            np.concatenate(column) for column in list(zip(*changes))[:4]
+        ] if changes else [np.zeros(0)] * 4
+        g = g.astype(np.int64)
+        before = before.reshape(-1, K).astype(np.int64)
+        candidates = sn_pad_columns([
+            change[4] for change in changes
+        ]) if changes else np.zeros((0, 0), dtype=np.int64)
+        events = []
+        while len(g):
+
+            def same_as_lo(index, mid):
+                serving = self.serving(g[index], mid, candidates[index])
+                return np.all(serving == before[index], axis=1)
+
+            at = sn_bisect(lo, hi, same_as_lo)
+            after = self.serving(g, at, candidates)
+            ms = sn_to_ms(at)
+            for i in range(len(g)):
+                added = np.setdiff1d(after[i], before[i])
+                removed = np.setdiff1d(before[i], after[i])
+                for sat, connect in [(removed, 0), (added, 1)]:
+                    sat = sat[sat >= 0]
+                    event = np.empty(len(sat), dtype=SN_HANDOVER_DTYPE)
+                    event['time'] = ms[i]
+                    event['gs'] = g[i] + self.sat_num + 1
+                    event['sat'] = sat + 1
+                    event['connect'] = connect
+                    events.append(event)
+            # the serving set at hi may differ again from the one found
+            again = np.any(self.serving(g, hi, candidates) != after,
+                           axis=1) & (hi - at > SN_TIME_RESOLUTION)
+            g, lo, hi, before = g[again], at[again], hi[again], after[again]
+            candidates = candidates[again]
+        if not events:
+            return np.zeros(0, dtype=SN_HANDOVER_DTYPE)
+        events = np.concatenate(events)
+        order = np.lexsort((events['sat'], events['connect'], events['gs'],
+                            events['time']))
+        return events[order]
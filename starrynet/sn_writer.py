@@ -0,0 +1,103 @@
+import queue
+import threading
+import time
+"""
+Background output stage of the observer. Writes (any callable and its
+arguments) are queued to a writer thread, in order, so computing the next
+seconds overlaps with formatting and writing the previous ones. The queue is
+bounded: submit() blocks while it is full, which keeps the memory held by
+pending outputs bounded, and how often and how long it blocked is recorded
+(stats()). flush() waits for the queued writes, close() also stops the
+thread. Once a write raises, the later writes are dropped and every later
+submit(), flush() or close() raises its exception again.
+"""
+
+# Writes queued at most before submit() blocks.
+SN_WRITER_QUEUE = 64
+
+
+def sn_write_positions(file_, lla):
+    # Same text as np.savetxt(file_, lla, fmt='%f', delimiter=','), formatted
+    # in one operation.
+    with open(file_, 'w') as f:
+        f.write(('%f,%f,%f\n' * len(lla)) % tuple(lla.ravel().tolist()))
+
+
+class AsyncWriter():
+
+    def __init__(self, maxsize=SN_WRITER_QUEUE):
+        self.jobs = queue.Queue(maxsize)
+        self.error = None
+        self.submitted = 0
+        self.blocks = 0  # submit() calls that found the queue full
+        self.blocked = 0.0  # seconds submit() waited for a free slot
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # do not hide the exception of the caller
+            try:
+                self.close()
+            except Exception:
+                pass
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                # after a failed write, the thread only drops the queued
+                # jobs until close()
+                if self.error is None:
+                    function, args = job
+                    function(*args)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def check(self):
+        # the error stays: the output is incomplete from then on
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, function, *args):
+        # Queue function(*args). The arguments must not be modified
+        # afterwards.
+        self.check()
+        if self.thread is None:
+            raise ValueError('write to a closed AsyncWriter')
+        try:
+            self.jobs.put_nowait((function, args))
+        except queue.Full:
+            start = time.time()
+            self.jobs.put((function, args))
+            self.blocks += 1
+            self.blocked += time.time() - start
+        self.submitted += 1
+
+    def stats(self):
+        # (writes submitted, submits blocked by a full queue, seconds blocked)
+        return self.submitted, self.blocks, self.blocked
+
+    def pending(self):
+        return self.jobs.qsize()
+
+    def flush(self):
+        # Wait until every queued write is done.
+        self.jobs.join()
+        self.check()
+
+    def close(self):
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+        self.check()
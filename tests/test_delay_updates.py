@@ -0,0 +1,38 @@
+import numpy as np
+
+from starrynet.sn_timeline import sn_make_edges
+from starrynet.sn_utils import (sn_damage, sn_delay_updates, sn_forget_links,
+                                sn_recover)
+
+
+class FakeAgent():
+
+    def __init__(self):
+        self.ops = []
+
+    def call(self, ops):
+        self.ops += ops
+        return [None] * len(ops)
+
+
+def test_recovered_links_are_updated_again():
+    # 4 satellites in a ring, delays that do not drift
+    edges = sn_make_edges(np.array([0, 1, 2, 0]), np.array([1, 2, 3, 3]),
+                          np.array([46.25, 46.25, 46.25, 46.25]))
+    agent = FakeAgent()
+    update, applied = sn_delay_updates(edges[:0], edges, 4, 0.1)
+    assert update.all()
+    update, applied = sn_delay_updates(applied, edges, 4, 0.1)
+    assert not update.any()
+
+    damage_list = []
+    damaged = sn_damage(0.25, damage_list, 4, agent)
+    applied = sn_forget_links(applied, damaged)
+    applied = sn_forget_links(applied, sn_recover(damage_list, 0, agent))
+    assert [op[0] for op in agent.ops] == ['damage', 'recover']
+
+    update, applied = sn_delay_updates(applied, edges, 4, 0.1)
+    touched = np.isin(edges['src'], damaged) | np.isin(edges['dst'], damaged)
+    assert touched.any()
+    assert (update == touched).all()
+    assert np.array_equal(applied, edges)
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+Compare the per-satellite skyfield loop formerly used by Observer.calculate_delay
+with the batched SatrecArray propagation in starrynet.sn_propagator.
+
+usage: python3 tools/benchmark_propagation.py [orbit_number] [sat_number] [duration]
+"""
+import os
+import sys
+import time
+import numpy as np
+from skyfield.api import load, wgs84, EarthSatellite
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from starrynet.sn_propagator import *
+
+
+def loop_propagate(satrecs, duration):
+    ts = load.timescale()
+    t_ts = ts.utc(*SN_START_UTC.timetuple()[:5], range(duration))
+    lla_per_sec = [[] for i in range(duration)]
+    for satrec in satrecs:
+        sat = EarthSatellite.from_satrec(satrec, ts)
+        subpoint = wgs84.subpoint(sat.at(t_ts))
+        for t in range(duration):
+            lla_per_sec[t].append([
+                subpoint.latitude.degrees[t], subpoint.longitude.degrees[t],
+                subpoint.elevation.km[t]
+            ])
+    return lla_per_sec
+
+
+if __name__ == '__main__':
+    orbit_number = int(sys.argv[1]) if len(sys.argv) > 1 else 72
+    sat_number = int(sys.argv[2]) if len(sys.argv) > 2 else 22
+    duration = int(sys.argv[3]) if len(sys.argv) > 3 else 3600
+    satrecs = sn_walker_satrecs(53, 550, orbit_number, sat_number)
+
+    start = time.time()
+    lla_loop = np.array(loop_propagate(satrecs, duration))
+    loop_time = time.time() - start
+
+    start = time.time()
+    lla_batch = sn_itrs_to_lla(sn_propagate(satrecs, range(duration)))
+    batch_time = time.time() - start
+
+    print("%d satellites x %d s" % (len(satrecs), duration))
+    print("loop:  %.3f s" % loop_time)
+    print("batch: %.3f s (%.1fx)" % (batch_time, loop_time / batch_time))
+    print("max |diff| (deg, deg, km): " +
+          str(np.abs(lla_loop - lla_batch).max(axis=(0, 1))))